@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import time
+import argparse
+import torch
+import torch.nn as nn
+from torchvision import models
+
+# Selectable ways of running the kitten classifier. All of them take a batch of
+# normalised 3x224x224 images and return logits, so classifier.ResidentModel can
+# use any of them.
+EAGER = 'eager' # fp32 eager mode, what the notebook trains
+CHANNELS_LAST = 'channels_last' # fp32 with NHWC tensors, faster convolutions on most x86 CPUs
+DYNAMIC_INT8_HEAD = 'dynamic_int8_head' # int8 weights for the Linear classifier head only; every conv layer stays fp32
+STATIC_INT8 = 'static_int8' # fully int8 conv stack, calibrated on sample images
+TORCHSCRIPT = 'torchscript' # traced, frozen TorchScript graph
+COMPILE = 'compile' # torch.compile
+ONNX = 'onnx' # exported to ONNX and run with ONNX Runtime
+BACKENDS = (EAGER, CHANNELS_LAST, DYNAMIC_INT8_HEAD, STATIC_INT8, TORCHSCRIPT, COMPILE, ONNX)
+CPU_ONLY_BACKENDS = (DYNAMIC_INT8_HEAD, STATIC_INT8, ONNX)
+
+NUM_CLASSES = 3
+INPUT_SHAPE = (3, 224, 224)
+ARCHS = ('resnet50', 'resnet18', 'mobilenet_v3_large', 'mobilenet_v3_small')
+
+
+def load_model(weights_path, arch='resnet50', num_classes=NUM_CLASSES, quantizable=False):
+    '''torchvision model with the notebook's 3-class head and the trained weights, in eval mode on the CPU.'''
+    if arch not in ARCHS:
+        raise ValueError(f"Unknown architecture {arch!r}, expected one of {ARCHS}")
+    if quantizable:
+        from torchvision.models import quantization
+        model = getattr(quantization, arch)(quantize=False)
+    else:
+        model = getattr(models, arch)()
+    if arch.startswith('resnet'):
+        model.fc = nn.Linear(model.fc.in_features, num_classes)
+    else:
+        model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, num_classes)
+    model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
+    model.eval()
+    return model
+
+
+class Wrapped:
+    '''Gives backends that need input conversion the same model(batch) -> logits call.'''
+    def __init__(self, module, convert=None, run=None):
+        self.module = module # Kept for memory accounting
+        self.convert = convert
+        self.run = run if run is not None else module
+
+    def __call__(self, batch):
+        if self.convert is not None:
+            batch = self.convert(batch)
+        return self.run(batch)
+
+
+class OnnxModel:
+    def __init__(self, onnx_path):
+        import onnxruntime
+        self.path = onnx_path
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        logits = self.session.run(None, {self.input_name: batch.cpu().numpy()})[0]
+        return torch.from_numpy(logits)
+
+
+def export_onnx(weights_path, arch='resnet50', onnx_path=None):
+    '''Exports the weights to ONNX next to the .pt file, unless an up-to-date export already exists.'''
+    onnx_path = onnx_path or os.path.splitext(weights_path)[0] + '.onnx'
+    if os.path.isfile(onnx_path) and os.path.getmtime(onnx_path) >= os.path.getmtime(weights_path):
+        return onnx_path
+    model = load_model(weights_path, arch)
+    torch.onnx.export(model, torch.zeros(1, *INPUT_SHAPE), onnx_path, input_names=['images'], output_names=['logits'],
+                      dynamic_axes={'images': {0: 'batch'}, 'logits': {0: 'batch'}}, opset_version=17)
+    return onnx_path
+
+
+def build(backend, weights_path, arch='resnet50', device=torch.device('cpu'), calibration=None):
+    '''
+    Returns a model(batch) -> logits callable for the named backend. static_int8
+    needs calibration: a list of image tensors representative of real traffic.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected one of {BACKENDS}")
+    example = torch.zeros(1, *INPUT_SHAPE, device=device)
+
+    if backend == EAGER:
+        return load_model(weights_path, arch).to(device)
+
+    if backend == CHANNELS_LAST:
+        model = load_model(weights_path, arch).to(device, memory_format=torch.channels_last)
+        return Wrapped(model, convert=lambda batch: batch.contiguous(memory_format=torch.channels_last))
+
+    if backend == DYNAMIC_INT8_HEAD:
+        # Dynamic quantization only covers Linear layers, which here are just the classifier head, so
+        # this runs at close to fp32 speed; static_int8 is the int8 path for the convolutions
+        return torch.ao.quantization.quantize_dynamic(load_model(weights_path, arch), {nn.Linear}, dtype=torch.qint8)
+
+    if backend == STATIC_INT8:
+        if not calibration:
+            raise ValueError("static_int8 needs calibration images")
+        model = load_model(weights_path, arch, quantizable=True)
+        model.fuse_model()
+        model.qconfig = torch.ao.quantization.get_default_qconfig('x86')
+        torch.ao.quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            for i in range(0, len(calibration), 32):
+                model(torch.stack(calibration[i:i + 32]))
+        return torch.ao.quantization.convert(model, inplace=True)
+
+    if backend == TORCHSCRIPT:
+        model = load_model(weights_path, arch).to(device)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+    if backend == COMPILE:
+        model = load_model(weights_path, arch).to(device)
+        return Wrapped(model, run=torch.compile(model))
+
+    return OnnxModel(export_onnx(weights_path, arch))
+
+
+def model_bytes(model):
+    '''
+    Bytes held by the model's weights and buffers, including packed int8 weights.
+    Frozen TorchScript graphs fold their weights into opaque constants and report 0.
+    '''
+    module = model.module if isinstance(model, Wrapped) else model
+    if isinstance(module, OnnxModel):
+        # Newer exporters keep the weights in a separate .data file
+        return sum(os.path.getsize(p) for p in (module.path, module.path + '.data') if os.path.isfile(p))
+    total = 0
+    pending = list(module.state_dict().values())
+    while pending:
+        value = pending.pop()
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            pending.extend(value)
+    return total
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare inference backends against the fp32 eager model.')
+    parser.add_argument('heldout', help='directory of held-out images (searched recursively)')
+    parser.add_argument('--weights', default='tensor.pt')
+    parser.add_argument('--arch', default='resnet50', choices=ARCHS)
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated, from: ' + ', '.join(BACKENDS))
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--budget', type=float, default=0.01, help='max fraction of top-1 labels allowed to differ from eager')
+    parser.add_argument('--calibration', type=int, default=256, help='images used to calibrate static_int8')
+    parser.add_argument('--latency-images', type=int, default=64, help='images timed one at a time for per-image latency')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    from classifier import load_directory
+    images, _, failed = load_directory(args.heldout)
+    if not images:
+        sys.exit(f'No readable images in {args.heldout}')
+    print(f'{len(images)} images ({len(failed)} unreadable)')
+    batches = [torch.stack(images[i:i + args.batch_size]) for i in range(0, len(images), args.batch_size)]
+    torch.set_grad_enabled(False)
+
+    reference = None
+    results = []
+    for backend in [EAGER] + [b for b in args.backends.split(',') if b and b != EAGER]:
+        try:
+            model = build(backend, args.weights, args.arch, calibration=images[:args.calibration])
+            model(batches[0]) # warm-up (tracing, compilation, allocator)
+        except Exception as e:
+            if backend == EAGER:
+                sys.exit(f'Could not load the eager reference model: {e}')
+            print(f'{backend:>17}: unavailable ({e})')
+            continue
+        predictions = []
+        start = time.perf_counter()
+        for batch in batches:
+            predictions.extend(model(batch).argmax(dim=1).tolist())
+        elapsed = time.perf_counter() - start
+        # Latency of a single image, as the bot sees when an image arrives on its own
+        latencies = []
+        for image in images[:args.latency_images]:
+            t = time.perf_counter()
+            model(image.unsqueeze(0))
+            latencies.append((time.perf_counter() - t) * 1000)
+        if reference is None:
+            reference = predictions
+        agreement = sum(p == r for p, r in zip(predictions, reference)) / len(reference)
+        result = {'backend': backend, 'images_per_sec': len(images) / elapsed, 'agreement': agreement,
+                  'p50_image_ms': percentile(latencies, 50), 'p99_image_ms': percentile(latencies, 99),
+                  'model_mb': model_bytes(model) / 2**20}
+        results.append(result)
+        print(f"{backend:>17}: {result['images_per_sec']:8.1f} img/s  p50 {result['p50_image_ms']:7.1f} ms/image  "
+              f"p99 {result['p99_image_ms']:7.1f} ms/image  agreement {agreement:.2%}  "
+              + (f"{result['model_mb']:.1f} MB" if result['model_mb'] else "size n/a"))
+
+    within_budget = [r for r in results if 1 - r['agreement'] <= args.budget]
+    best = max(within_budget, key=lambda r: r['images_per_sec'])
+    print(f"Fastest backend within {args.budget:.1%} of eager: {best['backend']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'images': len(images), 'batch_size': args.batch_size, 'budget': args.budget,
+                       'best': best['backend'], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
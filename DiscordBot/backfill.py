@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import discord
+from metrics import StatsCounters, gauge, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    '''
+    Runs messages posted before the bot was watching (before it joined the
+    guild, while it was down, or before new weights were deployed) through
+    the classification service.
+
+    Each channel is paged through oldest first, page_size messages per history
+    request, up to concurrency channels at a time, stopping at the messages
+    that were new when the scan started (the live path sees everything after
+    that). Messages with attachments are submitted like live ones, but only
+    while the model is ready and fewer than max_queue messages are waiting for
+    a worker, so a live message never queues behind more than a few old ones.
+
+    When every message in a page has been classified, the verdicts are passed
+    to on_result and the ID of the page's last message is saved to
+    checkpoint_path, so a restarted scan carries on from there. If a message
+    couldn't be classified (the service dropped it or classifying it failed),
+    the checkpoint stops just before it and the channel's scan ends there
+    unfinished, so the next scan retries it. Checkpoints record the weights
+    they were made with (version_fn); a channel scanned with different
+    weights is scanned again from the start.
+    '''
+    def __init__(self, service, on_result, version_fn, is_hit, checkpoint_path=None, concurrency=2,
+                 page_size=100, max_queue=4, poll_seconds=0.05, log_seconds=30):
+        self.service = service
+        self.on_result = on_result # Coroutine (message, attachments, verdicts)
+        self.version_fn = version_fn # Returns an id for the current weights
+        self.is_hit = is_hit # Function verdict -> whether the filter flags that image
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.max_queue = max_queue
+        self.poll_seconds = poll_seconds
+        self.log_seconds = log_seconds
+        self.slots = asyncio.Semaphore(concurrency)
+        self.checkpoints = {} # Map from channel ID (as a string) to {'last': message ID, 'weights': version}
+        self.save_lock = asyncio.Lock()
+        self.tasks = {} # Map from channel ID to the task scanning it
+        self.scanning = 0
+        self.started = None
+        self.active_seconds = 0.0 # Time with at least one channel being scanned, for images/sec
+        self.last_log = 0.0
+        self.stats = {'pages': 0, 'messages': 0, 'images': 0, 'hits': 0, 'skipped': 0, 'failed': 0,
+                      'channels_done': 0, 'channels_failed': 0}
+        REGISTRY.register(StatsCounters('modbot_backfill_total', self.stats, 'History backfill progress'))
+        gauge('modbot_backfill_channels_active', 'Channels the backfill is scanning', fn=lambda: self.scanning)
+        gauge('modbot_backfill_images_per_second', 'Images classified per second of backfill', fn=self.rate)
+
+    def load(self):
+        if self.checkpoint_path and os.path.isfile(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.checkpoints = json.load(f)
+            logger.info('Loaded backfill checkpoints for %d channels', len(self.checkpoints))
+
+    async def _save(self):
+        if not self.checkpoint_path:
+            return
+        data = json.dumps(self.checkpoints)
+        async with self.save_lock:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+
+    def _write(self, data):
+        # Write then rename, so a crash mid-write leaves the previous checkpoints intact
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, self.checkpoint_path)
+
+    def start(self, channels):
+        '''Starts scanning each channel that isn't already being scanned.'''
+        for channel in channels:
+            task = self.tasks.get(channel.id)
+            if task is None or task.done():
+                self.tasks[channel.id] = asyncio.create_task(self._scan(channel))
+
+    async def wait(self):
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    async def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await self.wait()
+
+    def rate(self):
+        seconds = self.active_seconds + (time.perf_counter() - self.started if self.scanning else 0.0)
+        return self.stats['images'] / seconds if seconds else 0.0
+
+    def progress(self):
+        stats = self.stats
+        return (f"Backfill: {stats['channels_done']} of {len(self.tasks)} channels done, {stats['messages']} messages "
+                f"and {stats['images']} images scanned ({self.rate():.1f} images/s), {stats['hits']} flagged")
+
+    async def _wait_for_room(self):
+        # Live traffic first: hold back while the model loads or anything but a short queue is waiting
+        service = self.service
+        while not service.ready or service.backlog or service.depth() >= self.max_queue:
+            await asyncio.sleep(self.poll_seconds)
+
+    async def _scan(self, channel):
+        async with self.slots:
+            if not self.scanning:
+                self.started = time.perf_counter()
+            self.scanning += 1
+            try:
+                if await self._scan_pages(channel):
+                    self.stats['channels_done'] += 1
+                    logger.info('Finished backfilling #%s. %s', channel, self.progress())
+                else:
+                    self.stats['channels_failed'] += 1
+                    logger.warning('Stopped backfilling #%s at a message that could not be classified; '
+                                   'the next scan retries it from the checkpoint. %s', channel, self.progress())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.stats['channels_failed'] += 1
+                logger.exception('Backfilling #%s failed; it will resume from its checkpoint', channel)
+            finally:
+                self.scanning -= 1
+                if not self.scanning:
+                    self.active_seconds += time.perf_counter() - self.started
+
+    async def _scan_pages(self, channel):
+        '''Returns True once the channel is scanned up to where the scan started, False if a message must be retried.'''
+        loop = asyncio.get_running_loop()
+        key = str(channel.id)
+        version = self.version_fn()
+        saved = self.checkpoints.get(key)
+        last = saved['last'] if saved is not None and saved.get('weights') == version else None
+        # Stop at the newest message now; anything after it goes through the live path
+        newest = [message async for message in channel.history(limit=1)]
+        if not newest or (last is not None and newest[0].id <= last):
+            return True
+        before = discord.Object(newest[0].id + 1)
+        while True:
+            after = discord.Object(last) if last is not None else None
+            page = [message async for message in channel.history(limit=self.page_size, after=after, before=before,
+                                                                 oldest_first=True)]
+            if not page:
+                return True
+            submitted = []
+            unclassified = len(page) # Index in page of the first message that must be retried
+            for i, message in enumerate(page):
+                self.stats['messages'] += 1
+                if not message.attachments:
+                    continue
+                await self._wait_for_room()
+                done = loop.create_future()
+                if await self.service.submit(message, message.attachments, done=done):
+                    submitted.append((i, message, done))
+                else:
+                    self.stats['skipped'] += 1
+                    unclassified = min(unclassified, i)
+            for i, message, done in submitted:
+                try:
+                    verdicts = await done
+                except Exception:
+                    self.stats['failed'] += 1 # Logged by the service
+                    unclassified = min(unclassified, i)
+                    continue
+                self.stats['images'] += len(verdicts)
+                self.stats['hits'] += sum(1 for v in verdicts if self.is_hit(v))
+                await self.on_result(message, message.attachments, verdicts)
+            if unclassified:
+                last = page[unclassified - 1].id
+                self.checkpoints[key] = {'last': last, 'weights': version}
+                await self._save()
+            self.stats['pages'] += 1
+            if unclassified < len(page):
+                return False
+            now = time.perf_counter()
+            if now - self.last_log >= self.log_seconds:
+                self.last_log = now
+                logger.info(self.progress())
+            if len(page) < self.page_size:
+                return True
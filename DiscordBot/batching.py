@@ -0,0 +1,75 @@
+import asyncio
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Histogram, SIZE_BUCKETS, REGISTRY, gauge
+
+logger = logging.getLogger(__name__)
+
+
+class MicroBatcher:
+    '''
+    Collects preprocessed image tensors for up to max_wait_ms (or until
+    max_batch are waiting) and runs them through infer_fn as one batch.
+    Each caller of submit() gets back the result for its own tensor.
+    '''
+    def __init__(self, infer_fn, max_batch=16, max_wait_ms=15):
+        self.infer_fn = infer_fn # Blocking function [tensor] -> [label]
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.pending = [] # (tensor, future, time queued)
+        self.timer = None
+        # A single inference thread; torch already spreads one batch across cores
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.batch_size = REGISTRY.register(Histogram(SIZE_BUCKETS, 'modbot_batch_size', 'Images per forward pass'))
+        self.queue_wait_ms = REGISTRY.register(Histogram(name='modbot_batch_queue_wait_ms', help='Time an image waited for its batch'))
+        self.inference_ms = REGISTRY.register(Histogram(name='modbot_batch_inference_ms', help='Time to run one batch'))
+        gauge('modbot_batch_pending', 'Images waiting for the next batch', fn=lambda: len(self.pending))
+
+    async def submit(self, tensor):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((tensor, future, time.perf_counter()))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        for _, _, queued in batch:
+            self.queue_wait_ms.observe((start - queued) * 1000)
+        self.batch_size.observe(len(batch))
+        try:
+            results = await loop.run_in_executor(self.executor, self.infer_fn, [t for t, _, _ in batch])
+        except Exception as e:
+            logger.exception('Batched inference failed for %d images', len(batch))
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.inference_ms.observe((time.perf_counter() - start) * 1000)
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'batch_size': self.batch_size.snapshot(),
+            'queue_wait_ms': self.queue_wait_ms.snapshot(),
+            'inference_ms': self.inference_ms.snapshot(),
+        }
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,340 @@
+'''
+Load and latency benchmark for ModBot. Drives the bot's real handlers with fake
+discord objects (fakes.py), serves attachment images from a local HTTP fixture
+server, and reports throughput and p50/p95/p99 latency per handler and per
+classification stage as JSON so runs can be compared across commits.
+
+    python benchmark.py --reporters 1000 --moderators 20 --images 500 --out new.json
+    python benchmark.py --replay traffic.jsonl --fixtures images/ --out new.json
+    python benchmark.py --backfill 2000 --out new.json
+    python benchmark.py --compare old.json new.json
+
+With --backfill, that many older image messages are put in the group
+channel's history first and scanned by the backfill while the traffic runs.
+
+A replay file has one JSON event per line:
+    {"phase": 0, "user": "alice", "where": "dm" | "group" | "mod", "content": "...", "attachments": ["cat.jpg"]}
+Each user's events run in order, users run concurrently, and phases run one
+after another (the classification queue is drained between phases). In mod
+events "{case}" is replaced by the next open case number.
+'''
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+import subprocess
+from collections import defaultdict
+from aiohttp import web
+import classifier
+import metrics
+import bot as bot_module
+from bot import ModBot
+from report import Report
+from review import Review
+from fakes import FakeGuild, FakeUser, FakeAttachment, FakeMessage, attach_fake_gateway
+
+GROUP_NUM = '25'
+
+
+def summarize(samples, wall_seconds):
+    ordered = sorted(samples)
+    def pct(q):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+    return {
+        'count': len(ordered),
+        'per_sec': len(ordered) / wall_seconds if wall_seconds else 0.0,
+        'mean_ms': sum(ordered) / len(ordered),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': ordered[-1],
+    }
+
+
+def timed(samples, name, fn):
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            samples[name].append((time.perf_counter() - start) * 1000)
+    return wrapper
+
+
+def make_fixtures(directory, count):
+    from PIL import Image
+    rng = random.Random(152)
+    for i in range(count):
+        size = (rng.randint(200, 800), rng.randint(200, 800))
+        Image.effect_noise(size, rng.randint(10, 100)).convert('RGB').save(os.path.join(directory, f'img{i}.jpg'))
+
+
+def synthetic_events(args, targets, fixtures):
+    rng = random.Random(args.seed)
+    events = []
+    for i in range(args.images):
+        events.append({'phase': 0, 'user': f'poster{i}', 'where': 'group', 'content': '',
+                       'attachments': [rng.choice(fixtures)]})
+    for i in range(args.reporters):
+        user = f'reporter{i}'
+        target = rng.choice(targets)
+        flow = ['report', target.jump_url]
+        flow += ['4', rng.choice(['y', 'n']), rng.choice(['1', '2', '3'])] if rng.random() < 0.5 else [rng.choice('123567')]
+        events += [{'phase': 0, 'user': user, 'where': rng.choice(['dm', 'group']), 'content': c} for c in flow]
+    for i in range(args.moderators):
+        user = f'moderator{i}'
+        for _ in range(args.reviews_per_moderator):
+            for content in ['review', '{case}', 'n', rng.choice(['y', 'n'])]:
+                events.append({'phase': 1, 'user': user, 'where': 'mod', 'content': content})
+    return events
+
+
+class Harness:
+    def __init__(self, bot, guild, channel, mod_channel, fixture_url):
+        self.bot = bot
+        self.guild = guild
+        self.channel = channel
+        self.mod_channel = mod_channel
+        self.fixture_url = fixture_url
+        self.fixture_dir = None
+        self.users = {}
+        self.claimed_cases = set()
+        self.posted_at = {}
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int) # Exception type -> count; a failing event doesn't stop its user
+
+    def user(self, name):
+        if name not in self.users:
+            self.users[name] = FakeUser(name)
+        return self.users[name]
+
+    def attachment(self, name):
+        path = os.path.join(self.fixture_dir, name)
+        size = os.path.getsize(path) if os.path.isfile(path) else None
+        return FakeAttachment(f'{self.fixture_url}/{name}', size=size)
+
+    def next_case(self):
+        for case in list(self.bot.report_store.open):
+            if case not in self.claimed_cases:
+                self.claimed_cases.add(case)
+                return str(case)
+        return '0'
+
+    async def dispatch(self, event):
+        author = self.user(event['user'])
+        content = event.get('content', '')
+        where = event.get('where', 'dm')
+        if where == 'mod':
+            content = content.replace('{case}', self.next_case()) if '{case}' in content else content
+            message = self.mod_channel.post(content, author)
+        elif where == 'group':
+            message = self.channel.post(content, author, [self.attachment(a) for a in event.get('attachments', [])])
+        else:
+            message = FakeMessage(content, author, author.dm_channel)
+        self.posted_at[message.id] = time.perf_counter()
+        try:
+            await self.bot.on_message(message)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+
+    async def run_user(self, events):
+        for event in events:
+            await self.dispatch(event)
+
+    async def drain(self):
+        await self.bot.classifier.queue.join()
+        while self.bot.batcher.pending:
+            await asyncio.sleep(self.bot.batcher.max_wait)
+        await self.bot.outbound.flush()
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='modbot-bench-')
+    fixture_dir = args.fixtures
+    if fixture_dir is None:
+        fixture_dir = os.path.join(workdir, 'fixtures')
+        os.makedirs(fixture_dir)
+        make_fixtures(fixture_dir, args.fixture_count)
+    fixtures = sorted(os.listdir(fixture_dir))
+
+    # Local fixture server standing in for the Discord CDN
+    app = web.Application()
+    app.router.add_static('/attachments', fixture_dir)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    classifier.resident_model.weights_path = args.weights
+    bot_module.METRICS_PORT = None
+    bot_module.OUTBOUND_SENDER = 'client' # The fake channels record what is sent to them
+    bot = ModBot()
+    bot.verdict_cache.path = None
+    bot.hash_list.path = os.path.join(workdir, 'known_hashes.txt')
+    bot.report_store.path = os.path.join(workdir, 'reports.db')
+    bot.backfill.checkpoint_path = os.path.join(workdir, 'backfill_checkpoints.json')
+    guild = FakeGuild('CS 152')
+    channel = guild.add_channel(f'group-{GROUP_NUM}')
+    mod_channel = guild.add_channel(f'group-{GROUP_NUM}-mod')
+    attach_fake_gateway(bot, [guild], FakeUser(f'Group {GROUP_NUM} Bot', bot=True))
+    await bot.setup_hook()
+    # Load the model before timing anything, as the bot would be by the time traffic arrives
+    await bot.warm_up()
+
+    harness = Harness(bot, guild, channel, mod_channel, f'http://127.0.0.1:{port}/attachments')
+    harness.fixture_dir = fixture_dir
+    samples = harness.samples
+
+    # Time every handler the traffic goes through
+    bot.handle_dm = timed(samples, 'handle_dm', bot.handle_dm)
+    bot.handle_channel_message = timed(samples, 'handle_channel_message', bot.handle_channel_message)
+    original_report, original_review = Report.handle_message, Review.handle_message
+    Report.handle_message = timed(samples, 'Report.handle_message', Report.handle_message)
+    Review.handle_message = timed(samples, 'Review.handle_message', Review.handle_message)
+    on_result = bot.classifier.on_result
+    async def record_classification(message, attachments, verdicts):
+        samples['classification_end_to_end'].append((time.perf_counter() - harness.posted_at[message.id]) * 1000)
+        await on_result(message, attachments, verdicts)
+    bot.classifier.on_result = record_classification
+    dispatch = harness.dispatch
+    harness.dispatch = timed(samples, 'on_message', dispatch)
+
+    if args.replay:
+        with open(args.replay) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        # Messages for the reporters to report
+        targets = [channel.post('target', FakeUser(f'target{i}'), [harness.attachment(random.choice(fixtures))])
+                   for i in range(max(1, args.reporters // 4))]
+        events = synthetic_events(args, targets, fixtures)
+
+    # History for the backfill to scan, posted before the traffic and never dispatched to the bot
+    rng = random.Random(args.seed)
+    for i in range(args.backfill):
+        channel.post('', FakeUser(f'old_poster{i % 50}'), [harness.attachment(rng.choice(fixtures))])
+    if args.backfill:
+        bot.start_backfill([guild])
+
+    phases = defaultdict(lambda: defaultdict(list))
+    for event in events:
+        phases[event.get('phase', 0)][event['user']].append(event)
+
+    start = time.perf_counter()
+    try:
+        for phase in sorted(phases):
+            await asyncio.gather(*(harness.run_user(user_events) for user_events in phases[phase].values()))
+            await harness.drain()
+        wall = time.perf_counter() - start
+        await bot.backfill.wait()
+        backfill_wall = time.perf_counter() - start
+    finally:
+        Report.handle_message, Review.handle_message = original_report, original_review
+        await bot.classifier.close()
+        await bot.fetcher.close()
+        await bot.outbound.close()
+        bot.session_sweeper.cancel()
+        bot.report_store.close()
+        await bot.backfill.close()
+        await runner.cleanup()
+
+    results = {
+        'commit': git_commit(),
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('compare', 'out')},
+        'events': len(events),
+        'wall_seconds': wall,
+        'handlers': {name: summarize(values, wall) for name, values in sorted(samples.items()) if values},
+        'stages': {
+            'fetch': bot.fetcher.snapshot(),
+            'batching': bot.batcher.stats(),
+            'verdict_cache': bot.verdict_cache.snapshot(),
+            'classification_service': dict(bot.classifier.stats),
+            'outbound': dict(bot.outbound.stats, delay_ms=bot.outbound.delay_ms.snapshot()),
+            'model': classifier.resident_model.stats(),
+            'backfill': dict(bot.backfill.stats, images_per_sec=bot.backfill.rate(), wall_seconds=backfill_wall),
+            'spans': {name: value for name, value in metrics.REGISTRY.snapshot().items() if name.startswith('modbot_stage_ms')},
+        },
+        'cases_filed': bot.report_store.last_number,
+        'mod_channel_messages': len(mod_channel.sent),
+        'errors': dict(harness.errors),
+    }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def compare(old_path, new_path, tolerance):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'handler':<28}{'p50 ms':>18}{'p99 ms':>18}{'per sec':>18}")
+    regressions = []
+    for name in sorted(set(old['handlers']) | set(new['handlers'])):
+        a, b = old['handlers'].get(name), new['handlers'].get(name)
+        if a is None or b is None:
+            print(f'{name:<28} only in {"new" if a is None else "old"} run')
+            continue
+        cells = []
+        for key in ('p50_ms', 'p99_ms', 'per_sec'):
+            change = (b[key] - a[key]) / a[key] if a[key] else 0.0
+            cells.append(f'{b[key]:9.2f} ({change:+.0%})')
+            worse = change < -tolerance if key == 'per_sec' else change > tolerance
+            if worse:
+                regressions.append(f'{name} {key}')
+        print(f'{name:<28}' + ''.join(f'{c:>18}' for c in cells))
+    if regressions:
+        print('Regressions beyond {:.0%}: {}'.format(tolerance, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay traffic through ModBot and measure per-handler latency.')
+    parser.add_argument('--weights', default=classifier.WEIGHTS_PATH)
+    parser.add_argument('--replay', help='JSON lines file of recorded events (see module docstring)')
+    parser.add_argument('--fixtures', help='directory of images served as attachments (synthetic images if omitted)')
+    parser.add_argument('--fixture-count', type=int, default=50)
+    parser.add_argument('--reporters', type=int, default=200)
+    parser.add_argument('--moderators', type=int, default=10)
+    parser.add_argument('--reviews-per-moderator', type=int, default=5)
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--backfill', type=int, default=0, help='older image messages for the backfill to scan')
+    parser.add_argument('--seed', type=int, default=152)
+    parser.add_argument('--out', help='write the results JSON here')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two results files and exit')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(compare(args.compare[0], args.compare[1], args.tolerance))
+
+    results = asyncio.run(run(args))
+    for name, stats in results['handlers'].items():
+        print(f"{name:<28}{stats['count']:>7} calls  {stats['per_sec']:9.1f}/s  p50 {stats['p50_ms']:8.2f} ms  "
+              f"p95 {stats['p95_ms']:8.2f} ms  p99 {stats['p99_ms']:8.2f} ms")
+    print(f"{results['events']} events in {results['wall_seconds']:.2f}s, {results['cases_filed']} cases filed")
+    if args.backfill:
+        backfill = results['stages']['backfill']
+        print(f"Backfill: {backfill['messages']} messages, {backfill['images']} images at {backfill['images_per_sec']:.1f}/s, "
+              f"{backfill['hits']} flagged, done {backfill['wall_seconds']:.2f}s after the traffic started")
+    if results['errors']:
+        print(f"Handler errors: {results['errors']}")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
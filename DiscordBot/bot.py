@@ -1,4 +1,8 @@
 # bot.py
+import time
+STARTED_AT = time.perf_counter() # For the time-to-ready metric
+import sys
+import asyncio
 import discord
 from discord.ext import commands
 import os
@@ -6,10 +10,52 @@ import json
 import logging
 import re
 import requests
-from report import Report
+import functools
+from report import Report, AUTOMATIC_SEVERITY, REASONS
 from review import Review
+from report_store import ReportStore, REMOVED, FURTHER_REVIEW
+from review_queue import ReviewScheduler
+from case_listing import CaseListing, parse_list_command, render_header
+from message_cache import MessageCache
+from sessions import SessionStore, sweep
+from dispatcher import OutboundDispatcher, HttpSender, ClientSender, DISCORD_API_URL
 import pdb
-from classifier import *
+from verdict_cache import VerdictCache
+from hash_list import HashList
+from fetcher import ImageFetcher
+from classification_service import ClassificationService, DEFER
+from batching import MicroBatcher
+from text_filter import TextFilter
+from backfill import Backfill
+import metrics
+from metrics import span, timed
+
+# classifier.py pulls in torch, torchvision and PIL, which take seconds to import. It is
+# imported by warm_up() in a background thread once the bot has connected instead.
+def loaded_classifier():
+    '''The classifier module if it has been imported yet, otherwise None.'''
+    return sys.modules.get('classifier')
+
+def decode_and_hash(data):
+    import classifier
+    return classifier.decode_and_hash(data)
+
+def classify_batch(images):
+    import classifier
+    return classifier.classify_batch(images)
+
+def hash_image_bytes(data):
+    # image_hash loads PIL on first use, so this too runs in a worker thread
+    import image_hash
+    return image_hash.hash_image_bytes(data)
+
+def weights_version():
+    classifier = loaded_classifier()
+    return classifier.resident_model.weights_sha256 if classifier else None
+
+def is_flagged(verdict):
+    '''Whether the automatic filter opens a case for an image: it is on the known hash list or looks like a kitten.'''
+    return verdict is not None and bool(verdict.known_match or verdict.label == "kitten")
 
 # Set up logging to the console
 logger = logging.getLogger('discord')
@@ -18,14 +64,60 @@ handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w'
 handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 logger.addHandler(handler)
 
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
+# Automatic filter settings
+INFERENCE_BACKEND = 'eager' # eager, channels_last, dynamic_int8_head, static_int8, torchscript, compile or onnx (see backends.py)
+MODEL_RETRY_SECONDS = 60 # After a failed load, try the weights again this often; images wait in the backlog meanwhile
+CASCADE_BAND = None # e.g. (0.05, 0.9): only escalate to ResNet-50 when the prefilter's kitten probability is in this band
+CLASSIFY_CONCURRENCY = 8 # Messages whose images are downloaded and preprocessed at the same time
+CLASSIFY_QUEUE_SIZE = 64 # Images (attachments across all queued messages) waiting for a classification worker
+CLASSIFY_OVERLOAD_POLICY = DEFER # One of drop, defer, mod_channel (see classification_service.py)
+BATCH_MAX_IMAGES = 16 # Run the model as soon as this many images are waiting
+BATCH_MAX_WAIT_MS = 15 # ...or once the oldest waiting image has waited this long
+IMAGE_MAX_BYTES = 10 * 2**20 # Attachments larger than this are not downloaded
+IMAGE_FETCH_TIMEOUT = 10 # Seconds
+IMAGE_FIXTURE_DIR = None # Read images from this directory instead of the CDN (for testing)
+VERDICT_CACHE_PATH = 'verdict_cache.json' # Set to None to keep cached verdicts in memory only
+VERDICT_CACHE_BYTES = 32 * 2**20
+VERDICT_CACHE_TTL = 7 * 24 * 3600 # Seconds
+VERDICT_CACHE_DISTANCE = 4 # Max differing perceptual hash bits for a near-duplicate
+KNOWN_HASHES_PATH = 'known_hashes.txt' # One hex perceptual hash per line, or a .npy of uint64; reviewer-confirmed hashes are appended (see hash_list.py)
+KNOWN_HASH_DISTANCE = 4 # Max differing bits for an image to count as on the list
+
+# Automatic text filter (see text_filter.py)
+TEXT_TERMS_PATH = 'text_terms.txt' # category<TAB>term[<TAB>weight] per line; categories are report reasons
+TEXT_MODEL_PATH = 'text_model.npz' # Written by `python text_filter.py train`; without it only the term list is used
+TEXT_FLAG_THRESHOLD = 0.8 # A message is flagged once a category scores this high
+TEXT_SEVERITY = dict(REASONS.values()) # Map from report reason to the severity of a case the text filter files for it
+
+# Scanning messages posted before the bot was watching (see backfill.py)
+BACKFILL_CHANNELS = None # Names of the channels to scan in every guild; None for the group channel, () to turn it off
+BACKFILL_CHECKPOINT_PATH = 'backfill_checkpoints.json' # Last message scanned in each channel, to resume after a restart
+BACKFILL_CONCURRENCY = 2 # Channels scanned at once
+BACKFILL_PAGE_SIZE = 100 # Messages per history request (Discord's maximum)
+BACKFILL_MAX_QUEUE = 4 # Old messages are only submitted while fewer than this many wait for a classification worker
+BACKFILL_KEYWORD = 'backfill' # Mod channel command that shows the scan's progress
+
+# Case storage
+REPORT_DB_PATH = 'reports.db' # SQLite database of every case filed and every strike given
+REVIEW_LEASE_SECONDS = 15 * 60 # A claimed case goes back in the review queue after this long without a reply
+
+# Outgoing messages (see dispatcher.py)
+OUTBOUND_SENDER = 'http' # 'http' posts to the REST API and tracks rate limit buckets itself; 'client' goes through discord.py
+OUTBOUND_API_URL = DISCORD_API_URL # Point at a local fakes.FakeDiscordAPI to test
+OUTBOUND_CONCURRENCY = 8 # Requests in flight at once, across all destinations
+MESSAGE_CACHE_SIZE = 100000 # Reported messages whose author and channel are remembered for enforcement
+
+# In-progress report and review flows
+REPORT_SESSION_TTL = 30 * 60 # Seconds a report can sit idle before it is dropped
+MAX_REPORT_SESSIONS = 50000 # Beyond this the least recently active report is dropped
+REVIEW_SESSION_TTL = REVIEW_LEASE_SECONDS
+MAX_REVIEW_SESSIONS = 1000
+SESSION_SWEEP_SECONDS = 60
+
+# Metrics (see metrics.py)
+METRICS_PORT = 9152 # Prometheus text endpoint at http://127.0.0.1:9152/metrics; None to disable
+METRICS_SNAPSHOT_PATH = None # Also rewrite this file with the metrics every METRICS_SNAPSHOT_SECONDS
+METRICS_SNAPSHOT_SECONDS = 30
 
 
 class ModBot(discord.Client):
@@ -34,14 +126,85 @@ class ModBot(discord.Client):
         intents.message_content = True
         super().__init__(command_prefix='.', intents=intents)
         self.group_num = None
-        self.mod_channels = {} # Map from guild to the mod channel id for that guild
-        self.reports = {} # Map from user IDs to the state of their report
-        self.reports_list = {} # Map from Report Number to (userID, timeStamp, reportedMessadeLink, containsChild)
-        self.report_num = 0 # Counter for report number
-        self.reviews = {} # Map from mod IDs to the state of their reviews
-        self.users_with_strike = set() # Contains user IDs who have already received warnings
+        self.mod_channels = {} # Map from guild ID to the mod channel for that guild, kept current by channel events
+        self.reports = SessionStore('report', REPORT_SESSION_TTL, MAX_REPORT_SESSIONS) # Map from user IDs to the state of their report
+        self.report_store = ReportStore(REPORT_DB_PATH) # Every case filed, and the users who have a strike
+        self.reviews = SessionStore('review', REVIEW_SESSION_TTL, MAX_REVIEW_SESSIONS, on_end=self.review_abandoned) # Map from mod IDs to the state of their reviews
+        self.session_sweeper = None
+        self.review_queue = ReviewScheduler(lease_seconds=REVIEW_LEASE_SECONDS) # Open cases in the order they should be reviewed
+        self.case_listing = CaseListing() # Rendered rows for the `list` command
+        self.message_cache = MessageCache(MESSAGE_CACHE_SIZE) # Map from reported message ID to its guild, channel and author
+        self.outbound = OutboundDispatcher(max_concurrency=OUTBOUND_CONCURRENCY) # Sender is picked in setup_hook, once we have the token
         self.mod_channel = None # Set to group 25 Mod Channel
- 
+        self.warmup_task = None
+        self.fetcher = ImageFetcher(max_bytes=IMAGE_MAX_BYTES, timeout=IMAGE_FETCH_TIMEOUT, fixture_dir=IMAGE_FIXTURE_DIR)
+        self.batcher = MicroBatcher(classify_batch, max_batch=BATCH_MAX_IMAGES, max_wait_ms=BATCH_MAX_WAIT_MS)
+        self.verdict_cache = VerdictCache(weights_version, max_bytes=VERDICT_CACHE_BYTES,
+                                          ttl=VERDICT_CACHE_TTL, max_distance=VERDICT_CACHE_DISTANCE, path=VERDICT_CACHE_PATH)
+        self.hash_list = HashList(KNOWN_HASHES_PATH, max_distance=KNOWN_HASH_DISTANCE)
+        self.text_filter = TextFilter(TEXT_TERMS_PATH, TEXT_MODEL_PATH, threshold=TEXT_FLAG_THRESHOLD,
+                                      on_flagged=self.handle_text_verdict)
+        self.classifier = ClassificationService(self.fetcher, decode_and_hash, self.batcher, self.handle_classification,
+                                                on_overload=self.handle_classifier_overload,
+                                                cache=self.verdict_cache, hash_list=self.hash_list,
+                                                max_queue=CLASSIFY_QUEUE_SIZE, concurrency=CLASSIFY_CONCURRENCY,
+                                                overload_policy=CLASSIFY_OVERLOAD_POLICY, ready=False)
+        self.backfill = Backfill(self.classifier, self.handle_backfill_classification, weights_version, is_flagged,
+                                 checkpoint_path=BACKFILL_CHECKPOINT_PATH, concurrency=BACKFILL_CONCURRENCY,
+                                 page_size=BACKFILL_PAGE_SIZE, max_queue=BACKFILL_MAX_QUEUE)
+        self.metrics_runner = None
+        self.metrics_task = None
+        self.cases_filed = {source: metrics.counter('modbot_cases_filed_total', 'Cases sent to the mod channel', source=source)
+                            for source in ('user', 'automatic')}
+        metrics.gauge('modbot_open_cases', 'Cases waiting for review', fn=self.report_store.__len__)
+        metrics.gauge('modbot_active_reports', 'Report flows in progress', fn=lambda: len(self.reports))
+        metrics.gauge('modbot_active_reviews', 'Review flows in progress', fn=lambda: len(self.reviews))
+        metrics.gauge('modbot_model_load_seconds', 'Time the last weights load took',
+                      fn=lambda: (loaded_classifier().resident_model.load_seconds or 0) if loaded_classifier() else 0)
+        metrics.gauge('modbot_model_bytes', 'Memory held by the model weights',
+                      fn=lambda: loaded_classifier().resident_model.memory_bytes() if loaded_classifier() else 0)
+        self.time_to_connect = metrics.gauge('modbot_time_to_connect_seconds', 'Time from process start to the first on_ready')
+        self.time_to_ready = metrics.gauge('modbot_time_to_ready_seconds', 'Time from process start to the model being loaded and warmed up')
+        metrics.gauge('modbot_ready', '1 once the automatic filter can classify images', fn=lambda: int(self.classifier.ready))
+
+    async def setup_hook(self):
+        # Start the classification workers once the event loop is running
+        if OUTBOUND_SENDER == 'http':
+            self.outbound.sender = HttpSender(self.http.token, OUTBOUND_API_URL)
+        else:
+            self.outbound.sender = ClientSender(self)
+        self.verdict_cache.load()
+        self.backfill.load()
+        await asyncio.get_running_loop().run_in_executor(None, self.report_store.load)
+        for case in self.report_store.open_cases():
+            self.review_queue.enqueue(case)
+            self.case_listing.add(case)
+        await asyncio.get_running_loop().run_in_executor(None, self.hash_list.load)
+        await asyncio.get_running_loop().run_in_executor(None, self.text_filter.load)
+        await self.fetcher.start()
+        self.classifier.start()
+        self.session_sweeper = asyncio.create_task(sweep([self.reports, self.reviews, self.review_queue], SESSION_SWEEP_SECONDS))
+        if METRICS_PORT is not None:
+            self.metrics_runner = await metrics.serve(METRICS_PORT)
+        if METRICS_SNAPSHOT_PATH is not None:
+            self.metrics_task = asyncio.create_task(metrics.write_snapshots(METRICS_SNAPSHOT_PATH, METRICS_SNAPSHOT_SECONDS))
+
+    async def close(self):
+        if self.warmup_task is not None:
+            self.warmup_task.cancel()
+        await self.backfill.close()
+        await self.classifier.close()
+        await self.outbound.close()
+        if self.session_sweeper is not None:
+            self.session_sweeper.cancel()
+        await self.fetcher.close()
+        self.verdict_cache.save()
+        await asyncio.get_running_loop().run_in_executor(None, self.report_store.close)
+        if self.metrics_task is not None:
+            self.metrics_task.cancel()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -58,12 +221,75 @@ class ModBot(discord.Client):
 
         # Find the mod channel in each guild that this bot should report to
         for guild in self.guilds:
-            for channel in guild.text_channels:
-                if channel.name == f'group-{self.group_num}-mod':
-                    self.mod_channels[guild.id] = channel
-                    self.mod_channel = channel
-        
-        
+            self.index_mod_channel(guild)
+
+        # Load the model now that we're connected; images that arrive meanwhile wait in the classifier's backlog
+        if self.warmup_task is None:
+            self.time_to_connect.set(time.perf_counter() - STARTED_AT)
+            self.warmup_task = asyncio.create_task(self.warm_up())
+
+    def index_mod_channel(self, guild):
+        channel = discord.utils.get(guild.text_channels, name=f'group-{self.group_num}-mod')
+        if channel is not None:
+            self.mod_channels[guild.id] = channel
+            self.mod_channel = channel
+        else:
+            self.mod_channels.pop(guild.id, None)
+
+    def is_mod_channel(self, channel):
+        return self.group_num is not None and channel.name == f'group-{self.group_num}-mod'
+
+    async def on_guild_join(self, guild):
+        self.index_mod_channel(guild)
+        if self.classifier.ready:
+            self.start_backfill([guild]) # Otherwise warm_up starts it for every guild once the model is loaded
+
+    def start_backfill(self, guilds):
+        names = (f'group-{self.group_num}',) if BACKFILL_CHANNELS is None else BACKFILL_CHANNELS
+        # Only guilds with a mod channel, which is where any cases it opens are sent
+        self.backfill.start([channel for guild in guilds if guild.id in self.mod_channels
+                             for channel in guild.text_channels if channel.name in names])
+
+    async def on_guild_remove(self, guild):
+        self.mod_channels.pop(guild.id, None)
+
+    async def on_guild_channel_create(self, channel):
+        if self.is_mod_channel(channel):
+            self.mod_channels[channel.guild.id] = channel
+            self.mod_channel = channel
+
+    async def on_guild_channel_delete(self, channel):
+        current = self.mod_channels.get(channel.guild.id)
+        if current is not None and current.id == channel.id:
+            self.index_mod_channel(channel.guild) # Fall back to another channel with the name, if any
+
+    async def on_guild_channel_update(self, before, after):
+        if self.is_mod_channel(before) != self.is_mod_channel(after):
+            self.index_mod_channel(after.guild)
+
+    def load_model(self):
+        # Runs in a worker thread: the slow imports, then loading the weights and a warm-up forward pass
+        import classifier
+        classifier.resident_model.backend = INFERENCE_BACKEND
+        if CASCADE_BAND is not None:
+            # The prefilter sees every image, so it is loaded and warmed up before the filter counts as ready too
+            classifier.enable_cascade(*CASCADE_BAND).small.get()
+        classifier.resident_model.get()
+
+    async def warm_up(self):
+        # Until a load succeeds the classifier stays not ready: images wait in its backlog, and once that
+        # is full they get the overload policy. Nothing is classified, or backfilled, without a model.
+        while True:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.load_model)
+                break
+            except Exception:
+                logger.exception('Could not load the classifier, retrying in %ds', MODEL_RETRY_SECONDS)
+                await asyncio.sleep(MODEL_RETRY_SECONDS)
+        self.time_to_ready.set(time.perf_counter() - STARTED_AT)
+        logger.info('Automatic filter ready %.1fs after start', self.time_to_ready.get())
+        self.classifier.set_ready()
+        self.start_backfill(self.guilds)
 
     async def on_message(self, message):
         '''
@@ -81,12 +307,13 @@ class ModBot(discord.Client):
             await self.handle_dm(message)
 
 
+    @timed('handle_dm')
     async def handle_dm(self, message):
         # Handle a help message
         if message.content == Report.HELP_KEYWORD:
             reply =  "Use the `report` command to begin the reporting process.\n"
             reply += "Use the `cancel` command to cancel the report process.\n"
-            await message.channel.send(reply)
+            self.outbound.send(message.channel, reply)
             return
 
         author_id = message.author.id
@@ -103,48 +330,42 @@ class ModBot(discord.Client):
         # Let the report class handle this message; forward all the messages it returns to uss
         responses = await self.reports[author_id].handle_message(message)
         for r in responses:
-            await message.channel.send(r)
+            self.outbound.send(message.channel, r)
 
         # If the report is complete or cancelled
         if self.reports[author_id].report_canceled() or self.reports[author_id].report_complete():
-            # If report completed, update reports_list map and send report to mod channel
+            # If report completed, file a case and send report to mod channel
             if self.reports[author_id].report_complete():
-                self.report_num += 1
-                time_stamp = str(self.reports[author_id].get_time())
-                reported_link = str(self.reports[author_id].get_link())
-                containsChild = self.reports[author_id].image_contains_child()
-                self.reports_list[self.report_num] = (author_id, time_stamp, reported_link, containsChild)
+                case = self.file_user_report(self.reports[author_id], message.author)
+                self.hash_reported_image(case.number, self.reports[author_id].get_message_id(), self.reports[author_id].get_image_urls())
                 reply = 'New report has been filed:\n'
-                reply += 'Case #' + str(self.report_num) + '\nReported by UserID: ' + str(message.author) + '\nTime Filed: ' + time_stamp + '\nReported Image Link: ' + reported_link + '\n'
-                if containsChild:
+                reply += render_header(case)
+                reply += 'Reason: ' + str(case.reason) + '\n'
+                if case.contains_child:
                     reply += 'Image believed to contain a child.\n'
                 else:
                     reply += 'Image is not believed to contain a child.\n'
-                await self.mod_channel.send(reply)
+                self.cases_filed['user'].inc()
+                self.outbound.send(self.mod_channel, reply, coalesce=True)
             self.reports.pop(author_id)
             return
 
+    @timed('handle_channel_message')
     async def handle_channel_message(self, message):
-        mod_channel = self.mod_channels[message.guild.id]
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            return # No mod channel for this guild (yet) to send cases to
         author_id = message.author.id
         # handle messages sent in the "group-#" channel
 
-        # automatic CSAM filtering
+        # automatic text filtering, scored in a batch with whatever else arrives in the same loop iteration
+        if message.content and message.channel.name == f'group-{self.group_num}':
+            self.eval_text(message)
+
+        # automatic CSAM filtering, done off the event loop by the classification service
         has_attachment = bool(message.attachments)
         if has_attachment:
-            image_url = message.attachments[0].url
-            label = classify(image_url)
-            if label == "kitten":
-                    author_id = "Automatic Filter"
-                    self.report_num += 1
-                    time_stamp = str(message.created_at)
-                    reported_link = str(message.jump_url)
-                    containsChild = True
-                    self.reports_list[self.report_num] = (author_id, time_stamp, reported_link, containsChild)
-                    reply = 'New report has been filed:\n'
-                    reply += 'Case #' + str(self.report_num) + '\nReported by UserID: ' + str(author_id) + '\nTime Filed: ' + time_stamp + '\nReported Image Link: ' + reported_link + '\n'
-                    reply += 'Image believed to contain a child.\n'
-                    await mod_channel.send(reply)
+            await self.classifier.submit(message, message.attachments)
             return
 
         
@@ -152,7 +373,7 @@ class ModBot(discord.Client):
             if message.content == Report.HELP_KEYWORD:
                 reply =  "Use the `report` command to begin the reporting process.\n"
                 reply += "Use the `cancel` command to cancel the report process.\n"
-                await message.channel.send(reply)
+                self.outbound.send(message.channel, reply)
                 return
             
             responses = []
@@ -168,23 +389,22 @@ class ModBot(discord.Client):
             # Let the report class handle the rest of the flow
             responses = await self.reports[author_id].handle_message(message)
             for r in responses:
-                await message.channel.send(r)
+                self.outbound.send(message.channel, r)
 
-            # If report completed, update reports_list map and send report to mod channel
+            # If report completed, file a case and send report to mod channel
             if self.reports[author_id].report_canceled() or self.reports[author_id].report_complete():
                 if self.reports[author_id].report_complete():
-                    self.report_num += 1
-                    time_stamp = str(self.reports[author_id].get_time())
-                    reported_link = str(self.reports[author_id].get_link())
-                    containsChild = self.reports[author_id].image_contains_child()
-                    self.reports_list[self.report_num] = (author_id, time_stamp, reported_link, containsChild)
+                    case = self.file_user_report(self.reports[author_id], message.author)
+                    self.hash_reported_image(case.number, self.reports[author_id].get_message_id(), self.reports[author_id].get_image_urls())
                     reply = '\nNew report has been filed:\n'
-                    reply += 'Case #' + str(self.report_num) + '\nReported by UserID: ' + str(message.author) + '\nTime Filed: ' + time_stamp + '\nReported Image Link: ' + reported_link + '\n'
-                    if containsChild:
+                    reply += render_header(case)
+                    reply += 'Reason: ' + str(case.reason) + '\n'
+                    if case.contains_child:
                         reply += 'Image believed to contain a child.\n'
                     else:
                         reply += 'Image is not believed to contain a child.\n'
-                    await mod_channel.send(reply)
+                    self.cases_filed['user'].inc()
+                    self.outbound.send(mod_channel, reply, coalesce=True)
                 self.reports.pop(author_id)
                 return
         
@@ -192,22 +412,23 @@ class ModBot(discord.Client):
         elif message.channel.name == f'group-{self.group_num}-mod':
             if message.content == Review.HELP_KEYWORD:
                 reply =  "Use the `review` command to begin the reviewing process.\n"
+                reply += "Use the `review next` command to review the most urgent unreviewed report.\n"
                 reply += "Use the `cancel` command to cancel the reviewing process.\n"
-                reply += "Use the `list` command to view all unreviewed reports.\n"
-                await message.channel.send(reply)
+                reply += "Use the `list` command to view all unreviewed reports, `list <page>` for later pages, and `list child` or `list auto` to see only child-flagged or automatically filed reports.\n"
+                reply += "Use the `backfill` command to see how far the scan of older messages has got.\n"
+                self.outbound.send(message.channel, reply)
                 return
         
-            # list all unreviewed reports
-            if message.content == Review.LIST_KEYWORD:
-                reply = "Unreviewed reports:\n\n"
-                for key in self.reports_list.keys():
-                    userID, time_stamp, reported_link, containsChild = self.reports_list[key] 
-                    reply += 'Case #' + str(key) + '\nReported by UserID: ' + str(userID) + '\nTime Filed: ' + time_stamp + '\nReported Image Link: ' + reported_link + '\n'
-                    if containsChild:
-                        reply += 'Image believed to contain a child.\n\n'
-                    else:
-                        reply += 'Image is not believed to contain a child.\n\n'
-                await message.channel.send(reply)
+            if message.content == BACKFILL_KEYWORD:
+                self.outbound.send(message.channel, self.backfill.progress())
+                return
+
+            # list unreviewed reports, one message-sized page at a time
+            list_command = parse_list_command(message.content, Review.LIST_KEYWORD)
+            if list_command is not None:
+                name, page = list_command
+                self.review_queue.expire() # So the queue and lease metrics are current even when nobody is claiming
+                self.outbound.send(message.channel, self.case_listing.page(page, name))
                 return
             
             # Only respond to messages if they're part of a review flow
@@ -216,61 +437,254 @@ class ModBot(discord.Client):
            
            # If we don't currently have an active review for this mod, add one
             if author_id not in self.reviews:
-                self.reviews[author_id] = Review(self, self.reports_list)
+                self.reviews[author_id] = Review(self, self.report_store)
             
             # Let the review class handle the rest of the flow
             responses = await self.reviews[author_id].handle_message(message)
             for r in responses:
-                await mod_channel.send(r)
+                self.outbound.send(mod_channel, r)
 
             # if we are at the end of the review flow
             if self.reviews[author_id].case_closed():
                 # Implement consequences on abuser has indeed violated guidelines
                 if self.reviews[author_id].is_violation():
-                    # find the ID of the abuser
-                    link = self.reviews[author_id].get_link()
-                    m = re.search('/(\d+)/(\d+)/(\d+)', link)
-                    channel = message.guild.get_channel(int(m.group(2)))
-                    m = await channel.fetch_message(int(m.group(3)))
-                    abuserID = m.author
-                    
-                    # delete the reported message
-                    await m.delete()
-                    
-                    # check past violation history
-                    if abuserID in self.users_with_strike:
-                        await abuserID.send("Your account has been banned due to activity that violated our guidelines. If you would like to appeal this decision, email hr@group25.com.")
-                        reply = "The reported user (" + str(abuserID) + ") has violated community guidelines in the past. System has removed the account from the platform according to our strike policy."
-                        await mod_channel.send(reply)
-                    else:
-                        self.users_with_strike.add(abuserID)
-                        await abuserID.send("You have received a warning for a post that violated our community guidelines. If you violate the guidelines again, your account will be permanently banned.")
-                        reply = "The reported user (" + str(abuserID) + ") has not violated community guidelines in the past. System has added a strike to the user's account."
-                        await mod_channel.send(reply)
+                    await self.enforce_violation(self.reviews[author_id].get_link(), self.reviews[author_id].get_report_num(), mod_channel)
                 if not self.reviews[author_id].is_canceled_review():
-                    self.reports_list.pop(self.reviews[author_id].get_report_num())
+                    outcome = REMOVED if self.reviews[author_id].is_violation() else FURTHER_REVIEW
+                    self.report_store.close_case(self.reviews[author_id].get_report_num(), outcome, reviewer_id=author_id)
+                    self.review_queue.complete(self.reviews[author_id].get_report_num())
+                    self.case_listing.remove(self.reviews[author_id].get_report_num())
+                else:
+                    self.review_queue.release(self.reviews[author_id].get_report_num(), author_id)
                 self.reviews.pop(author_id)
         else:
             return
         
     
+    async def enforce_violation(self, link, report_num, mod_channel):
+        # Remove the reported message and strike (or ban) its author
+        m = re.search(r'/(\d+)/(\d+)/(\d+)', link)
+        message_id = int(m.group(3))
+        info = await self.reported_message_info(int(m.group(1)), int(m.group(2)), message_id, report_num)
+        if info is None:
+            self.outbound.send(mod_channel, "The reported message no longer exists and its author is unknown, so no strike was applied.")
+            return
+        abuserID = info.author_id
+        abuser_name = str(self.get_user(abuserID) or abuserID)
+
+        # delete the reported message by ID, without fetching it first
+        if await self.delete_reported_message(info, message_id):
+            self.outbound.send(mod_channel, "The reported message has been removed.")
+        else:
+            self.outbound.send(mod_channel, "The reported message could not be removed automatically. Please delete it manually: " + link)
+
+        # check past violation history
+        if self.report_store.has_strike(abuserID):
+            self.outbound.send_dm(self.dm_target(abuserID), "Your account has been banned due to activity that violated our guidelines. If you would like to appeal this decision, email hr@group25.com.")
+            reply = "The reported user (" + abuser_name + ") has violated community guidelines in the past. System has removed the account from the platform according to our strike policy."
+            self.outbound.send(mod_channel, reply)
+        else:
+            self.report_store.add_strike(abuserID, report_num)
+            self.outbound.send_dm(self.dm_target(abuserID), "You have received a warning for a post that violated our community guidelines. If you violate the guidelines again, your account will be permanently banned.")
+            reply = "The reported user (" + abuser_name + ") has not violated community guidelines in the past. System has added a strike to the user's account."
+            self.outbound.send(mod_channel, reply)
+
+    async def resolve_known_match(self, case, match, mod_channel):
+        # The image is on the known hash list, so there is nothing for a moderator to decide: act on it now
+        self.outbound.send(mod_channel, "Case #" + str(case.number) + " matches the known CSAM hash list (" + str(match[1]) + " bits apart) and was resolved automatically. The image will be removed from the platform and sent to NCMEC in accordance to our guidelines.")
+        await self.enforce_violation(case.link, case.number, mod_channel)
+        self.report_store.close_case(case.number, REMOVED)
+        self.review_queue.complete(case.number)
+        self.case_listing.remove(case.number)
+
+    @timed('handle_classification')
+    async def handle_classification(self, message, attachments, verdicts):
+        # One case per message, however many of its attachments were flagged
+        flagged = [v for v in verdicts if is_flagged(v)]
+        if not flagged:
+            return
+        known = [v for v in flagged if v.known_match]
+        if known:
+            case = self.file_automatic_case(message, None, AUTOMATIC_SEVERITY, True, 'Image matches the known CSAM hash list.\n',
+                                            phash=known[0].phash, review=False)
+            if case is not None:
+                await self.resolve_known_match(case, known[0].known_match, self.case_mod_channel(case))
+            return
+        self.file_automatic_case(message, None, AUTOMATIC_SEVERITY, True, 'Image believed to contain a child.\n', phash=flagged[0].phash)
+
+    async def handle_backfill_classification(self, message, attachments, verdicts):
+        # An old message may already have a case, from a user's report or a scan with earlier weights
+        if any(is_flagged(v) for v in verdicts):
+            existing = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.report_store.find, link=str(message.jump_url), limit=1))
+            if not existing:
+                await self.handle_classification(message, attachments, verdicts)
+
+    def handle_text_verdict(self, message, verdict):
+        self.file_automatic_case(message, verdict.category, TEXT_SEVERITY.get(verdict.category, 1), False,
+                                 self.code_format(verdict, message))
+
+    def file_automatic_case(self, message, reason, severity, contains_child, notes, phash=None, review=True):
+        # Open a case for a message one of the automatic filters flagged and tell the mod channel;
+        # review=False for cases the bot resolves itself, which never go in the review queue.
+        # Returns None without filing if the guild's mod channel went away while the message was being checked.
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            logger.warning('No mod channel in guild %s for flagged message %s, not filing a case', message.guild.id, message.id)
+            return None
+        author_id = "Automatic Filter"
+        self.message_cache.put_message(message, phash)
+        case = self.report_store.file(None, author_id, True, message.author.id, str(message.created_at),
+                                      message.created_at.timestamp(), str(message.jump_url), contains_child,
+                                      reason, severity, phash=phash)
+        if review:
+            self.review_queue.enqueue(case)
+            self.case_listing.add(case)
+        reply = 'New report has been filed:\n'
+        reply += render_header(case)
+        reply += notes
+        self.cases_filed['automatic'].inc()
+        self.outbound.send(mod_channel, reply, coalesce=True)
+        return case
+
+    def file_user_report(self, report, reporter):
+        # Open a case for a report a user has just finished
+        reported_time = report.get_time()
+        case = self.report_store.file(reporter.id, str(reporter), False, report.get_abuser_id(),
+                                      str(reported_time), reported_time.timestamp(), str(report.get_link()),
+                                      report.image_contains_child(), report.get_reason(), report.get_severity())
+        self.review_queue.enqueue(case)
+        self.case_listing.add(case)
+        return case
+
+    async def reported_message_info(self, guild_id, channel_id, message_id, report_num):
+        '''Guild, channel and author of a reported message: cached, from the case, or fetched as a last resort. None if it's gone.'''
+        info = self.message_cache.get(message_id)
+        if info is not None:
+            return info
+        case = self.report_store.get(report_num)
+        if case is not None and case.reported_user_id is not None:
+            return self.message_cache.put(message_id, guild_id, channel_id, case.reported_user_id)
+        guild = self.get_guild(guild_id)
+        channel = guild.get_channel(channel_id) if guild is not None else None
+        if channel is None:
+            return None
+        try:
+            with span('fetch_message'):
+                reported = await channel.fetch_message(message_id)
+        except discord.errors.NotFound:
+            return None
+        return self.message_cache.put_message(reported)
+
+    async def delete_reported_message(self, info, message_id):
+        '''Deletes a reported message in whichever guild it was posted. Returns False if it could not be removed.'''
+        guild = self.get_guild(info.guild_id) if info.guild_id is not None else None
+        channel = guild.get_channel(info.channel_id) if guild is not None else None
+        if channel is None:
+            return False # The bot has left the guild or the channel is gone
+        try:
+            with span('delete_message'):
+                await channel.get_partial_message(message_id).delete()
+        except discord.errors.NotFound:
+            pass # Already deleted by its author or by an earlier case
+        except discord.errors.HTTPException:
+            logger.warning('Could not delete reported message %s in channel %s', message_id, info.channel_id, exc_info=True)
+            return False
+        return True
+
+    def review_abandoned(self, mod_id, review):
+        # A review session timed out or was evicted; let someone else take its case
+        if review.get_report_num() is not None:
+            self.review_queue.release(review.get_report_num(), mod_id)
+
+    def dm_target(self, user_id):
+        # A bare ID is all the REST sender needs; ClientSender fetches the user if they aren't cached
+        return self.get_user(user_id) or discord.Object(id=user_id)
+
+    def hash_reported_image(self, report_num, message_id, image_urls):
+        # Hash a user-reported image in the background so the review can check it against the hash list
+        if image_urls:
+            asyncio.create_task(self._hash_reported_image(report_num, message_id, image_urls[0]))
+
+    async def _hash_reported_image(self, report_num, message_id, image_url):
+        try:
+            data = await self.fetcher.fetch(image_url)
+            _, phash = await asyncio.get_running_loop().run_in_executor(None, hash_image_bytes, data)
+        except Exception:
+            logger.warning('Could not hash reported image %s', image_url, exc_info=True)
+            return
+        self.report_store.set_phash(report_num, phash)
+        self.message_cache.set_phash(message_id, phash)
+        # A known image is actioned without review, unless a moderator has already opened the case
+        match = self.hash_list.match(phash)
+        case = self.report_store.get(report_num)
+        if match is not None and case is not None and report_num not in self.review_queue.leases:
+            await self.resolve_known_match(case, match, self.case_mod_channel(case))
+
+    def case_mod_channel(self, case):
+        # The mod channel of the guild the reported message is in
+        m = re.search(r'/(\d+)/\d+/\d+', case.link)
+        return (self.mod_channels.get(int(m.group(1))) if m else None) or self.mod_channel
+
+    def known_hash_match(self, report_num):
+        '''(listed hash, distance) if the case's image is on the known hash list, otherwise None.'''
+        case = self.report_store.get(report_num)
+        if case is None or case.phash is None:
+            return None
+        return self.hash_list.match(case.phash)
+
+    def add_known_hash(self, report_num):
+        # A reviewer confirmed this case's image, so future copies are caught automatically
+        case = self.report_store.get(report_num)
+        if case is not None and case.phash is not None:
+            asyncio.create_task(self._add_known_hash(case.phash))
+
+    async def _add_known_hash(self, phash):
+        # HashList.add appends to the list file, so keep it off the event loop
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.hash_list.add, phash)
+        except Exception:
+            logger.exception('Could not add %016x to the known hash list', phash)
+
+    async def handle_classifier_overload(self, message, attachments):
+        # The filter is backed up, so let a moderator look at the image instead of silently skipping it
+        reply = 'Automatic filter is overloaded and could not check this image. Please review it manually:\n'
+        reply += 'Reported Image Link: ' + str(message.jump_url) + '\n'
+        mod_channel = self.mod_channels.get(message.guild.id)
+        if mod_channel is None:
+            logger.warning('No mod channel in guild %s to hand unchecked message %s to', message.guild.id, message.id)
+            return
+        self.outbound.send(mod_channel, reply, coalesce=True)
+
     def eval_text(self, message):
-        ''''
-        TODO: Once you know how you want to evaluate messages in your channel, 
-        insert your code here! This will primarily be used in Milestone 3. 
         '''
-        
-        return message
-
-     
-    def code_format(self, text):
-        ''''
-        TODO: Once you know how you want to show that a message has been 
-        evaluated, insert your code here for formatting the string to be 
-        shown in the mod channel. 
+        Queues the message's text for the automatic text filter. If it scores
+        over the threshold for a report reason, handle_text_verdict is called
+        with its TextVerdict once the batch it went in has been scored.
         '''
-        return ""
+        self.text_filter.submit(message, message.content)
+
+    def code_format(self, verdict, message):
+        '''
+        The lines the mod channel is shown for a message the text filter flagged.
+        '''
+        text = message.content if len(message.content) <= 300 else message.content[:300] + '...'
+        reply = 'Reason: ' + verdict.category + ' (text filter score ' + f'{verdict.score:.2f}' + ')\n'
+        if verdict.terms:
+            reply += 'Matched terms: ' + ', '.join(verdict.terms) + '\n'
+        reply += 'Message: ' + discord.utils.escape_mentions(discord.utils.escape_markdown(text)) + '\n'
+        return reply
+
 
+if __name__ == '__main__':
+    # There should be a file called 'tokens.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        tokens = json.load(f)
+        discord_token = tokens['discord']
 
-client = ModBot()
-client.run(discord_token)
\ No newline at end of file
+    client = ModBot()
+    client.run(discord_token)
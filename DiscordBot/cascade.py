@@ -0,0 +1,125 @@
+import sys
+import json
+import argparse
+import torch
+
+KITTEN = 1 # Class index of "kitten", as trained in the notebook
+
+
+class Cascade:
+    '''
+    Two-stage classifier. A small model (e.g. ResNet-18 trained with the same
+    notebook loop, saved as tensor_small.pt) scores every image first; only
+    images whose kitten probability falls inside the (low, high) uncertainty
+    band are escalated to the full ResNet-50. Below the band the small model's
+    best non-kitten class is used, above it the image is labelled a kitten.
+    '''
+    def __init__(self, small, large, low=0.05, high=0.9):
+        if not 0 <= low < high <= 1:
+            raise ValueError(f"Need 0 <= low < high <= 1, got ({low}, {high})")
+        self.small = small # ResidentModel for the prefilter
+        self.large = large # ResidentModel for the full model
+        self.low = low
+        self.high = high
+        self.stats = {'images': 0, 'escalated': 0}
+
+    def predict(self, images):
+        '''Class index for each image tensor.'''
+        self.small.reload_if_changed()
+        self.large.reload_if_changed()
+        batch = torch.stack(images)
+        with torch.no_grad():
+            probs = torch.softmax(self.small.get()(batch.to(self.small.device)), dim=1).cpu()
+            predictions = decide(probs, self.low, self.high)
+            escalate = (probs[:, KITTEN] > self.low) & (probs[:, KITTEN] < self.high)
+            if escalate.any():
+                logits = self.large.get()(batch[escalate].to(self.large.device))
+                predictions[escalate] = logits.argmax(dim=1).cpu()
+        self.stats['images'] += len(images)
+        self.stats['escalated'] += int(escalate.sum())
+        return predictions.tolist()
+
+    def escalation_rate(self):
+        return self.stats['escalated'] / self.stats['images'] if self.stats['images'] else 0.0
+
+
+def decide(probs, low, high):
+    '''Small-model decision for every row of softmax probs (escalated rows are overwritten by the caller).'''
+    others = probs.clone()
+    others[:, KITTEN] = -1
+    predictions = others.argmax(dim=1)
+    predictions[probs[:, KITTEN] >= high] = KITTEN
+    return predictions
+
+
+def sweep(small_probs, large_predictions, labels, lows, highs):
+    '''Escalation rate, kitten recall and accuracy of the cascade for every (low, high) pair.'''
+    labels = torch.as_tensor(labels)
+    large_predictions = torch.as_tensor(large_predictions)
+    kittens = labels == KITTEN
+    rows = []
+    for low in lows:
+        for high in highs:
+            if low >= high:
+                continue
+            predictions = decide(small_probs, low, high)
+            escalate = (small_probs[:, KITTEN] > low) & (small_probs[:, KITTEN] < high)
+            predictions[escalate] = large_predictions[escalate]
+            rows.append({
+                'low': low,
+                'high': high,
+                'escalated': escalate.float().mean().item(),
+                'kitten_recall': (predictions[kittens] == KITTEN).float().mean().item() if kittens.any() else 0.0,
+                'accuracy': (predictions == labels).float().mean().item(),
+            })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune the cascade band on a labelled directory (adults/, kittens/, Other/).')
+    parser.add_argument('labelled', help='directory with one sub-directory per class, as in the notebook')
+    parser.add_argument('--weights', default='tensor.pt')
+    parser.add_argument('--small-weights', default='tensor_small.pt')
+    parser.add_argument('--small-arch', default='resnet18')
+    parser.add_argument('--max-recall-loss', type=float, default=0.0,
+                        help='how much kitten recall the cascade may give up compared with ResNet-50 alone')
+    parser.add_argument('--json', help='also write every (low, high) result to this file')
+    args = parser.parse_args()
+
+    from classifier import ResidentModel, load_labelled
+    images, labels, _, failed = load_labelled(args.labelled)
+    if not images:
+        sys.exit(f'No readable images in {args.labelled}')
+    print(f'{len(images)} images ({len(failed)} unreadable)')
+
+    small = ResidentModel(args.small_weights, arch=args.small_arch).get()
+    large = ResidentModel(args.weights).get()
+    small_probs, large_predictions = [], []
+    with torch.no_grad():
+        for i in range(0, len(images), 32):
+            batch = torch.stack(images[i:i + 32])
+            small_probs.append(torch.softmax(small(batch), dim=1))
+            large_predictions.append(large(batch).argmax(dim=1))
+    small_probs = torch.cat(small_probs)
+    large_predictions = torch.cat(large_predictions)
+
+    labels_t = torch.as_tensor(labels)
+    kittens = labels_t == KITTEN
+    large_recall = (large_predictions[kittens] == KITTEN).float().mean().item() if kittens.any() else 0.0
+    print(f'ResNet-50 alone: kitten recall {large_recall:.2%}, accuracy {(large_predictions == labels_t).float().mean().item():.2%}')
+
+    steps = [i / 100 for i in range(1, 100)]
+    rows = sweep(small_probs, large_predictions, labels, steps[:60], steps[40:])
+    good = [r for r in rows if r['kitten_recall'] >= large_recall - args.max_recall_loss]
+    if not good:
+        sys.exit('No band keeps kitten recall within the allowed loss')
+    best = min(good, key=lambda r: (r['escalated'], -r['accuracy']))
+    print(f"Best band: low={best['low']:.2f} high={best['high']:.2f} escalates {best['escalated']:.1%} of images, "
+          f"kitten recall {best['kitten_recall']:.2%}, accuracy {best['accuracy']:.2%}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'large_kitten_recall': large_recall, 'best': best, 'results': rows}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
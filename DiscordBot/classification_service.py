@@ -0,0 +1,221 @@
+import asyncio
+import logging
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from fetcher import FetchError
+from image_hash import sha256_hex
+from metrics import span, gauge, StatsCounters, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# What to do with an image when the work queue is full
+DROP = 'drop' # skip it
+DEFER = 'defer' # wait for room in the queue (only the posting message's handler waits)
+MOD_CHANNEL = 'mod_channel' # skip classification and hand it straight to the moderators
+OVERLOAD_POLICIES = (DROP, DEFER, MOD_CHANNEL)
+
+# Result for one attachment. label is None if the model wasn't run on it (known_match is
+# set instead); known_match is (listed hash, distance) when the image is on the hash list.
+Verdict = namedtuple('Verdict', ['label', 'sha256', 'phash', 'known_match'])
+
+
+class ClassificationService:
+    '''
+    Runs image classification off the event loop. Messages with attachments are
+    put on a queue bounded at max_queue images (a message counts once per
+    attachment; one with more than max_queue is let in only when the queue is
+    empty). A fixed number of workers download every attachment
+    through the shared ImageFetcher, decode and preprocess it in a thread pool,
+    hand the tensors to a shared MicroBatcher so images from different messages
+    share one forward pass, and report the labels back through on_result.
+    Images already in the verdict cache (same bytes, or a near-identical
+    perceptual hash) skip decoding or inference, and images on the known-bad
+    hash list are flagged without running the model.
+
+    If created with ready=False, messages submitted before set_ready() is
+    called (while the model is still loading) are held in a backlog of up to
+    max_backlog messages and classified in order once it is. Messages that
+    arrive while the backlog is full get the overload policy, as they would
+    with a full queue; none are classified before the model is ready.
+
+    A caller that needs to know when its message has been classified (the
+    history backfill) can pass a future as done; the verdicts are set on it
+    instead of being passed to on_result.
+    '''
+    def __init__(self, fetcher, decode_fn, batcher, on_result, on_overload=None, cache=None, hash_list=None,
+                 max_queue=64, concurrency=2, overload_policy=DEFER, ready=True, max_backlog=4096):
+        if overload_policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy {overload_policy!r}, expected one of {OVERLOAD_POLICIES}")
+        if overload_policy == MOD_CHANNEL and on_overload is None:
+            raise ValueError("The mod_channel overload policy needs an on_overload callback")
+        self.fetcher = fetcher
+        self.decode_fn = decode_fn # Blocking function image bytes -> (image tensor, perceptual hash)
+        self.batcher = batcher
+        self.cache = cache
+        self.hash_list = hash_list
+        self.on_result = on_result # Coroutine (message, attachments, verdicts); a verdict is None if the image couldn't be read
+        self.on_overload = on_overload # Coroutine (message, attachments)
+        self.overload_policy = overload_policy
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue() # Bounded by queued_images rather than by message count
+        self.max_queue = max_queue
+        self.queued_images = 0
+        self.queue_room = asyncio.Event() # Set whenever a worker takes a message off the queue
+        self.waiting = deque() # Deferred messages waiting for room, oldest first
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='preprocess')
+        self.workers = []
+        self.ready = ready
+        self.backlog = deque() # Messages submitted before the model was ready
+        self.max_backlog = max_backlog
+        self.backlog_room = asyncio.Event() # Set whenever a message leaves the backlog
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'dropped': 0, 'deferred': 0, 'overloaded': 0, 'backlogged': 0}
+        REGISTRY.register(StatsCounters('modbot_classify_messages_total', self.stats, 'Messages sent to the automatic filter by outcome', label='result'))
+        gauge('modbot_classify_queue_depth', 'Messages waiting for a classification worker', fn=self.depth)
+        gauge('modbot_classify_queue_images', 'Images in the messages waiting for a classification worker',
+              fn=lambda: self.queued_images)
+        gauge('modbot_classify_backlog', 'Messages waiting for the model to finish loading', fn=lambda: len(self.backlog))
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.executor.shutdown(wait=False)
+        self.batcher.close()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _has_room(self, item):
+        return self.queued_images == 0 or self.queued_images + len(item[1]) <= self.max_queue
+
+    def _put(self, item):
+        self.queued_images += len(item[1])
+        self.queue.put_nowait(item)
+
+    async def _put_when_room(self, item):
+        # In arrival order, so a message with many images isn't overtaken forever by smaller ones
+        self.waiting.append(item)
+        try:
+            while self.waiting[0] is not item or not self._has_room(item):
+                self.queue_room.clear()
+                await self.queue_room.wait()
+        finally:
+            self.waiting.remove(item)
+            self.queue_room.set() # Let the next one in line check
+        self._put(item)
+
+    def set_ready(self):
+        '''The model is loaded; start classifying, backlog first.'''
+        self.ready = True
+        if self.backlog:
+            asyncio.create_task(self._release_backlog())
+
+    async def _release_backlog(self):
+        while self.backlog:
+            await self._put_when_room(self.backlog[0])
+            self.backlog.popleft()
+            self.backlog_room.set()
+
+    async def _put_in_backlog(self, item):
+        # Deferred while the backlog is full: wait for it to shrink, then queue behind it (or directly, if it has drained)
+        while len(self.backlog) >= self.max_backlog:
+            self.backlog_room.clear()
+            await self.backlog_room.wait()
+        if not self.ready or self.backlog:
+            self.backlog.append(item)
+        else:
+            await self._put_when_room(item)
+
+    async def submit(self, message, attachments, done=None):
+        '''Queues a message's images. Returns True if they were accepted for classification.'''
+        self.stats['submitted'] += 1
+        item = (message, attachments, done)
+        # Until the model is ready and the backlog has drained, new messages go behind it to keep their order
+        if not self.ready or self.backlog:
+            if len(self.backlog) < self.max_backlog:
+                self.stats['backlogged'] += 1
+                self.backlog.append(item)
+                return True
+            return await self._overloaded(item, self._put_in_backlog)
+        if not self.waiting and self._has_room(item):
+            self._put(item)
+            return True
+        return await self._overloaded(item, self._put_when_room)
+
+    async def _overloaded(self, item, defer):
+        # Applies the overload policy; defer is the coroutine that waits for room and queues the item
+        message, attachments, _ = item
+        if self.overload_policy == DEFER:
+            self.stats['deferred'] += 1
+            await defer(item)
+            return True
+        if self.overload_policy == MOD_CHANNEL:
+            self.stats['overloaded'] += 1
+            await self.on_overload(message, attachments)
+            return False
+        self.stats['dropped'] += 1
+        logger.warning('Automatic filter overloaded, dropping message %s', message.id)
+        return False
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message, attachments, done = await self.queue.get()
+            self.queued_images -= len(attachments)
+            self.queue_room.set()
+            try:
+                verdicts = await asyncio.gather(*(self._classify(loop, attachment) for attachment in attachments))
+                self.stats['completed'] += 1
+                if done is None:
+                    await self.on_result(message, attachments, verdicts)
+                elif not done.done():
+                    done.set_result(verdicts)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.exception('Failed to classify message %s', message.id)
+                if done is not None and not done.done():
+                    done.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def _classify(self, loop, attachment):
+        try:
+            with span('fetch'):
+                data = await self.fetcher.fetch(attachment)
+            with span('sha256'):
+                sha = await loop.run_in_executor(self.executor, sha256_hex, data)
+            cached = self.cache.lookup_exact(sha) if self.cache is not None else None
+            if cached is not None:
+                phash, label = cached
+                return Verdict(label, sha, phash, self._known_match(phash))
+            with span('preprocess'):
+                tensor, phash = await loop.run_in_executor(self.executor, self.decode_fn, data)
+        except FetchError as e:
+            logger.info('Skipping attachment: %s', e)
+            return None
+        except Exception:
+            logger.warning('Could not load image %s', attachment.url, exc_info=True)
+            return None
+
+        known_match = self._known_match(phash)
+        if known_match is not None:
+            return Verdict(None, sha, phash, known_match)
+        label = self.cache.lookup_similar(phash) if self.cache is not None else None
+        if label is not None:
+            return Verdict(label, sha, phash, None)
+        with span('batch_and_infer'):
+            label = await self.batcher.submit(tensor)
+        if self.cache is not None:
+            self.cache.store(sha, phash, label)
+        return Verdict(label, sha, phash, None)
+
+    def _known_match(self, phash):
+        if self.hash_list is None:
+            return None
+        with span('hash_list_lookup'):
+            return self.hash_list.match(phash)
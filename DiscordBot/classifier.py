@@ -1,42 +1,214 @@
+import os
+import hashlib
+import threading
+import time
+import logging
 import torch
-import torch.nn as nn
-from torchvision import datasets, models, transforms
+from torchvision import transforms
 from PIL import Image
-from tqdm import tqdm
-import requests
 from io import BytesIO
+from fetcher import fetch_sync
+from image_hash import dhash
+import backends
+from cascade import Cascade
+from metrics import span
 
-def image_loader(url):
-    """load image, returns tensor"""
-    transform = transforms.Compose([
+logger = logging.getLogger(__name__)
+
+WEIGHTS_PATH = 'tensor.pt'
+BACKEND = backends.EAGER # See backends.py; `python backends.py <dir>` compares speed and accuracy
+CALIBRATION_DIR = 'calibration' # Sample images for the static_int8 backend
+SMALL_WEIGHTS_PATH = 'tensor_small.pt' # Prefilter for cascade mode, trained like tensor.pt
+SMALL_ARCH = 'resnet18'
+CLASS_DIRS = {'adults': 0, 'kittens': 1, 'Other': 2} # Training directory for each label, as in the notebook
+LABELS = {0: "adult cat", 1: "kitten", 2: "not a cat"}
+RELOAD_CHECK_SECONDS = 5 # How often classify() looks for a new weights file
+
+transform = transforms.Compose([
     transforms.Resize(256),  # or whatever size you trained on
     transforms.CenterCrop(224),
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
 ])
-    response = requests.get(url)
-    image = Image.open(BytesIO(response.content))
-    image = transform(image).float()
-    image = image.unsqueeze(0)
-    return image
+
+def preprocess(image):
+    """PIL image -> normalised 3x224x224 tensor"""
+    return transform(image.convert('RGB')).float()
+
+def decode_tensor(data):
+    """raw image bytes -> unbatched tensor"""
+    return preprocess(Image.open(BytesIO(data)))
+
+def decode_and_hash(data):
+    """raw image bytes -> (unbatched tensor, perceptual hash)"""
+    with span('decode'):
+        image = Image.open(BytesIO(data))
+        image.load()
+    with span('transform'):
+        tensor = preprocess(image)
+    with span('dhash'):
+        phash = dhash(image)
+    return tensor, phash
+
+def load_directory(root):
+    '''Preprocesses every image under root. Returns (tensors, paths, paths that could not be decoded).'''
+    tensors, paths, failed = [], [], []
+    for dirpath, _, filenames in os.walk(root):
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                with Image.open(path) as image:
+                    tensors.append(preprocess(image))
+                paths.append(path)
+            except Exception:
+                failed.append(path)
+    return tensors, paths, failed
+
+def load_labelled(root):
+    '''Preprocesses root/adults, root/kittens and root/Other. Returns (tensors, labels, paths, undecodable paths).'''
+    tensors, labels, paths, failed = [], [], [], []
+    for name, label in CLASS_DIRS.items():
+        class_tensors, class_paths, class_failed = load_directory(os.path.join(root, name))
+        tensors += class_tensors
+        labels += [label] * len(class_tensors)
+        paths += class_paths
+        failed += class_failed
+    return tensors, labels, paths, failed
+
+def fetch_tensor(url):
+    """download image, returns unbatched tensor"""
+    return decode_tensor(fetch_sync(url))
+
+def image_loader(url):
+    """load image, returns tensor"""
+    return fetch_tensor(url).unsqueeze(0)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResidentModel:
+    '''
+    Keeps a single warmed-up copy of the ResNet-50 classifier in memory so every
+    classification shares it. Call reload() (or let classify() notice a newer
+    weights file) to swap in new weights without restarting the bot. backend
+    picks how the model is run (see backends.py).
+    '''
+    def __init__(self, weights_path=WEIGHTS_PATH, arch='resnet50', backend=BACKEND, device=None):
+        self.weights_path = weights_path
+        self.arch = arch
+        self.backend = backend
+        self.device = device or torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.model = None
+        self.version = 0 # Bumped every time new weights are swapped in
+        self.weights_mtime = None
+        self.weights_sha256 = None # Identifies the weights across restarts (e.g. for cached verdicts)
+        self.load_seconds = None
+        self.last_check = 0.0
+        self._load_lock = threading.RLock()
+
+    def build(self):
+        if self.backend in backends.CPU_ONLY_BACKENDS:
+            self.device = torch.device('cpu')
+        calibration = None
+        if self.backend == backends.STATIC_INT8:
+            calibration = load_directory(CALIBRATION_DIR)[0]
+        return backends.build(self.backend, self.weights_path, self.arch, device=self.device, calibration=calibration)
+
+    def reload(self):
+        with self._load_lock:
+            start = time.perf_counter()
+            mtime = os.path.getmtime(self.weights_path)
+            digest = file_sha256(self.weights_path)
+            model = self.build()
+            # Warm up with a dummy batch so the first real image doesn't pay for lazy allocation
+            with torch.no_grad():
+                model(torch.zeros(1, 3, 224, 224, device=self.device))
+            # Swap in one assignment; in-flight calls keep using the old model
+            self.model = model
+            self.weights_mtime = mtime
+            self.weights_sha256 = digest
+            self.version += 1
+            self.load_seconds = time.perf_counter() - start
+            logger.info('Loaded %s (%s, %s backend, version %d) in %.2fs, %.1f MB', self.weights_path, self.arch,
+                        self.backend, self.version, self.load_seconds, self.memory_bytes() / 2**20)
+            return model
+
+    def get(self):
+        if self.model is None:
+            with self._load_lock:
+                if self.model is None:
+                    self.reload()
+        return self.model
+
+    def reload_if_changed(self):
+        '''Reloads the weights if tensor.pt changed on disk. Returns True if a reload happened.'''
+        now = time.monotonic()
+        if self.model is None or now - self.last_check < RELOAD_CHECK_SECONDS:
+            return False
+        # Another thread is checking or reloading; batches keep using the current model rather than wait for it
+        if not self._load_lock.acquire(blocking=False):
+            return False
+        try:
+            if now - self.last_check < RELOAD_CHECK_SECONDS:
+                return False # Checked by another thread since we looked
+            self.last_check = now
+            if os.path.getmtime(self.weights_path) == self.weights_mtime:
+                return False
+            self.reload()
+            return True
+        except Exception:
+            # A half-written file shouldn't take the filter down; keep serving the old weights
+            logger.exception('Failed to reload %s, keeping version %d', self.weights_path, self.version)
+            return False
+        finally:
+            self._load_lock.release()
+
+    def memory_bytes(self):
+        model = self.model
+        if model is None:
+            return 0
+        return backends.model_bytes(model)
+
+    def stats(self):
+        return {
+            'weights_path': self.weights_path,
+            'version': self.version,
+            'weights_sha256': self.weights_sha256,
+            'arch': self.arch,
+            'backend': self.backend,
+            'load_seconds': self.load_seconds,
+            'memory_bytes': self.memory_bytes(),
+            'device': str(self.device),
+        }
+
+
+resident_model = ResidentModel()
+cascade = None # Set by enable_cascade()
+
+def enable_cascade(low, high, small_weights_path=SMALL_WEIGHTS_PATH, small_arch=SMALL_ARCH):
+    '''Route images through a small prefilter first; `python cascade.py <dir>` suggests low and high.'''
+    global cascade
+    small = ResidentModel(small_weights_path, arch=small_arch, backend=resident_model.backend)
+    cascade = Cascade(small, resident_model, low, high)
+    return cascade
+
+def classify_batch(images):
+    '''Runs one forward pass over a list of 3x224x224 tensors and returns a label per image.'''
+    if cascade is not None:
+        with span('forward'):
+            return [LABELS[p] for p in cascade.predict(images)]
+    resident_model.reload_if_changed()
+    model = resident_model.get()
+    batch = torch.stack(images).to(resident_model.device)
+
+    with torch.no_grad(), span('forward'):
+        predictions = model(batch).argmax(dim=1).tolist()
+    return [LABELS[p] for p in predictions]
 
 def classify(url):
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    model = models.resnet50(pretrained=True)
-    num_ftrs = model.fc.in_features
-    model.fc = nn.Linear(num_ftrs, 3)
-    model = model.to(device)
-    params = torch.load('tensor.pt', map_location=torch.device('cpu'))
-    model.load_state_dict(params)
-    model.eval()
-    image = image_loader(url)
-    
-    with torch.no_grad():
-        prediction = model(image)
-        prediction = prediction.argmax(dim=1)
-        if prediction == 1:
-            return "kitten"
-        elif prediction == 0:
-            return "adult cat"
-        else:
-            return "not a cat"
+    return classify_batch([fetch_tensor(url)])[0]
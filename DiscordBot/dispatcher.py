@@ -0,0 +1,351 @@
+import time
+import random
+import asyncio
+import logging
+from collections import deque, namedtuple
+import aiohttp
+import discord
+from metrics import Histogram, StatsCounters, REGISTRY, gauge, span
+
+logger = logging.getLogger(__name__)
+
+DISCORD_API_URL = 'https://discord.com/api/v10'
+# Discord rejects REST requests without a "DiscordBot (url, version)" user agent
+USER_AGENT = f'DiscordBot (https://github.com/Rapptz/discord.py, {discord.__version__}) ModBot'
+MESSAGE_LIMIT = 2000 # Discord rejects messages longer than this
+
+# Rate limit state Discord reports on every response (all fields None if unknown)
+RateLimit = namedtuple('RateLimit', ['bucket', 'remaining', 'reset_after'])
+NO_RATE_LIMIT = RateLimit(None, None, None)
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, is_global=False, limit=NO_RATE_LIMIT):
+        super().__init__(f'rate limited for {retry_after:.2f}s')
+        self.retry_after = retry_after
+        self.is_global = is_global
+        self.limit = limit
+
+class SendFailed(Exception):
+    '''The message can't be delivered (missing permissions, unknown channel...); retrying won't help.'''
+    pass
+
+
+class HttpSender:
+    '''
+    Posts messages straight to Discord's REST API, so the dispatcher sees the
+    rate limit headers on every response. base_url can point at a local fake
+    (see fakes.FakeDiscordAPI).
+    '''
+    def __init__(self, token, base_url=DISCORD_API_URL, timeout=10):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.session = None
+        self.dm_channels = {} # Map from user ID to the ID of the bot's DM channel with them
+
+    async def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=self.timeout, headers={'Authorization': f'Bot {self.token}',
+                                                                                'User-Agent': USER_AGENT})
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def route(self, kind, target_id):
+        # Messages to one channel share a bucket; Discord keys buckets by channel (the "major parameter")
+        return f'POST /channels/{target_id}/messages' if kind == 'channel' else f'POST /users/{target_id}/dm'
+
+    async def _dm_channel_id(self, user_id):
+        channel_id = self.dm_channels.get(user_id)
+        if channel_id is None:
+            async with self.session.post(f'{self.base_url}/users/@me/channels', json={'recipient_id': str(user_id)}) as resp:
+                await self._check(resp)
+                channel_id = self.dm_channels[user_id] = int((await resp.json())['id'])
+        return channel_id
+
+    async def send(self, kind, target, content):
+        await self.start()
+        channel_id = target.id if kind == 'channel' else await self._dm_channel_id(target.id)
+        async with self.session.post(f'{self.base_url}/channels/{channel_id}/messages', json={'content': content}) as resp:
+            return await self._check(resp)
+
+    async def _check(self, resp):
+        headers = resp.headers
+        remaining, reset_after = headers.get('X-RateLimit-Remaining'), headers.get('X-RateLimit-Reset-After')
+        limit = RateLimit(headers.get('X-RateLimit-Bucket'), int(remaining) if remaining is not None else None,
+                          float(reset_after) if reset_after is not None else None)
+        if resp.status == 429:
+            body = await resp.json(content_type=None)
+            retry_after = float(body.get('retry_after') or headers.get('Retry-After') or 1)
+            raise RateLimited(retry_after, bool(body.get('global')) or 'X-RateLimit-Global' in headers, limit)
+        if resp.status >= 500:
+            raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=resp.reason)
+        if resp.status >= 400:
+            raise SendFailed(f'{resp.status} {await resp.text()}')
+        return limit
+
+
+class ClientSender:
+    '''
+    Sends through the discord.py objects themselves. discord.py waits out
+    most rate limits on its own, so the dispatcher only sees the ones it gives
+    up on. Used by the benchmark, whose fake channels have no HTTP behind them.
+    '''
+    def __init__(self, client=None):
+        self.client = client # Used to look up users given only as a discord.Object
+
+    def route(self, kind, target_id):
+        return f'{kind} {target_id}'
+
+    async def send(self, kind, target, content):
+        try:
+            if not hasattr(target, 'send'):
+                target = await self.client.fetch_user(target.id)
+            await target.send(content)
+        except discord.RateLimited as e:
+            raise RateLimited(e.retry_after)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                raise RateLimited(1.0)
+            if e.status >= 500:
+                raise
+            raise SendFailed(f'{e.status} {e.text}')
+        return NO_RATE_LIMIT
+
+    async def close(self):
+        pass
+
+
+class Outgoing:
+    __slots__ = ('content', 'coalesce', 'future', 'queued')
+
+    def __init__(self, content, coalesce, future):
+        self.content = content
+        self.coalesce = coalesce
+        self.future = future
+        self.queued = time.perf_counter()
+
+
+class Outbox:
+    # Messages waiting for one destination; a worker task exists only while it is non-empty
+    __slots__ = ('kind', 'target', 'route', 'items', 'task')
+
+    def __init__(self, kind, target, route):
+        self.kind = kind
+        self.target = target
+        self.route = route
+        self.items = deque()
+        self.task = None
+
+
+class OutboundDispatcher:
+    '''
+    Sends the bot's messages without making handlers wait for them.
+
+    Each destination (channel or DM recipient) has its own FIFO, so replies
+    arrive in order, while different destinations are sent to concurrently,
+    up to max_concurrency requests at once. Mod channel notices queued behind
+    each other are merged into as few messages as fit under Discord's length
+    limit.
+
+    Rate limits are tracked per route bucket from the headers of earlier
+    responses, so a destination whose bucket is empty waits for it to reset
+    instead of collecting a 429. A 429 that happens anyway (or a global rate
+    limit) is retried after the time Discord asks for, and server errors with
+    exponential backoff, up to max_attempts.
+    '''
+    def __init__(self, sender=None, max_concurrency=8, max_attempts=5, backoff=0.5, limit=MESSAGE_LIMIT):
+        self.sender = sender
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.outboxes = {} # Map from (kind, target ID) to the Outbox of messages waiting for it
+        self.route_buckets = {} # Map from route to the bucket Discord said it belongs to
+        self.buckets = {} # Map from bucket to (remaining, monotonic time it resets)
+        self.global_reset = 0.0 # Monotonic time a global rate limit ends
+        self.stats = {'queued': 0, 'sent': 0, 'coalesced': 0, 'rate_limited': 0, 'retried': 0, 'failed': 0}
+        REGISTRY.register(StatsCounters('modbot_outbound_total', self.stats, 'Outbound messages by outcome'))
+        self.delay_ms = REGISTRY.register(Histogram(name='modbot_outbound_delay_ms', help='Time from queueing a message to Discord accepting it'))
+        gauge('modbot_outbound_pending', 'Messages waiting to be sent', fn=lambda: sum(len(o.items) for o in self.outboxes.values()))
+
+    def send(self, channel, content, coalesce=False):
+        '''
+        Queues a message for a channel and returns a future that resolves to
+        True once it is delivered (False if it was given up on). Callers
+        don't need to await it. With coalesce, the message may be merged
+        with other coalescable messages queued for the same channel.
+        '''
+        return self._queue('channel', channel, content, coalesce)
+
+    def send_dm(self, user, content):
+        '''Queues a direct message to a user; see send().'''
+        return self._queue('user', user, content, False)
+
+    def _queue(self, kind, target, content, coalesce):
+        key = (kind, target.id)
+        outbox = self.outboxes.get(key)
+        if outbox is None:
+            outbox = self.outboxes[key] = Outbox(kind, target, self.sender.route(kind, target.id))
+        future = asyncio.get_running_loop().create_future()
+        outbox.items.append(Outgoing(content, coalesce, future))
+        self.stats['queued'] += 1
+        if outbox.task is None:
+            outbox.task = asyncio.create_task(self._drain(key, outbox))
+        return future
+
+    def _next_batch(self, outbox):
+        items = [outbox.items.popleft()]
+        if items[0].coalesce:
+            size = len(items[0].content)
+            while outbox.items and outbox.items[0].coalesce and size + 1 + len(outbox.items[0].content) <= self.limit:
+                size += 1 + len(outbox.items[0].content)
+                items.append(outbox.items.popleft())
+        return items
+
+    async def _drain(self, key, outbox):
+        try:
+            while outbox.items:
+                items = self._next_batch(outbox)
+                self.stats['coalesced'] += len(items) - 1
+                delivered = await self._deliver(outbox, '\n'.join(item.content for item in items))
+                now = time.perf_counter()
+                for item in items:
+                    if delivered:
+                        self.delay_ms.observe((now - item.queued) * 1000)
+                    if not item.future.done():
+                        item.future.set_result(delivered)
+        finally:
+            # Nothing can be queued between the loop ending and this, since there is no await in between
+            outbox.task = None
+            if not outbox.items:
+                self.outboxes.pop(key, None)
+
+    async def _wait_for_bucket(self, route):
+        while True:
+            now = time.monotonic()
+            wait = self.global_reset - now
+            remaining, reset = self.buckets.get(self.route_buckets.get(route, route), (1, 0.0))
+            if remaining <= 0:
+                wait = max(wait, reset - now)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def _update_bucket(self, route, limit):
+        if limit.bucket is not None:
+            self.route_buckets[route] = limit.bucket + ':' + route # Same bucket on another channel is a separate limit
+        if limit.remaining is not None and limit.reset_after is not None:
+            bucket = self.route_buckets.get(route, route)
+            self.buckets[bucket] = (limit.remaining, time.monotonic() + limit.reset_after)
+
+    async def _deliver(self, outbox, content):
+        for attempt in range(self.max_attempts):
+            await self._wait_for_bucket(outbox.route)
+            bucket = self.route_buckets.get(outbox.route, outbox.route)
+            try:
+                async with self.semaphore:
+                    remaining, reset = self.buckets.get(bucket, (1, 0.0))
+                    self.buckets[bucket] = (remaining - 1, reset) # Claim our slot before awaiting, for concurrent senders on one bucket
+                    with span('outbound_send'):
+                        limit = await self.sender.send(outbox.kind, outbox.target, content)
+                self._update_bucket(outbox.route, limit)
+                self.stats['sent'] += 1
+                return True
+            except RateLimited as e:
+                self.stats['rate_limited'] += 1
+                self._update_bucket(outbox.route, e.limit)
+                if e.is_global:
+                    self.global_reset = time.monotonic() + e.retry_after
+                delay = e.retry_after
+            except SendFailed as e:
+                logger.warning('Dropping message to %s %s: %s', outbox.kind, outbox.target.id, e)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, discord.HTTPException) as e:
+                logger.warning('Sending to %s %s failed: %s', outbox.kind, outbox.target.id, e)
+                delay = self.backoff * 2 ** attempt * (1 + random.random() / 2)
+            self.stats['retried'] += 1
+            await asyncio.sleep(delay)
+        self.stats['failed'] += 1
+        return False
+
+    async def flush(self):
+        '''Waits until every queued message has been sent or given up on.'''
+        while self.outboxes:
+            await asyncio.gather(*(o.task for o in list(self.outboxes.values()) if o.task is not None))
+            await asyncio.sleep(0)
+
+    async def close(self, timeout=10):
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('Gave up on %d unsent messages', sum(len(o.items) for o in self.outboxes.values()))
+        if self.sender is not None:
+            await self.sender.close()
+
+
+async def main():
+    # Push a burst of traffic through the dispatcher against a local fake of
+    # Discord's message routes, and compare with awaiting each send in turn:
+    #   python dispatcher.py
+    from fakes import FakeDiscordAPI, FakeGuild, FakeUser
+    api = FakeDiscordAPI(limit=5, per=1.0)
+    base_url = await api.start()
+    guild = FakeGuild('CS 152')
+    mod_channel = guild.add_channel('group-25-mod')
+    channel = guild.add_channel('group-25')
+    users = [FakeUser(f'user{i}') for i in range(20)]
+
+    def traffic(dispatcher):
+        for i in range(40):
+            dispatcher.send(mod_channel, f'New report has been filed:\nCase #{i}\n', coalesce=True)
+        for i in range(10):
+            dispatcher.send(channel, f'reply {i}')
+        for user in users:
+            for i in range(3):
+                dispatcher.send_dm(user, f'dm {i}')
+
+    class Serial:
+        # Same traffic, awaited one message at a time like the handlers used to
+        def __init__(self, sender):
+            self.sender, self.sends = sender, []
+        def send(self, channel, content, coalesce=False):
+            self.sends.append(('channel', channel, content))
+        def send_dm(self, user, content):
+            self.sends.append(('user', user, content))
+        async def run(self):
+            for kind, target, content in self.sends:
+                while True:
+                    try:
+                        await self.sender.send(kind, target, content)
+                        break
+                    except RateLimited as e:
+                        await asyncio.sleep(e.retry_after)
+
+    serial = Serial(HttpSender('fake-token', base_url))
+    traffic(serial)
+    start = time.perf_counter()
+    await serial.run()
+    print(f'serial:     {len(serial.sends)} sends in {time.perf_counter() - start:.2f}s, '
+          f'{api.requests} requests, {api.rate_limited} rate limited')
+    await serial.sender.close()
+
+    api.reset()
+    dispatcher = OutboundDispatcher(HttpSender('fake-token', base_url))
+    traffic(dispatcher)
+    start = time.perf_counter()
+    await dispatcher.flush()
+    print(f'dispatcher: {dispatcher.stats["queued"]} sends in {time.perf_counter() - start:.2f}s, '
+          f'{api.requests} requests, {api.rate_limited} rate limited, {dispatcher.stats["coalesced"]} coalesced, '
+          f'p99 delay {dispatcher.delay_ms.percentile(99):.0f} ms')
+    delivered = sum(len(m) for m in api.messages.values())
+    print(f'{delivered} messages delivered to {len(api.messages)} channels')
+    await dispatcher.close()
+    await api.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,171 @@
+'''
+Offline evaluation of a weights file on labelled images, to check new weights
+before they're deployed to the bot.
+
+    python evaluate.py heldout/ --weights tensor_final.pt
+    python evaluate.py --adults a/ --kittens k/ --other o/ --workers 8 --json eval.json
+
+Images come from one directory per class (adults/, kittens/ and Other/ under
+the root, as in the notebook, or given separately). They are decoded and
+preprocessed exactly as classifier.image_loader does, in worker processes
+that stay ahead of batched inference on the resident model. Prints the
+confusion matrix, per-class precision and recall, the misclassified and
+undecodable files, and images/sec.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import torch
+from torch.utils.data import Dataset, DataLoader
+from PIL import Image
+import backends
+import classifier
+from classifier import CLASS_DIRS, LABELS, ResidentModel, preprocess
+
+
+class LabelledImages(Dataset):
+    '''(path, label) pairs -> (3x224x224 tensor, label, index, decoded ok).'''
+    def __init__(self, items):
+        self.items = items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx):
+        path, label = self.items[idx]
+        try:
+            with Image.open(path) as image:
+                return preprocess(image), label, idx, True
+        except Exception:
+            # Placeholder so the batch still stacks; dropped before inference
+            return torch.zeros(backends.INPUT_SHAPE), label, idx, False
+
+
+def list_files(directory):
+    files = []
+    for dirpath, _, filenames in os.walk(directory):
+        files += [os.path.join(dirpath, name) for name in sorted(filenames)]
+    return files
+
+
+def _init_worker(_):
+    # Decoding parallelises across workers; intra-op threads would only contend with inference
+    torch.set_num_threads(1)
+
+
+def evaluate(model, device, items, batch_size=64, workers=None):
+    '''
+    Runs every (path, label) through the model. Returns the confusion matrix
+    (rows are true labels, columns predictions), the misclassified files as
+    (path, true label, predicted label), the undecodable files, and timings.
+    '''
+    workers = os.cpu_count() if workers is None else workers
+    loader = DataLoader(LabelledImages(items), batch_size=batch_size, num_workers=workers,
+                        worker_init_fn=_init_worker if workers else None, pin_memory=device.type == 'cuda')
+    confusion = torch.zeros(len(LABELS), len(LABELS), dtype=torch.long)
+    misclassified, failed = [], []
+    forward_seconds = 0.0
+    start = time.perf_counter()
+    with torch.no_grad():
+        for images, labels, indexes, ok in loader:
+            failed += [items[i][0] for i in indexes[~ok].tolist()]
+            if not ok.any():
+                continue
+            images, labels, indexes = images[ok], labels[ok], indexes[ok]
+            t = time.perf_counter()
+            predictions = model(images.to(device, non_blocking=True)).argmax(dim=1).cpu()
+            forward_seconds += time.perf_counter() - t
+            confusion += torch.bincount(labels * len(LABELS) + predictions,
+                                        minlength=len(LABELS) ** 2).view(len(LABELS), len(LABELS))
+            wrong = predictions != labels
+            misclassified += [(items[i][0], label, prediction) for i, label, prediction
+                              in zip(indexes[wrong].tolist(), labels[wrong].tolist(), predictions[wrong].tolist())]
+    timings = {'wall_seconds': time.perf_counter() - start, 'forward_seconds': forward_seconds}
+    return confusion, misclassified, failed, timings
+
+
+def precision_recall(confusion):
+    '''{label: (precision, recall, support)} from a confusion matrix.'''
+    true = confusion.sum(dim=1)
+    predicted = confusion.sum(dim=0)
+    scores = {}
+    for label in range(len(confusion)):
+        hits = confusion[label, label].item()
+        scores[label] = (hits / predicted[label].item() if predicted[label] else 0.0,
+                         hits / true[label].item() if true[label] else 0.0, true[label].item())
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate a weights file on labelled image directories.')
+    parser.add_argument('root', nargs='?', help='directory containing ' + ', '.join(f'{name}/' for name in CLASS_DIRS))
+    for name in CLASS_DIRS:
+        parser.add_argument('--' + name.lower(), metavar='DIR', help=f'{LABELS[CLASS_DIRS[name]]} images (default: ROOT/{name})')
+    parser.add_argument('--weights', default=classifier.WEIGHTS_PATH, help='e.g. tensor.pt or tensor_final.pt')
+    parser.add_argument('--arch', default='resnet50', choices=backends.ARCHS)
+    parser.add_argument('--backend', default=backends.EAGER, choices=backends.BACKENDS)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='decoding processes (0 decodes in this process)')
+    parser.add_argument('--show', type=int, default=20, help='misclassified files to print (all are in --json)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    items = []
+    for name, label in CLASS_DIRS.items():
+        directory = getattr(args, name.lower()) or (os.path.join(args.root, name) if args.root else None)
+        if directory is None:
+            continue
+        if not os.path.isdir(directory):
+            sys.exit(f'No such directory: {directory}')
+        items += [(path, label) for path in list_files(directory)]
+    if not items:
+        sys.exit('No images given; pass a root directory or --adults/--kittens/--other')
+
+    resident = ResidentModel(args.weights, arch=args.arch, backend=args.backend)
+    model = resident.get()
+    print(f'Evaluating {args.weights} ({args.arch}, {args.backend} backend, {resident.device}) on {len(items)} files')
+    confusion, misclassified, failed, timings = evaluate(model, resident.device, items, args.batch_size, args.workers)
+
+    evaluated = int(confusion.sum())
+    width = max(len(label) for label in LABELS.values()) + 2
+    print('\nConfusion matrix (rows: true class, columns: predicted)')
+    print(' ' * width + ''.join(f'{LABELS[p]:>{width}}' for p in LABELS))
+    for t in LABELS:
+        print(f'{LABELS[t]:<{width}}' + ''.join(f'{confusion[t, p].item():>{width}}' for p in LABELS))
+    print(f"\n{'class':<{width}}{'precision':>10}{'recall':>10}{'images':>10}")
+    scores = precision_recall(confusion)
+    for label, (precision, recall, support) in scores.items():
+        print(f'{LABELS[label]:<{width}}{precision:>10.2%}{recall:>10.2%}{support:>10}')
+    accuracy = confusion.trace().item() / evaluated if evaluated else 0.0
+    print(f'Accuracy: {accuracy:.2%} of {evaluated} images')
+
+    if misclassified:
+        print(f'\nMisclassified ({len(misclassified)}):')
+        for path, label, prediction in misclassified[:args.show]:
+            print(f'  {path}: {LABELS[label]}, predicted {LABELS[prediction]}')
+        if len(misclassified) > args.show:
+            print(f'  ... and {len(misclassified) - args.show} more')
+    if failed:
+        print(f'\nUndecodable ({len(failed)}):')
+        for path in failed:
+            print(f'  {path}')
+
+    rate = evaluated / timings['wall_seconds'] if timings['wall_seconds'] else 0.0
+    print(f"\n{rate:.1f} images/s ({timings['wall_seconds']:.1f}s total, {timings['forward_seconds']:.1f}s in the model, "
+          f'batch size {args.batch_size}, {args.workers} decoding workers)')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'weights': args.weights, 'weights_sha256': resident.weights_sha256, 'arch': args.arch,
+                       'backend': args.backend, 'images': evaluated, 'accuracy': accuracy,
+                       'confusion': confusion.tolist(), 'labels': [LABELS[label] for label in LABELS],
+                       'classes': {LABELS[label]: {'precision': p, 'recall': r, 'images': n}
+                                   for label, (p, r, n) in scores.items()},
+                       'misclassified': [{'path': path, 'label': LABELS[label], 'predicted': LABELS[prediction]}
+                                         for path, label, prediction in misclassified],
+                       'undecodable': failed, 'images_per_sec': rate, **timings}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
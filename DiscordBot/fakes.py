@@ -0,0 +1,231 @@
+import time
+import itertools
+import datetime
+from collections import defaultdict
+import discord
+from aiohttp import web
+
+# In-memory stand-ins for the discord.py objects ModBot touches, so the bot's
+# handlers can be driven without a gateway connection (see benchmark.py).
+
+_ids = itertools.count(10**17)
+
+def next_id():
+    return next(_ids)
+
+
+class FakeResponse:
+    # discord.HTTPException only needs these two fields from the HTTP response
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+
+class FakeUser:
+    client_user = None # Author of the messages the bot sends; set by attach_fake_gateway
+    users = {} # Every FakeUser by ID, standing in for the client's user cache
+
+    def __init__(self, name, id=None, bot=False):
+        self.id = id or next_id()
+        FakeUser.users[self.id] = self
+        self.name = name
+        self.bot = bot
+        self.sent = [] # DMs the bot sent this user
+        self.dm_channel = FakeDMChannel(self)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+    async def send(self, content):
+        return await self.dm_channel.send(content)
+
+
+class FakeAttachment:
+    def __init__(self, url, size=None, content_type='image/jpeg', filename=None):
+        self.id = next_id()
+        self.url = url
+        self.size = size
+        self.content_type = content_type
+        self.filename = filename or url.rsplit('/', 1)[-1]
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, attachments=(), id=None, created_at=None):
+        self.id = id or next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.attachments = list(attachments)
+        self.created_at = created_at or datetime.datetime.now(datetime.timezone.utc)
+        self.deleted = False
+
+    @property
+    def jump_url(self):
+        guild_id = self.guild.id if self.guild else '@me'
+        return f'https://discord.com/channels/{guild_id}/{self.channel.id}/{self.id}'
+
+    async def delete(self):
+        if self.channel.messages.pop(self.id, None) is None:
+            raise discord.errors.NotFound(FakeResponse(404, 'Not Found'), 'Unknown Message')
+        self.deleted = True
+
+
+class FakeTextChannel:
+    def __init__(self, name, guild, id=None):
+        self.id = id or next_id()
+        self.name = name
+        self.guild = guild
+        self.messages = {} # Message ID -> FakeMessage, oldest first
+        self.sent = [] # Contents of messages the bot sent here
+
+    def __str__(self):
+        return self.name
+
+    def post(self, content, author, attachments=()):
+        '''Adds a message as if a user had sent it; the caller passes it to the bot.'''
+        message = FakeMessage(content, author, self, attachments)
+        self.messages[message.id] = message
+        return message
+
+    async def send(self, content):
+        self.sent.append(content)
+        message = FakeMessage(content, FakeUser.client_user, self)
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, id):
+        message = self.messages.get(id)
+        if message is None:
+            raise discord.errors.NotFound(FakeResponse(404, 'Not Found'), 'Unknown Message')
+        return message
+
+    def get_partial_message(self, id):
+        return self.messages.get(id) or FakeMessage('', None, self, id=id)
+
+    async def history(self, limit=100, before=None, after=None, oldest_first=None):
+        # Newest first like discord.py unless oldest_first (or after) is given
+        messages = list(self.messages.values())
+        if after is not None:
+            messages = [m for m in messages if m.id > getattr(after, 'id', after)]
+            oldest_first = True if oldest_first is None else oldest_first
+        if before is not None:
+            messages = [m for m in messages if m.id < getattr(before, 'id', before)]
+        if not oldest_first:
+            messages.reverse()
+        for message in messages[:limit] if limit is not None else messages:
+            yield message
+
+
+class FakeDMChannel:
+    def __init__(self, user):
+        self.id = user.id
+        self.recipient = user
+        self.guild = None
+        self.messages = {}
+        self.sent = user.sent
+
+    async def send(self, content):
+        self.sent.append(content)
+        return FakeMessage(content, FakeUser.client_user, self)
+
+
+class FakeGuild:
+    def __init__(self, name, id=None):
+        self.id = id or next_id()
+        self.name = name
+        self.text_channels = []
+
+    def add_channel(self, name):
+        channel = FakeTextChannel(name, self)
+        self.text_channels.append(channel)
+        return channel
+
+    def get_channel(self, id):
+        for channel in self.text_channels:
+            if channel.id == id:
+                return channel
+        return None
+
+
+def attach_fake_gateway(bot, guilds, bot_user):
+    '''
+    Points a ModBot at fake guilds instead of a gateway connection and runs the
+    same mod channel discovery on_ready would.
+    '''
+    FakeUser.client_user = bot_user
+    bot._connection.user = bot_user
+    by_id = {guild.id: guild for guild in guilds}
+    bot.get_guild = by_id.get
+    bot.get_user = FakeUser.users.get
+    bot.group_num = bot_user.name.split()[1]
+    for guild in guilds:
+        for channel in guild.text_channels:
+            if channel.name == f'group-{bot.group_num}-mod':
+                bot.mod_channels[guild.id] = channel
+                bot.mod_channel = channel
+
+
+class FakeDiscordAPI:
+    '''
+    Local HTTP server standing in for Discord's message routes (see
+    dispatcher.HttpSender). Each channel gets a bucket of limit messages per
+    per seconds, reported in the same headers Discord uses, and a request over
+    the limit gets a 429 with retry_after.
+    '''
+    def __init__(self, limit=5, per=5.0):
+        self.limit = limit
+        self.per = per
+        self.runner = None
+        self.reset()
+
+    def reset(self):
+        self.windows = {} # Channel ID -> (remaining, monotonic time the bucket resets)
+        self.messages = defaultdict(list) # Channel ID -> contents posted there
+        self.dm_channels = {} # User ID -> DM channel ID
+        self.requests = 0
+        self.rate_limited = 0
+
+    async def start(self):
+        '''Starts serving on a free local port and returns the base URL to give HttpSender.'''
+        app = web.Application()
+        app.router.add_post('/channels/{channel_id}/messages', self.create_message)
+        app.router.add_post('/users/@me/channels', self.create_dm)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, '127.0.0.1', 0).start()
+        return f'http://127.0.0.1:{self.runner.addresses[0][1]}'
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def create_dm(self, request):
+        user_id = int((await request.json())['recipient_id'])
+        channel_id = self.dm_channels.setdefault(user_id, next_id())
+        return web.json_response({'id': str(channel_id), 'type': 1})
+
+    async def create_message(self, request):
+        self.requests += 1
+        channel_id = int(request.match_info['channel_id'])
+        now = time.monotonic()
+        remaining, reset = self.windows.get(channel_id, (self.limit, now + self.per))
+        if now >= reset:
+            remaining, reset = self.limit, now + self.per
+        headers = {'X-RateLimit-Limit': str(self.limit), 'X-RateLimit-Bucket': 'fake-messages',
+                   'X-RateLimit-Reset-After': f'{reset - now:.3f}'}
+        if remaining <= 0:
+            self.rate_limited += 1
+            headers['X-RateLimit-Remaining'] = '0'
+            return web.json_response({'message': 'You are being rate limited.', 'retry_after': reset - now, 'global': False},
+                                     status=429, headers=headers)
+        self.windows[channel_id] = (remaining - 1, reset)
+        headers['X-RateLimit-Remaining'] = str(remaining - 1)
+        content = (await request.json())['content']
+        self.messages[channel_id].append(content)
+        return web.json_response({'id': str(next_id()), 'channel_id': str(channel_id), 'content': content}, headers=headers)
@@ -0,0 +1,146 @@
+import asyncio
+import os
+import time
+from urllib.parse import urlparse
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import Histogram, StatsCounters, REGISTRY
+
+MAX_IMAGE_BYTES = 10 * 2**20 # Larger uploads are rejected without being read
+CHUNK_BYTES = 64 * 1024
+BYTES_BUCKETS = (16 * 2**10, 64 * 2**10, 256 * 2**10, 2**20, 4 * 2**20, 8 * 2**20, 16 * 2**20)
+
+
+class FetchError(Exception):
+    pass
+
+class ImageTooLarge(FetchError):
+    pass
+
+class NotAnImage(FetchError):
+    pass
+
+
+def fixture_path(fixture_dir, url):
+    # Tests map every URL to the file with the same name in the fixture directory
+    return os.path.join(fixture_dir, os.path.basename(urlparse(url).path))
+
+
+class ImageFetcher:
+    '''
+    Downloads attachment images over one shared keep-alive connection pool.
+    Downloads are streamed and abandoned as soon as they go over max_bytes, and
+    attachments whose Discord metadata already says they are too big or not an
+    image are rejected without a request. If fixture_dir is set, images are
+    read from that directory instead of the network.
+    '''
+    def __init__(self, max_bytes=MAX_IMAGE_BYTES, timeout=10, connect_timeout=3, pool_size=32, fixture_dir=None):
+        self.max_bytes = max_bytes
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.pool_size = pool_size
+        self.fixture_dir = fixture_dir
+        self.session = None
+        self.bytes = REGISTRY.register(Histogram(BYTES_BUCKETS, 'modbot_fetch_bytes', 'Size of downloaded images'))
+        self.latency_ms = REGISTRY.register(Histogram(name='modbot_fetch_ms', help='Time to download one image'))
+        self.stats = {'fetched': 0, 'rejected': 0, 'failed': 0}
+        REGISTRY.register(StatsCounters('modbot_fetch_total', self.stats, 'Image downloads by outcome', label='result'))
+
+    async def start(self):
+        if self.session is None and self.fixture_dir is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def check_attachment(self, attachment):
+        '''Rejects attachments using the size and content type Discord already sent us.'''
+        content_type = getattr(attachment, 'content_type', None)
+        if content_type and not content_type.startswith('image/'):
+            raise NotAnImage(f'{attachment.url} has content type {content_type}')
+        size = getattr(attachment, 'size', None)
+        if size and size > self.max_bytes:
+            raise ImageTooLarge(f'{attachment.url} is {size} bytes')
+
+    async def fetch(self, attachment):
+        '''Returns the raw bytes of an attachment (anything with a .url) or a URL string.'''
+        if isinstance(attachment, str):
+            url = attachment
+        else:
+            url = attachment.url
+            try:
+                self.check_attachment(attachment)
+            except FetchError:
+                self.stats['rejected'] += 1
+                raise
+
+        start = time.perf_counter()
+        try:
+            if self.fixture_dir is not None:
+                data = await asyncio.get_running_loop().run_in_executor(None, self._read_fixture, url)
+            else:
+                data = await self._download(url)
+        except FetchError:
+            self.stats['rejected'] += 1
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        self.stats['fetched'] += 1
+        self.bytes.observe(len(data))
+        self.latency_ms.observe((time.perf_counter() - start) * 1000)
+        return data
+
+    async def _download(self, url):
+        if self.session is None:
+            await self.start()
+        async with self.session.get(url) as response:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type')
+            if content_type and not content_type.startswith('image/'):
+                raise NotAnImage(f'{url} has content type {content_type}')
+            if response.content_length and response.content_length > self.max_bytes:
+                raise ImageTooLarge(f'{url} is {response.content_length} bytes')
+            data = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_BYTES):
+                data += chunk
+                if len(data) > self.max_bytes:
+                    raise ImageTooLarge(f'{url} is over {self.max_bytes} bytes')
+            return bytes(data)
+
+    def _read_fixture(self, url):
+        path = fixture_path(self.fixture_dir, url)
+        if os.path.getsize(path) > self.max_bytes:
+            raise ImageTooLarge(f'{path} is over {self.max_bytes} bytes')
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def snapshot(self):
+        return dict(self.stats, bytes=self.bytes.snapshot(), latency_ms=self.latency_ms.snapshot())
+
+
+# Blocking equivalent for code that isn't running on the event loop (classify(), notebooks, scripts)
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+def fetch_sync(url, max_bytes=MAX_IMAGE_BYTES, timeout=(3, 10), fixture_dir=None):
+    if fixture_dir is not None:
+        path = fixture_path(fixture_dir, url)
+        if os.path.getsize(path) > max_bytes:
+            raise ImageTooLarge(f'{path} is over {max_bytes} bytes')
+        with open(path, 'rb') as f:
+            return f.read()
+    with _session.get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and int(length) > max_bytes:
+            raise ImageTooLarge(f'{url} is {length} bytes')
+        data = bytearray()
+        for chunk in response.iter_content(CHUNK_BYTES):
+            data += chunk
+            if len(data) > max_bytes:
+                raise ImageTooLarge(f'{url} is over {max_bytes} bytes')
+        return bytes(data)
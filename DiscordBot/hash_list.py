@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import numpy as np
+from image_hash import HammingIndex, PackedHammingIndex
+from metrics import StatsCounters, gauge, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+def load_hashes(path):
+    '''
+    Reads a hash list: either a .npy array of uint64, or a text file with one
+    16-digit hex perceptual hash per line (blank lines and # comments ignored).
+    '''
+    if path.endswith('.npy'):
+        return np.load(path)
+    hashes = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hashes.append(int(line, 16))
+    return np.array(hashes, dtype=np.uint64)
+
+
+class HashList:
+    '''
+    Local list of perceptual hashes of known CSAM. The bulk of the list is
+    loaded once into a PackedHammingIndex; hashes confirmed by reviewers while
+    the bot is running go into a small dict-based HammingIndex and are appended
+    to the list file so they survive a restart. A .npy list can't be appended
+    to in place, so its additions go to a text file next to it
+    (known_hashes.npy -> known_hashes.added.txt), which is loaded with it.
+    '''
+    def __init__(self, path, max_distance=4):
+        self.path = path
+        self.max_distance = max_distance
+        self.packed = PackedHammingIndex([], max_distance)
+        self.recent = HammingIndex(max_distance)
+        self.lock = threading.Lock() # Lookups run on classification threads as well as the event loop
+        self.stats = {'lookups': 0, 'matches': 0, 'added': 0}
+        REGISTRY.register(StatsCounters('modbot_hash_list_total', self.stats, 'Known hash list lookups and additions'))
+        gauge('modbot_hash_list_size', 'Hashes on the known hash list', fn=self.__len__)
+
+    @property
+    def added_path(self):
+        # Where add() appends confirmed hashes
+        return os.path.splitext(self.path)[0] + '.added.txt' if self.path.endswith('.npy') else self.path
+
+    def load(self):
+        start = time.perf_counter()
+        lists = [load_hashes(path) for path in dict.fromkeys((self.path, self.added_path)) if os.path.isfile(path)]
+        if lists:
+            self.packed = PackedHammingIndex(np.concatenate(lists), self.max_distance)
+        self.recent = HammingIndex(self.max_distance)
+        logger.info('Loaded %d known hashes from %s in %.2fs', len(self.packed), self.path, time.perf_counter() - start)
+
+    def __len__(self):
+        return len(self.packed) + len(self.recent)
+
+    def match(self, phash):
+        '''Returns (known hash, distance) for the closest listed hash within max_distance, or None.'''
+        with self.lock:
+            self.stats['lookups'] += 1
+            matches = self.packed.search(phash) + self.recent.search(phash)
+        if not matches:
+            return None
+        self.stats['matches'] += 1
+        return min(matches, key=lambda m: m[1])
+
+    def add(self, phash):
+        '''Adds a newly confirmed hash. Returns False if it was already listed.'''
+        with self.lock:
+            if phash in self.packed or phash in self.recent:
+                return False
+            self.recent.add(phash)
+            self.stats['added'] += 1
+        with open(self.added_path, 'a') as f:
+            f.write(f'{phash:016x}\n')
+        return True
+
+
+if __name__ == '__main__':
+    # Generate a synthetic hash list and time lookups against it:
+    #   python hash_list.py synthetic_hashes.txt 1000000
+    path = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    rng = random.Random(152)
+    hashes = [rng.getrandbits(64) for _ in range(count)]
+    with open(path, 'w') as f:
+        for h in hashes:
+            f.write(f'{h:016x}\n')
+
+    hash_list = HashList(path)
+    start = time.perf_counter()
+    hash_list.load()
+    print(f'Loaded {len(hash_list)} hashes in {time.perf_counter() - start:.2f}s')
+
+    queries = 10000
+    found = 0
+    start = time.perf_counter()
+    for i in range(queries):
+        # Half are near-duplicates of listed hashes, half are random
+        if i % 2:
+            flipped = hashes[rng.randrange(count)]
+            for bit in rng.sample(range(64), hash_list.max_distance):
+                flipped ^= 1 << bit
+            found += hash_list.match(flipped) is not None
+        else:
+            hash_list.match(rng.getrandbits(64))
+    elapsed = time.perf_counter() - start
+    print(f'{queries} lookups, {elapsed / queries * 1e6:.1f} us each, found {found}/{queries // 2} near-duplicates')
@@ -0,0 +1,140 @@
+import hashlib
+from io import BytesIO
+import numpy as np
+
+HASH_BITS = 64
+
+
+def sha256_hex(data):
+    return hashlib.sha256(data).hexdigest()
+
+def dhash(image):
+    """difference hash: 64-bit int that barely changes when an image is resized or re-encoded"""
+    from PIL import Image # Imported on first use, so the bot can start without PIL loaded
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] < pixels[row * 9 + col + 1])
+    return value
+
+def hash_image_bytes(data):
+    """raw image bytes -> (sha256 hex digest, perceptual hash)"""
+    from PIL import Image
+    return sha256_hex(data), dhash(Image.open(BytesIO(data)))
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class HammingIndex:
+    '''
+    Multi-index hashing over 64-bit hashes. Each hash is split into
+    max_distance + 1 bands and filed under each band's value; by the pigeonhole
+    principle any hash within max_distance bits of a query shares at least one
+    band exactly, so a search only compares against those few candidates.
+    '''
+    def __init__(self, max_distance=4):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self.widths = [HASH_BITS // bands + (1 if i < HASH_BITS % bands else 0) for i in range(bands)]
+        self.tables = [{} for _ in range(bands)] # band value -> set of hashes
+        self.size = 0
+
+    def _bands(self, value):
+        shift = 0
+        for width in self.widths:
+            yield (value >> shift) & ((1 << width) - 1)
+            shift += width
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, value):
+        band = next(self._bands(value))
+        return value in self.tables[0].get(band, ())
+
+    def add(self, value):
+        if value in self:
+            return
+        for table, band in zip(self.tables, self._bands(value)):
+            table.setdefault(band, set()).add(value)
+        self.size += 1
+
+    def remove(self, value):
+        if value not in self:
+            return
+        for table, band in zip(self.tables, self._bands(value)):
+            bucket = table[band]
+            bucket.discard(value)
+            if not bucket:
+                del table[band]
+        self.size -= 1
+
+    def search(self, value, max_distance=None):
+        '''Returns [(hash, distance)] within max_distance bits of value, closest first.'''
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        seen = set()
+        matches = []
+        for table, band in zip(self.tables, self._bands(value)):
+            for candidate in table.get(band, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                distance = hamming(value, candidate)
+                if distance <= max_distance:
+                    matches.append((candidate, distance))
+        matches.sort(key=lambda m: m[1])
+        return matches
+
+
+# Number of set bits in every byte value, for counting bits of many hashes at once
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class PackedHammingIndex:
+    '''
+    Read-only multi-index hashing over a numpy array of 64-bit hashes, for hash
+    lists with millions of entries. Per band it keeps the band values sorted, so
+    finding the candidates that share a band is a binary search rather than a
+    dict of Python sets (roughly 8 bytes per hash per band instead of ~100).
+    '''
+    def __init__(self, hashes, max_distance=4):
+        self.hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self.widths = [HASH_BITS // bands + (1 if i < HASH_BITS % bands else 0) for i in range(bands)]
+        self.bands = [] # (sorted band values, positions into self.hashes)
+        shift = 0
+        for width in self.widths:
+            values = (self.hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+            order = np.argsort(values, kind='stable')
+            self.bands.append((values[order], order))
+            shift += width
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, value):
+        i = np.searchsorted(self.hashes, np.uint64(value))
+        return i < len(self.hashes) and int(self.hashes[i]) == value
+
+    def search(self, value, max_distance=None):
+        '''Returns [(hash, distance)] within max_distance bits of value, closest first.'''
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+        if not len(self.hashes):
+            return []
+        positions = []
+        shift = 0
+        for width, (values, order) in zip(self.widths, self.bands):
+            band = np.uint64((value >> shift) & ((1 << width) - 1))
+            lo = np.searchsorted(values, band, 'left')
+            hi = np.searchsorted(values, band, 'right')
+            positions.append(order[lo:hi])
+            shift += width
+        candidates = self.hashes[np.unique(np.concatenate(positions))]
+        distances = _POPCOUNT[(candidates ^ np.uint64(value)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        keep = distances <= max_distance
+        matches = sorted(zip(distances[keep].tolist(), candidates[keep].tolist()))
+        return [(h, d) for d, h in matches]
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from metrics import StatsCounters, gauge, REGISTRY
+
+
+class MessageInfo:
+    '''What enforcement needs to know about a reported message, without holding the discord.Message.'''
+    __slots__ = ('guild_id', 'channel_id', 'author_id', 'phash')
+
+    def __init__(self, guild_id, channel_id, author_id, phash=None):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+        self.phash = phash # Perceptual hash of the message's image, once known
+
+
+class MessageCache:
+    '''
+    Reported and automatically flagged messages, keyed by message ID, so a
+    review that ends in a violation can delete the message and strike its
+    author without fetching it again. Holds at most max_entries messages
+    (roughly 200 bytes each) and evicts the least recently used.
+    '''
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # Map from message ID to MessageInfo
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        REGISTRY.register(StatsCounters('modbot_message_cache_total', self.stats, 'Reported message metadata lookups'))
+        gauge('modbot_message_cache_entries', 'Messages in the reported message cache', fn=self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, message_id, guild_id, channel_id, author_id, phash=None):
+        info = self.entries.get(message_id)
+        if info is None:
+            info = self.entries[message_id] = MessageInfo(guild_id, channel_id, author_id, phash)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+        else:
+            self.entries.move_to_end(message_id)
+            if phash is not None:
+                info.phash = phash
+        return info
+
+    def put_message(self, message, phash=None):
+        return self.put(message.id, message.guild.id if message.guild else None, message.channel.id, message.author.id, phash)
+
+    def get(self, message_id):
+        info = self.entries.get(message_id)
+        if info is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        self.entries.move_to_end(message_id)
+        return info
+
+    def set_phash(self, message_id, phash):
+        info = self.entries.get(message_id)
+        if info is not None:
+            info.phash = phash
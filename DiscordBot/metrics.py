@@ -0,0 +1,258 @@
+import os
+import time
+import asyncio
+import functools
+from bisect import bisect_left
+
+LATENCY_MS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+# Updates are plain Python arithmetic with no locks. Metrics touched from
+# classification threads can very occasionally lose an update under the GIL,
+# which is an acceptable trade for leaving them on all the time.
+
+
+def _label_text(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram. Observing a value is one bisect and two adds, so it
+    is cheap enough to leave on for every image and message.
+    '''
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_MS_BUCKETS, name=None, help='', labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # Last slot catches values above the top bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        '''Upper bound of the bucket holding the q-th percentile (0 < q <= 100).'''
+        if not self.count:
+            return 0.0
+        target = self.count * q / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.mean(),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+    def samples(self):
+        cumulative = 0
+        for bound, c in zip(self.buckets, self.counts):
+            cumulative += c
+            yield self.name + '_bucket' + _label_text(self.labels, {'le': bound}), cumulative
+        yield self.name + '_bucket' + _label_text(self.labels, {'le': '+Inf'}), self.count
+        yield self.name + '_sum' + _label_text(self.labels), self.sum
+        yield self.name + '_count' + _label_text(self.labels), self.count
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help='', labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + _label_text(self.labels), self.value
+
+
+class Gauge:
+    '''A value that goes up and down. If fn is given it is called at export time instead.'''
+    kind = 'gauge'
+
+    def __init__(self, name, help='', labels=None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.fn = fn
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.fn() if self.fn is not None else self.value
+
+    def samples(self):
+        yield self.name + _label_text(self.labels), self.get()
+
+
+class StatsCounters:
+    '''Exports an existing dict of event counts (e.g. ImageFetcher.stats) as one labelled counter.'''
+    kind = 'counter'
+
+    def __init__(self, name, stats, help='', label='event', labels=None):
+        self.name = name
+        self.help = help
+        self.stats = stats
+        self.label = label
+        self.labels = labels or {}
+
+    def samples(self):
+        for key, value in list(self.stats.items()):
+            yield self.name + _label_text(self.labels, {self.label: key}), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {} # (name, labels) -> metric
+
+    def register(self, metric):
+        '''Adds a metric, replacing any earlier one with the same name and labels.'''
+        self.metrics[(metric.name, tuple(sorted(metric.labels.items())))] = metric
+        return metric
+
+    def get_or_create(self, cls, name, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = self.metrics[key] = cls(name=name, labels=labels, **kwargs)
+        return metric
+
+    def render(self):
+        '''Prometheus text exposition format.'''
+        lines = []
+        described = set()
+        for (name, _), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                if metric.help:
+                    lines.append(f'# HELP {name} {metric.help}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+            for sample, value in metric.samples():
+                lines.append(f'{sample} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        result = {}
+        for (name, labels), metric in self.metrics.items():
+            key = name + _label_text(dict(labels))
+            if isinstance(metric, Histogram):
+                result[key] = metric.snapshot()
+            elif isinstance(metric, StatsCounters):
+                result[key] = dict(metric.stats)
+            else:
+                result[key] = metric.get() if isinstance(metric, Gauge) else metric.value
+        return result
+
+
+REGISTRY = Registry()
+
+def counter(name, help='', **labels):
+    return REGISTRY.get_or_create(Counter, name, labels, help=help)
+
+def gauge(name, help='', fn=None, **labels):
+    if fn is not None:
+        return REGISTRY.register(Gauge(name, help, labels, fn))
+    return REGISTRY.get_or_create(Gauge, name, labels, help=help)
+
+def histogram(name, help='', buckets=LATENCY_MS_BUCKETS, **labels):
+    return REGISTRY.get_or_create(Histogram, name, labels, help=help, buckets=buckets)
+
+
+class span:
+    '''
+    Times a stage of the pipeline into modbot_stage_ms{stage=...} and counts it
+    in modbot_in_flight{stage=...} while it runs. Works around awaits too:
+
+        with span('fetch'):
+            data = await fetcher.fetch(attachment)
+    '''
+    __slots__ = ('histogram', 'in_flight', 'start')
+    _stages = {}
+
+    def __init__(self, stage):
+        metrics = self._stages.get(stage)
+        if metrics is None:
+            metrics = self._stages[stage] = (
+                histogram('modbot_stage_ms', 'Time spent in each pipeline stage', stage=stage),
+                gauge('modbot_in_flight', 'Operations currently inside each pipeline stage', stage=stage))
+        self.histogram, self.in_flight = metrics
+
+    def __enter__(self):
+        self.in_flight.value += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe((time.perf_counter() - self.start) * 1000)
+        self.in_flight.value -= 1
+        return False
+
+
+def timed(stage):
+    '''Decorator that wraps every call of a coroutine function in span(stage).'''
+    def decorate(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with span(stage):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+async def serve(port, host='127.0.0.1', registry=REGISTRY):
+    '''Serves registry.render() at http://host:port/metrics. Returns the aiohttp runner.'''
+    from aiohttp import web
+    async def handle(request):
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+async def write_snapshots(path, interval=30, registry=REGISTRY):
+    '''Rewrites path with the current metrics every interval seconds, for hosts without a scraper.'''
+    while True:
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(registry.render())
+        os.replace(tmp, path)
+        await asyncio.sleep(interval)
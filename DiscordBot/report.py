@@ -1,6 +1,7 @@
 from enum import Enum, auto
 import discord
 import re
+from metrics import timed
 
 class State(Enum):
     REPORT_START = auto()
@@ -12,20 +13,43 @@ class State(Enum):
     AWAITING_LAST_MESSAGE= auto()
     REPORT_CANCELED = auto()
 
+# Map from the number a user replies with to the report reason and its severity; higher is reviewed sooner
+REASONS = {
+    '1': ('Hate Speech', 2),
+    '2': ('Spam', 0),
+    '3': ('Scam or Fraud', 1),
+    '4': ('Nudity or Sexual Activity', 2),
+    '5': ('Bullying or Harassment', 2),
+    '6': ('Illegal Activity', 3),
+    '7': ('Violence', 3),
+    '8': ("I just don't like it", 0),
+}
+CHILD_SEVERITY = 4 # Sexual content the reporter says involves a child
+AUTOMATIC_SEVERITY = 5 # Cases filed by the automatic filter
+
 class Report:
     START_KEYWORD = "report"
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
+    # Reports can sit half-finished for a while, so keep each one small and free of discord objects
+    __slots__ = ('state', 'client', 'reported_message_link', 'reported_time', 'contains_child', 'abuser_id',
+                 'abuser_name', 'reported_message_id', 'image_urls', 'reason', 'severity')
+
     def __init__(self, client):
         self.state = State.REPORT_START
         self.client = client
-        self.message = None
         self.reported_message_link = None
         self.reported_time = None
         self.contains_child = False
-        self.abuserID = None
+        self.abuser_id = None
+        self.abuser_name = None
+        self.reported_message_id = None
+        self.image_urls = ()
+        self.reason = None
+        self.severity = 0
         
+    @timed('report_flow')
     async def handle_message(self, message):
         '''
         This function makes up the meat of the user-side reporting flow. It defines how we transition between states and what 
@@ -59,8 +83,13 @@ class Report:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
                 message = await channel.fetch_message(int(m.group(3)))
-                self.abuserID = message.author
+                self.abuser_id = message.author.id
+                self.abuser_name = str(message.author)
                 self.reported_message_link = raw
+                self.image_urls = tuple(attachment.url for attachment in message.attachments)
+                self.reported_message_id = message.id
+                # Remember who sent it, so enforcement doesn't have to fetch the message again
+                self.client.message_cache.put(message.id, guild.id, channel.id, message.author.id)
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
             self.state = State.MESSAGE_IDENTIFIED
@@ -73,6 +102,8 @@ class Report:
         
         if self.state == State.AWAITING_COMPLAINT:
             m = message.content
+            if m in REASONS:
+                self.reason, self.severity = REASONS[m]
             if m == '1' or m == '2' or m == '3' or m == '5' or m == '6' or m == '7' or m == '8':
                 self.state = State.REPORT_COMPLETE
                 return ["Thank you for your report. We appreciate your feedback."]
@@ -95,7 +126,7 @@ class Report:
             self.state = State.REPORT_COMPLETE
             reply = ""
             if m == '1':
-                reply += str(self.abuserID) + " has been succesfully blocked."
+                reply += self.abuser_name + " has been succesfully blocked."
             elif m == '2':
                 reply += 'Sure! You can read up on our community guidelines here: https://docs.google.com/document/d/1Zv5NfIxcxeTJVEKC65LWJACgUGRRIYd58iwygyfLcLU/edit?usp=sharing'
             else:
@@ -120,7 +151,19 @@ class Report:
         return self.contains_child
     
     def get_abuser_id(self):
-        return self.abuserID
+        return self.abuser_id
+
+    def get_message_id(self):
+        return self.reported_message_id
+
+    def get_image_urls(self):
+        return self.image_urls
+
+    def get_reason(self):
+        return self.reason
+
+    def get_severity(self):
+        return CHILD_SEVERITY if self.contains_child else self.severity
 
     
 
@@ -0,0 +1,297 @@
+import re
+import sys
+import time
+import queue
+import random
+import sqlite3
+import logging
+import threading
+from collections import namedtuple
+from metrics import Histogram, SIZE_BUCKETS, REGISTRY, gauge
+
+logger = logging.getLogger(__name__)
+
+OPEN = 'open'
+CLOSED = 'closed'
+
+# Outcomes recorded when a case is closed
+REMOVED = 'removed'
+FURTHER_REVIEW = 'further_review'
+
+Case = namedtuple('Case', ['number', 'reporter_id', 'reporter', 'automatic', 'reported_user_id', 'time_filed',
+                           'filed_at', 'link', 'contains_child', 'reason', 'severity', 'phash'])
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cases (
+    number INTEGER PRIMARY KEY,
+    reporter_id INTEGER,
+    reporter TEXT NOT NULL,
+    automatic INTEGER NOT NULL,
+    reported_user_id INTEGER,
+    time_filed TEXT NOT NULL,
+    filed_at REAL NOT NULL,
+    link TEXT NOT NULL,
+    contains_child INTEGER NOT NULL,
+    reason TEXT,
+    severity INTEGER NOT NULL,
+    phash TEXT,
+    status TEXT NOT NULL,
+    outcome TEXT,
+    reviewer_id INTEGER,
+    closed_at REAL
+);
+CREATE INDEX IF NOT EXISTS cases_status ON cases (status, severity, number);
+CREATE INDEX IF NOT EXISTS cases_severity ON cases (severity, number);
+CREATE INDEX IF NOT EXISTS cases_reported_user ON cases (reported_user_id, number);
+CREATE INDEX IF NOT EXISTS cases_reporter ON cases (reporter_id, number);
+CREATE INDEX IF NOT EXISTS cases_filed_at ON cases (filed_at);
+CREATE INDEX IF NOT EXISTS cases_link ON cases (link);
+CREATE TABLE IF NOT EXISTS strikes (
+    user_id INTEGER PRIMARY KEY,
+    strikes INTEGER NOT NULL,
+    last_case INTEGER,
+    updated_at REAL NOT NULL
+);
+'''
+
+CASE_COLUMNS = ', '.join(Case._fields)
+
+MESSAGE_LINK = 'https://discord.com/channels/{}/{}/{}'
+# Rows whose link is anything but MESSAGE_LINK with numeric IDs (from before links were normalised)
+NON_CANONICAL_LINKS = "SELECT number, link FROM cases WHERE link NOT GLOB 'https://discord.com/channels/*' OR substr(link, 30) GLOB '*[^0-9/]*'"
+UPDATE_LINK = 'UPDATE cases SET link = ? WHERE number = ?'
+
+INSERT_CASE = f'INSERT INTO cases ({CASE_COLUMNS}, status) VALUES ({", ".join("?" * (len(Case._fields) + 1))})'
+UPDATE_PHASH = 'UPDATE cases SET phash = ? WHERE number = ?'
+CLOSE_CASE = 'UPDATE cases SET status = ?, outcome = ?, reviewer_id = ?, closed_at = ? WHERE number = ?'
+ADD_STRIKE = '''INSERT INTO strikes (user_id, strikes, last_case, updated_at) VALUES (?, 1, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET strikes = strikes + 1, last_case = excluded.last_case,
+                updated_at = excluded.updated_at'''
+
+
+def canonical_link(link):
+    '''
+    The discord.com form of a message link, whatever the reporter pasted
+    (ptb./canary. hosts, surrounding text or whitespace), so one message
+    always has the same link. Text without a guild/channel/message path is
+    returned stripped.
+    '''
+    m = re.search(r'/(\d+)/(\d+)/(\d+)', link)
+    return MESSAGE_LINK.format(*m.groups()) if m else link.strip()
+
+
+def _row_to_case(row):
+    case = Case(*row[:len(Case._fields)])
+    return case._replace(automatic=bool(case.automatic), contains_child=bool(case.contains_child),
+                         phash=int(case.phash, 16) if case.phash is not None else None)
+
+
+class ReportStore:
+    '''
+    Every case the bot has filed, kept in SQLite (WAL mode) so open cases and
+    strikes survive a restart and old cases can be searched.
+
+    Open cases and the set of users with a strike are mirrored in memory, so
+    the report and review flows never wait on the database. Writes are queued
+    and a single writer thread commits them in batches, one transaction per
+    batch, off the event loop.
+    '''
+    def __init__(self, path, max_batch=256, flush_ms=50):
+        self.path = path
+        self.max_batch = max_batch
+        self.flush_interval = flush_ms / 1000
+        self.open = {} # Map from case number to Case for every unreviewed case, oldest first
+        self.strikes = set() # IDs of users who have already received a warning
+        self.last_number = 0
+        self.writes = queue.Queue() # (sql, params), or None to stop the writer
+        self.writer = None
+        self.reader = None
+        self.read_lock = threading.Lock()
+        self.batch_size = REGISTRY.register(Histogram(SIZE_BUCKETS + (256, 512), 'modbot_report_store_batch_size',
+                                                      'Writes committed per report store transaction'))
+        gauge('modbot_report_store_pending_writes', 'Report store writes waiting to be committed', fn=self.writes.qsize)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL') # WAL keeps this crash-safe; only the last commits can be lost on power failure
+        return conn
+
+    def load(self):
+        '''Creates the tables if needed, reads back open cases and strikes, and starts the writer.'''
+        start = time.perf_counter()
+        self.reader = self._connect()
+        self.reader.executescript(SCHEMA)
+        with self.reader:
+            relinked = [(canonical_link(link), number) for number, link in self.reader.execute(NON_CANONICAL_LINKS)
+                        if canonical_link(link) != link]
+            self.reader.executemany(UPDATE_LINK, relinked)
+        if relinked:
+            logger.info('Normalised the links of %d cases', len(relinked))
+        rows = self.reader.execute(f'SELECT {CASE_COLUMNS} FROM cases WHERE status = ? ORDER BY number', (OPEN,))
+        self.open = {case.number: case for case in map(_row_to_case, rows)}
+        self.strikes = {user_id for user_id, in self.reader.execute('SELECT user_id FROM strikes')}
+        self.last_number = self.reader.execute('SELECT COALESCE(MAX(number), 0) FROM cases').fetchone()[0]
+        self.writer = threading.Thread(target=self._write_loop, name='report-store', daemon=True)
+        self.writer.start()
+        logger.info('Loaded %d open cases and %d strikes from %s in %.2fs',
+                    len(self.open), len(self.strikes), self.path, time.perf_counter() - start)
+
+    def __len__(self):
+        return len(self.open)
+
+    def __contains__(self, number):
+        return number in self.open
+
+    def get(self, number):
+        '''The open case with this number, or None if it is closed or doesn't exist.'''
+        return self.open.get(number)
+
+    def open_cases(self):
+        return list(self.open.values())
+
+    def file(self, reporter_id, reporter, automatic, reported_user_id, time_filed, filed_at, link,
+             contains_child, reason, severity, phash=None):
+        '''Opens a new case and returns it. The row is written in the background.'''
+        link = canonical_link(link)
+        self.last_number += 1
+        case = Case(self.last_number, reporter_id, reporter, automatic, reported_user_id, time_filed,
+                    filed_at, link, contains_child, reason, severity, phash)
+        self.open[case.number] = case
+        self.writes.put((INSERT_CASE, case._replace(phash=self._hex(phash)) + (OPEN,)))
+        return case
+
+    def set_phash(self, number, phash):
+        case = self.open.get(number)
+        if case is None:
+            return
+        self.open[number] = case._replace(phash=phash)
+        self.writes.put((UPDATE_PHASH, (self._hex(phash), number)))
+
+    def close_case(self, number, outcome, reviewer_id=None):
+        '''Removes a case from the open set and records how it was resolved.'''
+        case = self.open.pop(number, None)
+        if case is not None:
+            self.writes.put((CLOSE_CASE, (CLOSED, outcome, reviewer_id, time.time(), number)))
+        return case
+
+    def has_strike(self, user_id):
+        return user_id in self.strikes
+
+    def add_strike(self, user_id, case_number=None):
+        self.strikes.add(user_id)
+        self.writes.put((ADD_STRIKE, (user_id, case_number, time.time())))
+
+    def find(self, status=None, severity=None, min_severity=None, reported_user_id=None, reporter_id=None,
+             automatic=None, contains_child=None, since=None, until=None, link=None, before=None, limit=50):
+        '''
+        Searches all cases, open and closed, newest first. Every filter except
+        automatic and contains_child can be answered from an index. Pass the
+        number of the last case of one page as before to get the next page.
+        link matches any form of the same message link (see canonical_link).
+
+        This waits for queued writes and reads the database, so call it from
+        an executor rather than the event loop.
+        '''
+        clauses, params = [], []
+        link = canonical_link(link) if link is not None else None
+        for column, op, value in (('status', '=', status), ('severity', '=', severity),
+                                  ('severity', '>=', min_severity), ('reported_user_id', '=', reported_user_id),
+                                  ('reporter_id', '=', reporter_id), ('automatic', '=', automatic),
+                                  ('contains_child', '=', contains_child), ('filed_at', '>=', since),
+                                  ('filed_at', '<', until), ('link', '=', link), ('number', '<', before)):
+            if value is not None:
+                clauses.append(f'{column} {op} ?')
+                params.append(int(value) if isinstance(value, bool) else value)
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        self.flush()
+        with self.read_lock:
+            rows = self.reader.execute(f'SELECT {CASE_COLUMNS} FROM cases{where} ORDER BY number DESC LIMIT ?',
+                                       params + [limit]).fetchall()
+        return [_row_to_case(row) for row in rows]
+
+    def lookup(self, number):
+        '''Any case by number, including closed ones. Blocks like find().'''
+        cases = self.find(before=number + 1, limit=1)
+        return cases[0] if cases and cases[0].number == number else None
+
+    def flush(self):
+        '''Blocks until every queued write has been committed.'''
+        if self.writer is not None:
+            self.writes.join()
+
+    def close(self):
+        if self.writer is not None:
+            self.writes.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+    def _write_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Keep collecting for a moment so a burst of reports is one transaction
+            while batch[-1] is not None and len(batch) < self.max_batch:
+                try:
+                    batch.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            running = batch[-1] is not None
+            statements = [w for w in batch if w is not None]
+            try:
+                with conn:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+            except sqlite3.Error:
+                logger.exception('Could not write %d report store changes', len(statements))
+            if statements:
+                self.batch_size.observe(len(statements))
+            for _ in batch:
+                self.writes.task_done()
+        conn.close()
+
+    @staticmethod
+    def _hex(phash):
+        # Perceptual hashes are unsigned 64-bit, which doesn't fit SQLite's signed INTEGER
+        return f'{phash:016x}' if phash is not None else None
+
+
+if __name__ == '__main__':
+    # Fill a store with synthetic history and time indexed searches against it:
+    #   python report_store.py synthetic_reports.db 300000
+    path = sys.argv[1]
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 300000
+    rng = random.Random(152)
+    store = ReportStore(path, max_batch=5000)
+    store.load()
+    start = time.perf_counter()
+    now = time.time()
+    for i in range(count):
+        automatic = rng.random() < 0.2
+        case = store.file(None if automatic else rng.randrange(1000), 'Automatic Filter' if automatic else 'reporter',
+                          automatic, rng.randrange(50000), 'synthetic', now - (count - i) * 30,
+                          'https://discord.com/channels/1/2/3', automatic or rng.random() < 0.1,
+                          None, rng.randrange(6))
+        if rng.random() < 0.99:
+            store.close_case(case.number, REMOVED)
+    store.flush()
+    print(f'Filed {count} cases in {time.perf_counter() - start:.2f}s, {len(store)} open')
+
+    queries = {
+        'open, severity >= 4': dict(status=OPEN, min_severity=4),
+        'by reported user': dict(reported_user_id=1234),
+        'by reporter': dict(reporter_id=42),
+        'last hour': dict(since=now - 3600),
+        'case by number': None,
+    }
+    for name, query in queries.items():
+        start = time.perf_counter()
+        for _ in range(1000):
+            found = store.find(**query) if query is not None else [store.lookup(rng.randrange(1, count + 1))]
+        print(f'{name}: {(time.perf_counter() - start):.3f} ms per query, {len(found)} results') # 1000 queries
+    store.close()
@@ -1,6 +1,7 @@
 from enum import Enum, auto
 import discord
 import re
+from metrics import timed
 
 class State(Enum):
     REVIEW_START = auto()
@@ -13,44 +14,58 @@ class State(Enum):
 
 class Review:
     START_KEYWORD = "review"
+    NEXT_KEYWORD = "review next"
     LIST_KEYWORD = 'list'
     CANCEL_KEYWORD = "cancel"
     HELP_KEYWORD = "help"
 
-    def __init__(self, client, reports_list):
+    __slots__ = ('state', 'client', 'curr_report_num', 'report_store', 'link')
+
+    def __init__(self, client, report_store):
         self.state = State.REVIEW_START
         self.client = client
         self.curr_report_num = None
-        self.reports_list = reports_list
+        self.report_store = report_store
         self.link = None 
         
+    @timed('review_flow')
     async def handle_message(self, message):
 
         if message.content == self.CANCEL_KEYWORD:
             self.state = State.REVIEW_CANCLED
             return ["Review cancelled."]
+
+        # Every reply keeps the moderator's claim on the case alive
+        if self.curr_report_num is not None and not self.client.review_queue.renew(self.curr_report_num, message.author.id):
+            self.state = State.REVIEW_CANCLED
+            return ["Your review of case #" + str(self.curr_report_num) + " timed out and the case was returned to the queue. Use `review next` to pick up a case."]
         
         if self.state == State.REVIEW_START:
+            if message.content == self.NEXT_KEYWORD:
+                report_num = self.client.review_queue.claim_next(message.author.id)
+                if report_num is None:
+                    self.state = State.REVIEW_CANCLED
+                    return ["There are no unreviewed reports waiting for a moderator."]
+                return self.open_case(report_num)
             reply = "Please enter a report number:"
             self.state = State.AWAITING_REPORT_NUM
             return [reply]
         
         if self.state == State.AWAITING_REPORT_NUM:
             m = message.content
-            if int(m) not in self.reports_list:
+            if int(m) not in self.report_store:
                 return ["Sorry, that is not a valid report case number. Use the `list` command to view all unreviewed reports."]
+            elif not self.client.review_queue.claim(int(m), message.author.id):
+                return ["Case #" + m + " is already being reviewed by another moderator. Use `review next` to take the next waiting case."]
             else:
-                # print report details
-                self.state = State.CONFIRMING_HASH
-                self.curr_report_num = int(m)
-                self.link = self.reports_list[self.curr_report_num][2]
-                return ["Please hash check the reported image with the NCMEC database. Is the reported image already in the database? Y/N"]
+                return self.open_case(int(m))
         
         if self.state == State.CONFIRMING_HASH:
             m = message.content.strip().lower()
             if m == 'y' or m == 'yes':
                 self.state = State.REVIEW_COMPLETE 
-                return ["The image has been removed from the platform and sent to NCMEC in accordance to our guidelines. Thank you for reviewing this report."]
+                self.client.add_known_hash(self.curr_report_num)
+                return ["The image will be removed from the platform and sent to NCMEC in accordance to our guidelines. Thank you for reviewing this report."]
             elif m == 'n' or m =='no':
                 self.state = State.CONFIRMING_CSAM
                 reply = "Open " + self.link + " to view the reported image. Does the image contain child sexual abuse material? Y/N"
@@ -62,7 +77,8 @@ class Review:
             m = message.content.strip().lower()
             if m == 'y' or m == 'yes':
                 self.state = State.REVIEW_COMPLETE 
-                return ["The image has been removed from the platform and sent to NCMEC in accordance to our guidelines. Thank you for reviewing this report."]
+                self.client.add_known_hash(self.curr_report_num)
+                return ["The image will be removed from the platform and sent to NCMEC in accordance to our guidelines. Thank you for reviewing this report."]
             elif m == 'n' or m =='no':
                 self.state = State.FURTHER_REVIEW
                 return ["The reported image does not contain CSAM. The material will require further review."]
@@ -71,6 +87,20 @@ class Review:
             
         return []
 
+    def open_case(self, report_num):
+        # print report details
+        self.state = State.CONFIRMING_HASH
+        self.curr_report_num = report_num
+        case = self.report_store.get(report_num)
+        self.link = case.link
+        match = self.client.known_hash_match(self.curr_report_num)
+        if match:
+            self.state = State.REVIEW_COMPLETE
+            return ["The reported image matches the known CSAM hash list (" + str(match[1]) + " bits apart), so no manual check is needed. The image will be removed from the platform and sent to NCMEC in accordance to our guidelines. Thank you for reviewing this report."]
+        reply = "Reviewing case #" + str(report_num) + " (reported " + case.time_filed + ", reason: " + str(case.reason or "automatic filter") + ").\n"
+        reply += "Please hash check the reported image with the NCMEC database. Is the reported image already in the database? Y/N"
+        return [reply]
+
     def case_closed(self):
         return self.state == State.REVIEW_COMPLETE or self.state == State.FURTHER_REVIEW or self.state == State.REVIEW_CANCLED
     
@@ -0,0 +1,155 @@
+import time
+import heapq
+import logging
+from metrics import Histogram, REGISTRY, counter, gauge
+
+logger = logging.getLogger(__name__)
+
+# Seconds from a case being filed to a moderator first opening it
+WAIT_SECONDS_BUCKETS = (10, 30, 60, 300, 900, 1800, 3600, 4 * 3600, 12 * 3600, 24 * 3600, 72 * 3600)
+
+
+class ReviewScheduler:
+    '''
+    Decides which case a moderator should review next: highest severity first
+    (automatic filter hits, then child-flagged reports, then by report reason),
+    oldest first within a severity.
+
+    A moderator claims a case by taking a lease on it. Nobody else can open a
+    leased case, and if the moderator goes quiet for lease_seconds the lease
+    expires and the case goes back in the queue.
+
+    Both the queue and the leases are heaps with lazy deletion: removing an
+    entry only forgets it in a dict, and stale heap entries are skipped when
+    they reach the top. Enqueue, claim and expiry are all O(log n).
+    '''
+    def __init__(self, lease_seconds=15 * 60):
+        self.lease_seconds = lease_seconds
+        self.heap = [] # (-severity, filed_at, case number)
+        self.queued = {} # Map from case number to its live heap entry
+        self.leases = {} # Map from case number to (moderator ID, expires)
+        self.lease_heap = [] # (expires, case number)
+        self.leased_entries = {} # Map from leased case number to its queue entry, to requeue it if the lease ends
+        self.filed_at = {} # Map from case number to filing time, for cases not yet opened by anyone
+        self.time_to_first_review = {}
+        self.expired = counter('modbot_review_leases_expired_total', 'Review leases that ran out before the case was closed')
+        gauge('modbot_review_queue_depth', 'Cases waiting for a moderator', fn=self.__len__)
+        gauge('modbot_review_leases', 'Cases a moderator is reviewing', fn=lambda: len(self.leases))
+
+    def __len__(self):
+        return len(self.queued)
+
+    def enqueue(self, case):
+        if case.number in self.queued or case.number in self.leases:
+            return
+        entry = (-case.severity, case.filed_at, case.number)
+        self.queued[case.number] = entry
+        self.filed_at.setdefault(case.number, case.filed_at)
+        heapq.heappush(self.heap, entry)
+
+    def _requeue(self, number, entry):
+        self.queued[number] = entry
+        heapq.heappush(self.heap, entry)
+
+    def claim_next(self, moderator_id, now=None):
+        '''Leases the most urgent waiting case to the moderator and returns its number, or None.'''
+        now = time.time() if now is None else now
+        self.expire(now)
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            number = entry[2]
+            if self.queued.get(number) is entry:
+                self._lease(number, moderator_id, now)
+                return number
+        return None
+
+    def claim(self, number, moderator_id, now=None):
+        '''
+        Leases a specific case to the moderator. Returns False if another
+        moderator holds an unexpired lease on it.
+        '''
+        now = time.time() if now is None else now
+        self.expire(now)
+        holder = self.leases.get(number)
+        if holder is not None and holder[0] != moderator_id:
+            return False
+        self._lease(number, moderator_id, now)
+        return True
+
+    def renew(self, number, moderator_id, now=None):
+        '''Extends the moderator's lease. Returns False if it has expired or belongs to someone else.'''
+        now = time.time() if now is None else now
+        self.expire(now)
+        holder = self.leases.get(number)
+        if holder is None or holder[0] != moderator_id:
+            return False
+        self._lease(number, moderator_id, now)
+        return True
+
+    def release(self, number, moderator_id=None):
+        '''
+        The moderator gave up the case without closing it; put it back in the
+        queue. Does nothing if moderator_id is given and no longer holds the lease.
+        '''
+        holder = self.leases.get(number)
+        if holder is None or (moderator_id is not None and holder[0] != moderator_id):
+            return
+        del self.leases[number]
+        entry = self.leased_entries.pop(number, None)
+        if entry is not None:
+            self._requeue(number, entry)
+
+    def complete(self, number):
+        '''The case was closed; forget it entirely.'''
+        self.leases.pop(number, None)
+        self.queued.pop(number, None)
+        self.leased_entries.pop(number, None)
+        self.filed_at.pop(number, None)
+
+    def expire(self, now=None):
+        '''Returns every case whose lease has run out to the queue. Returns how many there were.'''
+        now = time.time() if now is None else now
+        expired = 0
+        while self.lease_heap and self.lease_heap[0][0] <= now:
+            expires, number = heapq.heappop(self.lease_heap)
+            holder = self.leases.get(number)
+            if holder is None or holder[1] != expires:
+                continue # Renewed or already closed since this entry was pushed
+            logger.info('Lease on case #%d held by %s expired, returning it to the queue', number, holder[0])
+            self.expired.inc()
+            self.release(number)
+            expired += 1
+        return expired
+
+    def _lease(self, number, moderator_id, now):
+        entry = self.queued.pop(number, None)
+        if entry is not None:
+            self.leased_entries[number] = entry
+        filed_at = self.filed_at.pop(number, None)
+        if filed_at is not None:
+            self._first_review(number, now - filed_at)
+        expires = now + self.lease_seconds
+        self.leases[number] = (moderator_id, expires)
+        heapq.heappush(self.lease_heap, (expires, number))
+        if len(self.heap) > 64 and len(self.heap) > 2 * len(self.queued):
+            # Mostly stale entries; rebuild so the heap doesn't grow with every claim
+            self.heap = list(self.queued.values())
+            heapq.heapify(self.heap)
+
+    def _first_review(self, number, waited):
+        entry = self.leased_entries.get(number)
+        severity = -entry[0] if entry is not None else 'unknown'
+        histogram = self.time_to_first_review.get(severity)
+        if histogram is None:
+            histogram = self.time_to_first_review[severity] = REGISTRY.register(Histogram(
+                WAIT_SECONDS_BUCKETS, 'modbot_time_to_first_review_seconds',
+                'Time from a case being filed to a moderator opening it', {'severity': severity}))
+        histogram.observe(max(0.0, waited))
+
+    def stats(self):
+        self.expire()
+        return {
+            'queued': len(self.queued),
+            'leased': len(self.leases),
+            'time_to_first_review': {severity: h.snapshot() for severity, h in self.time_to_first_review.items()},
+        }
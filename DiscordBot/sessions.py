@@ -0,0 +1,94 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from metrics import StatsCounters, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    '''
+    In-progress Report or Review flows, keyed by user ID. Drop-in for the
+    plain dicts the bot used to keep (in, [], [] =, pop, len).
+
+    Sessions are kept in order of last activity, so expiring the ones idle
+    for more than ttl seconds only looks at the oldest few, and when more
+    than max_sessions are open the least recently active one is dropped.
+    on_end(user_id, session) is called for every session that is expired or
+    evicted (not for ones popped by the bot when a flow finishes).
+    '''
+    def __init__(self, name, ttl=30 * 60, max_sessions=50000, on_end=None):
+        self.name = name
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.on_end = on_end
+        self.sessions = OrderedDict() # Map from user ID to (session, time of last activity), least recent first
+        self.stats = {'started': 0, 'finished': 0, 'expired': 0, 'evicted': 0}
+        REGISTRY.register(StatsCounters('modbot_sessions_total', self.stats, 'Report and review sessions by outcome',
+                                        label='outcome', labels={'flow': name}))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __getitem__(self, user_id):
+        # Every access counts as activity
+        session, _ = self.sessions[user_id]
+        self.sessions[user_id] = (session, time.monotonic())
+        self.sessions.move_to_end(user_id)
+        return session
+
+    def __setitem__(self, user_id, session):
+        if user_id not in self.sessions:
+            self.stats['started'] += 1
+        self.sessions[user_id] = (session, time.monotonic())
+        self.sessions.move_to_end(user_id)
+        while len(self.sessions) > self.max_sessions:
+            self._end(*self.sessions.popitem(last=False), 'evicted')
+
+    def pop(self, user_id, default=None):
+        entry = self.sessions.pop(user_id, None)
+        if entry is None:
+            return default
+        self.stats['finished'] += 1
+        return entry[0]
+
+    def expire(self, now=None):
+        '''Ends every session idle for longer than ttl. Returns how many were ended.'''
+        cutoff = (time.monotonic() if now is None else now) - self.ttl
+        expired = 0
+        while self.sessions:
+            user_id, (session, last_seen) = next(iter(self.sessions.items()))
+            if last_seen > cutoff:
+                break
+            del self.sessions[user_id]
+            self._end(user_id, (session, last_seen), 'expired')
+            expired += 1
+        return expired
+
+    def _end(self, user_id, entry, reason):
+        self.stats[reason] += 1
+        if self.on_end is not None:
+            try:
+                self.on_end(user_id, entry[0])
+            except Exception:
+                logger.exception('Cleaning up %s session for %s failed', self.name, user_id)
+
+    def counts(self):
+        return {'live': len(self.sessions), 'expired': self.stats['expired'], 'evicted': self.stats['evicted']}
+
+
+async def sweep(stores, interval=60):
+    '''
+    Calls expire() on each store every interval seconds: idle sessions in a
+    SessionStore, and run-out leases in a ReviewScheduler (which logs its own).
+    '''
+    while True:
+        await asyncio.sleep(interval)
+        for store in stores:
+            expired = store.expire()
+            if expired and isinstance(store, SessionStore):
+                logger.info('Expired %d idle %s sessions', expired, store.name)
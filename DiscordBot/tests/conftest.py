@@ -0,0 +1,43 @@
+import os
+import sys
+import pytest
+
+# The bot's modules are flat files in DiscordBot/, imported by name as bot.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def bot_module(tmp_path_factory):
+    '''bot.py, imported from a scratch directory so its discord.log isn't written into the checkout.'''
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('bot'))
+    try:
+        import bot
+    finally:
+        os.chdir(cwd)
+    return bot
+
+
+@pytest.fixture
+def write_weights(tmp_path):
+    '''
+    Returns write(name, arch, seed) -> path of a randomly initialised model
+    with the notebook's 3-class head, saved like tensor.pt. mobilenet_v3_small
+    by default, which is small enough to build many times in a test run.
+    '''
+    torch = pytest.importorskip('torch')
+    from torch import nn
+    from torchvision import models
+    import backends
+
+    def write(name='tensor.pt', arch='mobilenet_v3_small', seed=0):
+        torch.manual_seed(seed)
+        model = getattr(models, arch)()
+        if arch.startswith('resnet'):
+            model.fc = nn.Linear(model.fc.in_features, backends.NUM_CLASSES)
+        else:
+            model.classifier[-1] = nn.Linear(model.classifier[-1].in_features, backends.NUM_CLASSES)
+        path = str(tmp_path / name)
+        torch.save(model.state_dict(), path)
+        return path
+    return write
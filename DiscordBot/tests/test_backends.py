@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+import backends
+
+
+@pytest.fixture
+def batch():
+    torch.manual_seed(1)
+    return torch.randn(4, *backends.INPUT_SHAPE)
+
+
+@pytest.fixture
+def reference(write_weights, batch):
+    weights = write_weights()
+    with torch.no_grad():
+        return weights, backends.build(backends.EAGER, weights, 'mobilenet_v3_small')(batch)
+
+
+@pytest.mark.parametrize('backend, atol', [
+    (backends.CHANNELS_LAST, 1e-4),
+    (backends.TORCHSCRIPT, 1e-4),
+    (backends.DYNAMIC_INT8_HEAD, 5e-2), # int8 weights in the head only
+])
+def test_backend_matches_eager(reference, batch, backend, atol):
+    weights, expected = reference
+    model = backends.build(backend, weights, 'mobilenet_v3_small')
+    with torch.no_grad():
+        logits = model(batch)
+    assert logits.shape == (4, backends.NUM_CLASSES)
+    assert torch.allclose(logits, expected, atol=atol)
+    assert torch.equal(logits.argmax(dim=1), expected.argmax(dim=1))
+
+
+def test_onnx_matches_eager(reference, batch):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    weights, expected = reference
+    model = backends.build(backends.ONNX, weights, 'mobilenet_v3_small')
+    assert torch.allclose(model(batch), expected, atol=1e-3)
+    assert backends.model_bytes(model) > 0
+    # The export is reused while it is newer than the weights
+    assert backends.export_onnx(weights, 'mobilenet_v3_small') == model.path
+
+
+def test_model_bytes(reference):
+    weights, _ = reference
+    eager = backends.build(backends.EAGER, weights, 'mobilenet_v3_small')
+    fp32 = sum(p.numel() * p.element_size() for p in eager.state_dict().values())
+    assert backends.model_bytes(eager) == fp32
+    assert backends.model_bytes(backends.build(backends.CHANNELS_LAST, weights, 'mobilenet_v3_small')) == fp32
+    # The int8 head packs its weights, so it's smaller than fp32 but not empty
+    assert 0 < backends.model_bytes(backends.build(backends.DYNAMIC_INT8_HEAD, weights, 'mobilenet_v3_small')) < fp32
+
+
+def test_build_rejects_bad_arguments(reference):
+    weights, _ = reference
+    with pytest.raises(ValueError):
+        backends.build('tensorrt', weights)
+    with pytest.raises(ValueError):
+        backends.build(backends.STATIC_INT8, weights, 'mobilenet_v3_small')
+    with pytest.raises(ValueError):
+        backends.load_model(weights, 'vgg16')
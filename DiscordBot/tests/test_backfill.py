@@ -0,0 +1,142 @@
+import asyncio
+from backfill import Backfill
+from fakes import FakeAttachment, FakeGuild, FakeUser
+
+
+class StubService:
+    '''Stands in for ClassificationService: labels every attachment hit if its URL says so.'''
+    def __init__(self, ready=True, accept=True, fail=()):
+        self.ready = ready
+        self.accept = accept
+        self.fail = set(fail) # IDs of messages whose classification raises
+        self.backlog = []
+        self.submitted = []
+
+    def depth(self):
+        return 0
+
+    async def submit(self, message, attachments, done=None):
+        if not self.accept:
+            return False
+        self.submitted.append(message.id)
+        if message.id in self.fail:
+            done.set_exception(RuntimeError('could not decode'))
+            return True
+        done.set_result(['hit' if 'hit' in a.url else 'ok' for a in attachments])
+        return True
+
+
+def make_channel(count):
+    channel = FakeGuild('guild').add_channel('general')
+    user = FakeUser('user')
+    for i in range(count):
+        name = 'hit' if i % 4 == 0 else 'ok'
+        attachments = [FakeAttachment(f'https://cdn.example/{name}{i}.jpg')] if i % 2 == 0 else []
+        channel.post(f'message {i}', user, attachments)
+    return channel
+
+
+def make_backfill(service, results, path=None, version='v1'):
+    async def on_result(message, attachments, verdicts):
+        results.append((message.id, verdicts))
+    return Backfill(service, on_result, lambda: version, lambda verdict: verdict == 'hit', checkpoint_path=path,
+                    page_size=3, poll_seconds=0.001)
+
+
+def test_scans_history_oldest_first_and_checkpoints(tmp_path):
+    path = str(tmp_path / 'backfill.json')
+    channel = make_channel(10)
+    with_images = [m.id for m in channel.messages.values() if m.attachments]
+    service, results = StubService(), []
+
+    async def run():
+        backfill = make_backfill(service, results, path)
+        backfill.start([channel])
+        await backfill.wait()
+        return backfill
+    backfill = asyncio.run(run())
+    assert service.submitted == with_images
+    assert [message_id for message_id, _ in results] == with_images
+    assert backfill.stats['messages'] == 10
+    assert backfill.stats['images'] == 5
+    assert backfill.stats['hits'] == 3
+    assert backfill.stats['channels_done'] == 1
+    assert backfill.checkpoints[str(channel.id)] == {'last': max(channel.messages), 'weights': 'v1'}
+
+    # A restart with the same weights only scans what was posted since
+    channel.post('new', FakeUser('user'), [FakeAttachment('https://cdn.example/new.jpg')])
+    service, results = StubService(), []
+
+    async def resume(version):
+        backfill = make_backfill(service, results, path, version)
+        backfill.load()
+        backfill.start([channel])
+        await backfill.wait()
+    asyncio.run(resume('v1'))
+    assert service.submitted == [max(channel.messages)]
+
+    # New weights scan the whole channel again
+    service, results = StubService(), []
+    asyncio.run(resume('v2'))
+    assert len(service.submitted) == 6
+
+
+def test_waits_for_the_model_and_counts_skipped_images():
+    channel = make_channel(4)
+    service, results = StubService(ready=False), []
+
+    async def run():
+        backfill = make_backfill(service, results)
+        backfill.start([channel])
+        await asyncio.sleep(0.02)
+        assert service.submitted == []
+        service.ready = True
+        service.accept = False
+        await backfill.wait()
+        return backfill
+    backfill = asyncio.run(run())
+    assert backfill.stats['skipped'] == 2
+    assert results == []
+
+
+def test_failed_messages_are_retried_by_the_next_scan(tmp_path):
+    path = str(tmp_path / 'backfill.json')
+    channel = make_channel(10)
+    with_images = [m.id for m in channel.messages.values() if m.attachments]
+    ids = list(channel.messages)
+    failing = with_images[2] # The 5th message, on the second page
+
+    async def scan(service, results):
+        backfill = make_backfill(service, results, path)
+        backfill.load()
+        backfill.start([channel])
+        await backfill.wait()
+        return backfill
+    service, results = StubService(fail=[failing]), []
+    backfill = asyncio.run(scan(service, results))
+    assert backfill.stats['failed'] == 1
+    assert backfill.stats['channels_done'] == 0
+    assert backfill.stats['channels_failed'] == 1
+    assert backfill.checkpoints[str(channel.id)]['last'] == ids[ids.index(failing) - 1]
+    assert service.submitted == with_images[:3] # Stops after the page with the failure
+
+    service, results = StubService(), []
+    backfill = asyncio.run(scan(service, results))
+    assert service.submitted == with_images[2:]
+    assert backfill.stats['channels_done'] == 1
+    assert backfill.checkpoints[str(channel.id)]['last'] == ids[-1]
+
+
+def test_failure_on_the_first_message_keeps_the_old_checkpoint(tmp_path):
+    path = str(tmp_path / 'backfill.json')
+    channel = make_channel(4)
+    first = min(channel.messages)
+
+    async def run():
+        backfill = make_backfill(StubService(fail=[first]), [], path)
+        backfill.start([channel])
+        await backfill.wait()
+        return backfill
+    backfill = asyncio.run(run())
+    assert str(channel.id) not in backfill.checkpoints
+    assert backfill.stats['channels_done'] == 0
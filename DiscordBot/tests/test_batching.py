@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from batching import MicroBatcher
+
+
+class Recorder:
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, tensors):
+        with self.lock:
+            self.batches.append(list(tensors))
+        if self.fail:
+            raise RuntimeError('out of memory')
+        return [t * 10 for t in tensors]
+
+
+def test_full_batch_runs_without_waiting():
+    async def run():
+        infer = Recorder()
+        batcher = MicroBatcher(infer, max_batch=4, max_wait_ms=10000)
+        results = await asyncio.wait_for(asyncio.gather(*(batcher.submit(i) for i in range(8))), 5)
+        batcher.close()
+        return infer, results
+    infer, results = asyncio.run(run())
+    assert results == [i * 10 for i in range(8)] # Each caller gets its own result
+    assert infer.batches == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+
+def test_partial_batch_runs_after_max_wait():
+    async def run():
+        infer = Recorder()
+        batcher = MicroBatcher(infer, max_batch=16, max_wait_ms=20)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = asyncio.ensure_future(batcher.submit(1))
+        await asyncio.sleep(0.005)
+        second = asyncio.ensure_future(batcher.submit(2)) # Joins the batch the first one started
+        results = await asyncio.gather(first, second)
+        waited = loop.time() - start
+        batcher.close()
+        return infer, results, waited
+    infer, results, waited = asyncio.run(run())
+    assert results == [10, 20]
+    assert infer.batches == [[1, 2]]
+    assert 0.015 <= waited < 1
+
+
+def test_failed_batch_fails_every_caller():
+    async def run():
+        batcher = MicroBatcher(Recorder(fail=True), max_batch=2, max_wait_ms=5)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        batcher.close()
+        return results
+    results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
@@ -0,0 +1,90 @@
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+
+@pytest.fixture
+def benchmark(bot_module):
+    import benchmark
+    return benchmark
+
+
+def options(**kwargs):
+    args = dict(weights=None, replay=None, fixtures=None, fixture_count=3, reporters=4, moderators=1,
+                reviews_per_moderator=1, images=3, backfill=0, seed=152, compare=None, out=None, tolerance=0.10)
+    args.update(kwargs)
+    return SimpleNamespace(**args)
+
+
+def test_summarize(benchmark):
+    stats = benchmark.summarize([float(ms) for ms in range(100, 0, -1)], wall_seconds=2.0)
+    assert stats['count'] == 100
+    assert stats['per_sec'] == 50.0
+    assert (stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms']) == (51.0, 96.0, 100.0, 100.0)
+    assert stats['mean_ms'] == 50.5
+
+
+def test_compare_flags_regressions_beyond_the_tolerance(benchmark, tmp_path, capsys):
+    def write(name, p50, p99, per_sec):
+        path = tmp_path / name
+        path.write_text(json.dumps({'handlers': {'on_message': {'p50_ms': p50, 'p99_ms': p99, 'per_sec': per_sec}}}))
+        return str(path)
+    old = write('old.json', 10.0, 20.0, 100.0)
+    assert benchmark.compare(old, write('same.json', 10.5, 21.0, 95.0), tolerance=0.10) == 0
+    assert benchmark.compare(old, write('slow.json', 10.0, 30.0, 80.0), tolerance=0.10) == 1
+    assert 'on_message p99_ms, on_message per_sec' in capsys.readouterr().out
+
+
+def test_synthetic_traffic(benchmark):
+    targets = [SimpleNamespace(jump_url=f'https://discord.com/channels/1/2/{i}') for i in range(2)]
+    events = benchmark.synthetic_events(options(), targets, ['a.jpg'])
+    posts = [e for e in events if e['where'] == 'group' and e.get('attachments')]
+    assert len(posts) == 3
+    assert {e['user'] for e in events if e['user'].startswith('reporter')} == {f'reporter{i}' for i in range(4)}
+    # Moderators only start reviewing once the reports are in
+    assert {e['phase'] for e in events if e['where'] == 'mod'} == {1}
+    assert benchmark.synthetic_events(options(), targets, ['a.jpg']) == events
+
+
+def run_benchmark(benchmark, bot_module, monkeypatch, write_weights, args):
+    import classifier
+    pytest.importorskip('PIL')
+    monkeypatch.setattr(classifier, 'resident_model', classifier.ResidentModel(arch='mobilenet_v3_small'))
+    monkeypatch.setattr(bot_module, 'CASCADE_BAND', None)
+    monkeypatch.setattr(bot_module, 'METRICS_PORT', None)
+    monkeypatch.setattr(bot_module, 'OUTBOUND_SENDER', 'client')
+    args.weights = write_weights()
+    return asyncio.run(benchmark.run(args))
+
+
+def test_synthetic_run_reports_every_handler(benchmark, bot_module, monkeypatch, write_weights):
+    results = run_benchmark(benchmark, bot_module, monkeypatch, write_weights, options(backfill=4))
+    assert results['errors'] == {}
+    for name in ('on_message', 'handle_dm', 'handle_channel_message', 'Report.handle_message',
+                 'Review.handle_message', 'classification_end_to_end'):
+        assert results['handlers'][name]['count'] > 0, name
+    # Every image post went through the classifier; the reporters' targets are never dispatched to the bot
+    assert results['handlers']['classification_end_to_end']['count'] == 3
+    # The backfill picks up the older history and the target, but not the posts classified live
+    assert results['stages']['backfill']['images'] == 4 + 1
+    json.dumps(results) # The results file is plain JSON
+
+
+def test_replay(benchmark, bot_module, monkeypatch, write_weights, tmp_path):
+    from PIL import Image
+    fixtures = tmp_path / 'images'
+    fixtures.mkdir()
+    Image.new('RGB', (64, 64), 'orange').save(fixtures / 'kitten.jpg')
+    replay = tmp_path / 'traffic.jsonl'
+    replay.write_text('\n'.join(json.dumps(e) for e in [
+        {'phase': 0, 'user': 'alice', 'where': 'group', 'content': 'look', 'attachments': ['kitten.jpg']},
+        {'phase': 0, 'user': 'bob', 'where': 'dm', 'content': 'help'},
+    ]) + '\n')
+    results = run_benchmark(benchmark, bot_module, monkeypatch, write_weights,
+                            options(replay=str(replay), fixtures=str(fixtures)))
+    assert results['events'] == 2
+    assert results['errors'] == {}
+    assert results['handlers']['on_message']['count'] == 2
+    assert results['handlers']['classification_end_to_end']['count'] == 1
+    assert results['stages']['fetch']['fetched'] == 1
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import subprocess
+import sys
+import pytest
+from types import SimpleNamespace
+from classification_service import Verdict
+from dispatcher import ClientSender
+from fakes import FakeAttachment, FakeGuild, FakeUser, attach_fake_gateway
+from report_store import REMOVED
+
+
+def test_failed_model_load_leaves_the_filter_not_ready(bot_module, monkeypatch):
+    monkeypatch.setattr(bot_module, 'MODEL_RETRY_SECONDS', 0.01)
+
+    async def run():
+        bot = bot_module.ModBot()
+        attempts, backfills = [], []
+
+        def load_model():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OSError('tensor.pt: no such file')
+        bot.load_model = load_model
+        bot.start_backfill = backfills.append
+        task = asyncio.create_task(bot.warm_up())
+        while len(attempts) < 2:
+            await asyncio.sleep(0.005)
+        assert not bot.classifier.ready
+        assert not backfills
+        await task
+        assert len(attempts) == 3
+        assert bot.classifier.ready
+        assert len(backfills) == 1
+    asyncio.run(run())
+
+
+def test_cascade_prefilter_is_loaded_before_ready(bot_module, monkeypatch):
+    pytest.importorskip('torch')
+    import classifier
+
+    loaded = []
+
+    class RecordingModel:
+        def __init__(self, weights_path, arch='resnet50', backend=None):
+            self.weights_path, self.backend = weights_path, backend
+
+        def get(self):
+            loaded.append(self.weights_path)
+
+    monkeypatch.setattr(classifier, 'ResidentModel', RecordingModel)
+    monkeypatch.setattr(classifier, 'resident_model', RecordingModel('tensor.pt'))
+    monkeypatch.setattr(classifier, 'cascade', None)
+    monkeypatch.setattr(bot_module, 'CASCADE_BAND', (0.1, 0.9))
+    bot_module.ModBot().load_model()
+    assert loaded == [classifier.SMALL_WEIGHTS_PATH, 'tensor.pt']
+
+
+@pytest.fixture
+def gateway(bot_module, tmp_path):
+    '''A ModBot on fake guilds, one with a mod channel and one without, with its stores in tmp_path.'''
+    bot = bot_module.ModBot()
+    bot.verdict_cache.path = None
+    bot.hash_list.path = str(tmp_path / 'known_hashes.txt')
+    bot.report_store.path = str(tmp_path / 'reports.db')
+    bot.backfill.checkpoint_path = None
+    guild, other = FakeGuild('CS 152'), FakeGuild('elsewhere')
+    world = SimpleNamespace(bot=bot, guild=guild, channel=guild.add_channel('group-25'),
+                            mod_channel=guild.add_channel('group-25-mod'), other=other,
+                            other_channel=other.add_channel('group-25'), user=FakeUser('poster'))
+    attach_fake_gateway(bot, [guild, other], FakeUser('Group 25 Bot', bot=True))
+    bot.outbound.sender = ClientSender(bot)
+    bot.report_store.load()
+    yield world
+    bot.report_store.close()
+
+
+def run_with(world, test):
+    async def run():
+        await test()
+        await world.bot.outbound.flush()
+    asyncio.run(run())
+
+
+def known_verdict():
+    return Verdict(None, 'ab' * 32, 0xFF, (0xFF, 0))
+
+
+def test_known_match_is_resolved_in_its_own_guild(gateway):
+    message = gateway.channel.post('', gateway.user, [FakeAttachment('https://cdn.example/a.jpg')])
+
+    async def test():
+        await gateway.bot.handle_classification(message, message.attachments, [known_verdict()])
+    run_with(gateway, test)
+    case = gateway.bot.report_store.lookup(1)
+    assert case is not None and gateway.bot.report_store.get(1) is None # Filed and closed at once
+    assert message.deleted
+    assert gateway.bot.report_store.has_strike(gateway.user.id)
+    assert len(gateway.bot.case_listing) == 0
+    assert any('resolved automatically' in m.content for m in gateway.mod_channel.messages.values())
+
+
+def test_guild_without_a_mod_channel_is_skipped(gateway):
+    message = gateway.other_channel.post('', gateway.user, [FakeAttachment('https://cdn.example/a.jpg')])
+    child = Verdict('kitten', 'cd' * 32, 0xF0, None)
+
+    async def test():
+        await gateway.bot.handle_classification(message, message.attachments, [known_verdict()])
+        await gateway.bot.handle_classification(message, message.attachments, [child])
+        await gateway.bot.handle_classifier_overload(message, message.attachments)
+        gateway.bot.handle_text_verdict(message, SimpleNamespace(category='Spam', score=1.0, terms=('nitro',)))
+    run_with(gateway, test)
+    assert gateway.bot.report_store.last_number == 0
+    assert not message.deleted
+    assert not gateway.mod_channel.messages
+
+
+def test_bot_imports_without_the_ml_stack(tmp_path):
+    # torch, torchvision and PIL take seconds to import; they are loaded by warm_up once connected
+    bot_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = "import sys, bot; print(sorted(m for m in ('torch', 'torchvision', 'PIL', 'classifier') if m in sys.modules))"
+    out = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=dict(os.environ, PYTHONPATH=bot_dir),
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == '[]'
@@ -0,0 +1,70 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+from cascade import KITTEN, Cascade, decide, sweep
+
+
+class FixedModel:
+    '''Stands in for a ResidentModel. Each image's first pixel is its kitten probability.'''
+    device = torch.device('cpu')
+
+    def __init__(self, predict_other=False):
+        self.predict_other = predict_other
+        self.calls = []
+
+    def reload_if_changed(self):
+        return False
+
+    def get(self):
+        return self.forward
+
+    def forward(self, batch):
+        self.calls.append(len(batch))
+        kitten = batch[:, 0, 0, 0]
+        if self.predict_other:
+            return torch.tensor([[0.0, 0.0, 10.0]]).repeat(len(batch), 1)
+        # Adult is the likelier of the other two classes
+        probs = torch.stack([(1 - kitten) * 0.7, kitten, (1 - kitten) * 0.3], dim=1)
+        return torch.log(probs.clamp_min(1e-6))
+
+
+def images(*kitten_probs):
+    batch = []
+    for p in kitten_probs:
+        image = torch.zeros(3, 224, 224)
+        image[0, 0, 0] = p
+        batch.append(image)
+    return batch
+
+
+def test_only_the_uncertainty_band_is_escalated():
+    small, large = FixedModel(), FixedModel(predict_other=True)
+    cascade = Cascade(small, large, low=0.1, high=0.9)
+    # Below the band: the small model's best other class; above: kitten; inside: the large model's answer
+    assert cascade.predict(images(0.01, 0.95, 0.5, 0.3)) == [0, KITTEN, 2, 2]
+    assert large.calls == [2]
+    assert cascade.stats == {'images': 4, 'escalated': 2}
+    assert cascade.escalation_rate() == 0.5
+
+
+def test_nothing_escalated_skips_the_large_model():
+    small, large = FixedModel(), FixedModel(predict_other=True)
+    cascade = Cascade(small, large, low=0.1, high=0.9)
+    assert cascade.predict(images(0.0, 0.99)) == [0, KITTEN]
+    assert large.calls == []
+
+
+def test_band_must_be_ordered():
+    with pytest.raises(ValueError):
+        Cascade(FixedModel(), FixedModel(), low=0.9, high=0.1)
+
+
+def test_decide_and_sweep():
+    probs = torch.tensor([[0.2, 0.05, 0.75], [0.1, 0.85, 0.05], [0.5, 0.5, 0.0]])
+    assert decide(probs, 0.1, 0.8).tolist() == [2, KITTEN, 0]
+    rows = sweep(probs, torch.tensor([2, KITTEN, KITTEN]), [2, KITTEN, KITTEN], [0.1], [0.6, 0.9])
+    assert [(r['low'], r['high']) for r in rows] == [(0.1, 0.6), (0.1, 0.9)]
+    assert rows[0]['escalated'] == pytest.approx(1 / 3) # Only the 0.5 row is inside (0.1, 0.6)
+    assert rows[1]['escalated'] == pytest.approx(2 / 3)
+    assert rows[1]['kitten_recall'] == 1.0
+    assert rows[1]['accuracy'] == 1.0
@@ -0,0 +1,79 @@
+import re
+from case_listing import MESSAGE_LIMIT, CaseListing, parse_list_command, render_row
+from report_store import Case
+
+
+def make_case(number, automatic=False, child=False, reason=None, link=None):
+    link = link or f'https://discord.com/channels/1/2/{number}'
+    return Case(number, 10, 'reporter', automatic, 20, 'Jan 01 2026 00:00:00', float(number), link, child, reason, 1, None)
+
+
+def listed(listing, name='all'):
+    numbers = []
+    for page in range(1, listing.page_count(name) + 1):
+        text = listing.page(page, name)
+        assert len(text) <= MESSAGE_LIMIT
+        numbers += [int(n) for n in re.findall(r'^Case #(\d+)$', text, re.M)]
+    return numbers
+
+
+def test_every_page_fits_in_a_message():
+    listing = CaseListing()
+    for number in range(1, 301):
+        # Some reporters paste very long text as the link
+        listing.add(make_case(number, child=number % 3 == 0, link='x' * 5000 if number % 7 == 0 else None))
+    assert listing.page_count() > 1
+    assert listed(listing) == list(range(1, 301))
+    assert 'Use `list 2` for the next page.' in listing.page(1)
+    assert 'for the next page' not in listing.page(listing.page_count())
+
+
+def test_filters():
+    listing = CaseListing()
+    for number in range(1, 61):
+        listing.add(make_case(number, automatic=number % 2 == 0, child=number % 5 == 0))
+    assert listed(listing, 'child') == list(range(5, 61, 5))
+    assert listed(listing, 'auto') == list(range(2, 61, 2))
+    assert listing.page_count('auto') > 1
+    assert 'Use `list auto 2` for the next page.' in listing.page(1, 'auto')
+
+
+def test_remove_and_out_of_order_add():
+    listing = CaseListing()
+    for number in (1, 2, 4):
+        listing.add(make_case(number, child=True))
+    listing.add(make_case(3)) # Reloaded after newer cases were added
+    listing.add(make_case(3))
+    assert listed(listing) == [1, 2, 3, 4]
+    listing.remove(2)
+    listing.remove(99)
+    assert listed(listing) == [1, 3, 4]
+    assert listed(listing, 'child') == [1, 4]
+    assert len(listing) == 3
+
+
+def test_empty_and_out_of_range_pages():
+    listing = CaseListing()
+    assert listing.page() == 'There are no unreviewed reports.'
+    assert listing.page(1, 'child') == 'There are no unreviewed reports matching `child`.'
+    listing.add(make_case(1))
+    assert listing.page(2) == 'There is only 1 page of unreviewed reports.'
+
+
+def test_text_cases_are_labelled_as_messages():
+    text = render_row(make_case(1, automatic=True, reason='Harassment'))
+    assert 'Reported Message Link' in text
+    assert 'child' not in text
+    image = render_row(make_case(2, automatic=True, child=True))
+    assert 'Reported Image Link' in image
+    assert 'Image believed to contain a child.' in image
+
+
+def test_parse_list_command():
+    assert parse_list_command('list') == ('all', 1)
+    assert parse_list_command('list 3') == ('all', 3)
+    assert parse_list_command('list child') == ('child', 1)
+    assert parse_list_command('list auto 2') == ('auto', 2)
+    assert parse_list_command('list everything') is None
+    assert parse_list_command('lists') is None
+    assert parse_list_command('') is None
@@ -0,0 +1,188 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from classification_service import DEFER, DROP, MOD_CHANNEL, ClassificationService
+from fakes import FakeAttachment
+from fetcher import ImageFetcher
+
+
+class StubBatcher:
+    '''Labels an image "kitten" if its file starts with b"kitten".'''
+    def __init__(self):
+        self.seen = []
+
+    async def submit(self, tensor):
+        self.seen.append(tensor)
+        return 'kitten' if tensor.startswith(b'kitten') else 'adult cat'
+
+    def close(self):
+        pass
+
+
+def decode(data):
+    # Stands in for classifier.decode_and_hash: the "tensor" is the bytes, the hash their length
+    return data, len(data)
+
+
+@pytest.fixture
+def images(tmp_path):
+    for name, data in (('kitten.jpg', b'kitten pixels'), ('cat.jpg', b'cat pixels')):
+        (tmp_path / name).write_bytes(data)
+    return tmp_path
+
+
+def make_service(images, **kwargs):
+    results, overloaded = [], []
+
+    async def on_result(message, attachments, verdicts):
+        results.append((message.id, [v.label if v else None for v in verdicts]))
+
+    async def on_overload(message, attachments):
+        overloaded.append(message.id)
+    service = ClassificationService(ImageFetcher(fixture_dir=str(images)), decode, StubBatcher(), on_result,
+                                    on_overload=on_overload, concurrency=1, **kwargs)
+    return service, results, overloaded
+
+
+def message(id, *names):
+    return SimpleNamespace(id=id, attachments=[FakeAttachment(f'https://cdn.example/{name}') for name in names])
+
+
+async def drain(service):
+    service.start()
+    await service.queue.join()
+    await service.close()
+
+
+def test_classifies_every_attachment(images):
+    async def run():
+        service, results, _ = make_service(images)
+        m = message(1, 'kitten.jpg', 'cat.jpg', 'missing.jpg')
+        assert await service.submit(m, m.attachments)
+        await drain(service)
+        return service, results
+    service, results = asyncio.run(run())
+    assert results == [(1, ['kitten', 'adult cat', None])] # An unreadable image gets no verdict
+    assert service.stats['completed'] == 1
+
+
+def test_queue_bound_counts_images(images):
+    async def run():
+        service, _, _ = make_service(images, max_queue=4, overload_policy=DROP)
+        three, one, another = message(1, *['cat.jpg'] * 3), message(2, 'cat.jpg'), message(3, 'cat.jpg')
+        assert await service.submit(three, three.attachments)
+        assert await service.submit(one, one.attachments) # 4 images queued, the bound
+        assert not await service.submit(another, another.attachments)
+        assert service.queued_images == 4
+        assert service.depth() == 2
+        assert service.stats['dropped'] == 1
+        await drain(service)
+        assert service.queued_images == 0
+    asyncio.run(run())
+
+
+def test_large_message_is_let_in_when_the_queue_is_empty(images):
+    async def run():
+        service, results, _ = make_service(images, max_queue=2, overload_policy=DROP)
+        big = message(1, *['cat.jpg'] * 5)
+        assert await service.submit(big, big.attachments)
+        small = message(2, 'cat.jpg')
+        assert not await service.submit(small, small.attachments)
+        await drain(service)
+        return results
+    assert [id for id, _ in asyncio.run(run())] == [1]
+
+
+def test_mod_channel_policy_hands_the_message_over(images):
+    async def run():
+        service, results, overloaded = make_service(images, max_queue=1, overload_policy=MOD_CHANNEL)
+        first, second = message(1, 'cat.jpg'), message(2, 'kitten.jpg')
+        assert await service.submit(first, first.attachments)
+        assert not await service.submit(second, second.attachments)
+        await drain(service)
+        return results, overloaded, service
+    results, overloaded, service = asyncio.run(run())
+    assert [id for id, _ in results] == [1]
+    assert overloaded == [2]
+    assert service.stats['overloaded'] == 1
+
+
+def test_defer_waits_for_room_in_arrival_order(images):
+    async def run():
+        service, results, _ = make_service(images, max_queue=2, overload_policy=DEFER)
+        messages = [message(1, 'cat.jpg', 'cat.jpg'), message(2, 'cat.jpg', 'cat.jpg'), message(3, 'kitten.jpg')]
+        submits = [asyncio.create_task(service.submit(m, m.attachments)) for m in messages]
+        await asyncio.sleep(0)
+        assert submits[0].done() and not submits[1].done() and not submits[2].done()
+        service.start()
+        assert all(await asyncio.gather(*submits))
+        await service.queue.join()
+        await service.close()
+        return service, results
+    service, results = asyncio.run(run())
+    assert [id for id, _ in results] == [1, 2, 3] # The small message didn't overtake the larger one before it
+    assert service.stats['deferred'] == 2
+
+
+def test_policy_is_checked():
+    with pytest.raises(ValueError):
+        ClassificationService(None, decode, StubBatcher(), None, overload_policy='ignore')
+    with pytest.raises(ValueError):
+        ClassificationService(None, decode, StubBatcher(), None, overload_policy=MOD_CHANNEL)
+
+
+def test_nothing_is_classified_before_ready(images):
+    async def run():
+        service, results, _ = make_service(images, ready=False)
+        service.start()
+        for i in range(3):
+            m = message(i, 'cat.jpg')
+            assert await service.submit(m, m.attachments)
+        await asyncio.sleep(0.01)
+        assert results == []
+        assert len(service.backlog) == 3
+        service.set_ready()
+        late = message(3, 'kitten.jpg')
+        assert await service.submit(late, late.attachments) # Goes behind the backlog
+        while service.backlog or service.queue.qsize():
+            await asyncio.sleep(0.001)
+        await service.queue.join()
+        await service.close()
+        return service, results
+    service, results = asyncio.run(run())
+    assert [id for id, _ in results] == [0, 1, 2, 3]
+    assert service.stats['backlogged'] == 4
+
+
+@pytest.mark.parametrize('policy', [DROP, MOD_CHANNEL])
+def test_full_backlog_gets_the_overload_policy(images, policy):
+    async def run():
+        service, results, overloaded = make_service(images, ready=False, max_backlog=1, overload_policy=policy)
+        first, second = message(1, 'cat.jpg'), message(2, 'cat.jpg')
+        assert await service.submit(first, first.attachments)
+        assert not await service.submit(second, second.attachments)
+        return service, overloaded
+    service, overloaded = asyncio.run(run())
+    assert overloaded == ([2] if policy == MOD_CHANNEL else [])
+    assert service.stats['dropped'] == (1 if policy == DROP else 0)
+    assert list(m.id for m, _, _ in service.backlog) == [1]
+
+
+def test_deferred_past_a_full_backlog_keeps_its_place(images):
+    async def run():
+        service, results, _ = make_service(images, ready=False, max_backlog=1, overload_policy=DEFER)
+        service.start()
+        first, second = message(1, 'cat.jpg'), message(2, 'kitten.jpg')
+        assert await service.submit(first, first.attachments)
+        waiting = asyncio.create_task(service.submit(second, second.attachments))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert results == []
+        service.set_ready()
+        assert await waiting
+        while service.backlog or service.queue.qsize():
+            await asyncio.sleep(0.001)
+        await service.queue.join()
+        await service.close()
+        return results
+    assert [id for id, _ in asyncio.run(run())] == [1, 2]
@@ -0,0 +1,87 @@
+import os
+import threading
+import pytest
+
+torch = pytest.importorskip('torch')
+import classifier
+from classifier import ResidentModel
+
+
+@pytest.fixture(autouse=True)
+def check_every_call(monkeypatch):
+    monkeypatch.setattr(classifier, 'RELOAD_CHECK_SECONDS', 0)
+
+
+def test_loads_once_and_warms_up(write_weights):
+    resident = ResidentModel(write_weights(), arch='mobilenet_v3_small')
+    assert resident.model is None
+    model = resident.get()
+    assert resident.get() is model
+    assert resident.version == 1
+    assert resident.load_seconds is not None
+    assert len(resident.weights_sha256) == 64
+    assert resident.memory_bytes() > 0
+
+
+def test_reloads_when_the_weights_file_changes(write_weights):
+    path = write_weights(seed=0)
+    resident = ResidentModel(path, arch='mobilenet_v3_small')
+    assert not resident.reload_if_changed() # Nothing loaded yet
+    first = resident.get()
+    digest = resident.weights_sha256
+    assert not resident.reload_if_changed()
+
+    write_weights(seed=1)
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert resident.reload_if_changed()
+    assert resident.get() is not first
+    assert resident.version == 2
+    assert resident.weights_sha256 != digest
+    assert not resident.reload_if_changed()
+
+
+def test_broken_weights_keep_the_old_model(write_weights):
+    path = write_weights()
+    resident = ResidentModel(path, arch='mobilenet_v3_small')
+    model = resident.get()
+    with open(path, 'wb') as f:
+        f.write(b'half written')
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    assert not resident.reload_if_changed()
+    assert resident.get() is model
+    assert resident.version == 1
+
+
+def test_check_is_skipped_while_another_thread_holds_the_lock(write_weights):
+    path = write_weights()
+    resident = ResidentModel(path, arch='mobilenet_v3_small')
+    resident.get()
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    locked, release = threading.Event(), threading.Event()
+
+    def hold():
+        with resident._load_lock:
+            locked.set()
+            release.wait()
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+    try:
+        assert not resident.reload_if_changed()
+        assert resident.last_check == 0.0
+    finally:
+        release.set()
+        holder.join()
+    assert resident.reload_if_changed()
+
+
+def test_classify_batch_labels_every_image(write_weights, monkeypatch):
+    resident = ResidentModel(write_weights(), arch='mobilenet_v3_small')
+    monkeypatch.setattr(classifier, 'resident_model', resident)
+    monkeypatch.setattr(classifier, 'cascade', None)
+    labels = classifier.classify_batch([torch.zeros(3, 224, 224), torch.ones(3, 224, 224)])
+    assert len(labels) == 2
+    assert set(labels) <= set(classifier.LABELS.values())
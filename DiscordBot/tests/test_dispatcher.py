@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+from dispatcher import NO_RATE_LIMIT, USER_AGENT, HttpSender, OutboundDispatcher, RateLimit, RateLimited, SendFailed
+
+
+class RecordingSender:
+    '''Records what would have been sent; failures[content] lists exceptions to raise for it first.'''
+    def __init__(self, failures=None, limit=NO_RATE_LIMIT):
+        self.sent = []
+        self.failures = failures or {}
+        self.limit = limit
+
+    def route(self, kind, target_id):
+        return f'{kind} {target_id}'
+
+    async def send(self, kind, target, content):
+        await asyncio.sleep(0)
+        errors = self.failures.get(content)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((target.id, content))
+        return self.limit
+
+    async def close(self):
+        pass
+
+
+def channel(id):
+    return SimpleNamespace(id=id)
+
+
+def test_each_destination_keeps_its_order():
+    async def run():
+        sender = RecordingSender()
+        dispatcher = OutboundDispatcher(sender, max_concurrency=2)
+        futures = [dispatcher.send(channel(i % 3), f'{i % 3}:{i}') for i in range(30)]
+        await dispatcher.flush()
+        assert all(f.result() for f in futures)
+        for target in range(3):
+            assert [c for t, c in sender.sent if t == target] == [f'{target}:{i}' for i in range(target, 30, 3)]
+        assert not dispatcher.outboxes
+    asyncio.run(run())
+
+
+def test_coalesced_messages_stay_under_the_limit():
+    async def run():
+        sender = RecordingSender()
+        dispatcher = OutboundDispatcher(sender, limit=100)
+        mod = channel(1)
+        notices = [f'notice {i:02d} ' + 'x' * 20 for i in range(20)]
+        for notice in notices[:10]:
+            dispatcher.send(mod, notice, coalesce=True)
+        dispatcher.send(mod, 'reply') # Not coalescable, so it splits the run
+        for notice in notices[10:]:
+            dispatcher.send(mod, notice, coalesce=True)
+        await dispatcher.flush()
+        contents = [c for _, c in sender.sent]
+        assert all(len(c) <= 100 for c in contents)
+        assert len(contents) < 21
+        assert '\n'.join(contents).split('\n') == notices[:10] + ['reply'] + notices[10:]
+        assert dispatcher.stats['coalesced'] == 21 - len(contents)
+    asyncio.run(run())
+
+
+def test_rate_limits_and_errors_are_retried():
+    async def run():
+        sender = RecordingSender({'a': [RateLimited(0.01)], 'b': [RateLimited(0.01, is_global=True)]})
+        dispatcher = OutboundDispatcher(sender, backoff=0.01)
+        futures = [dispatcher.send(channel(1), 'a'), dispatcher.send(channel(2), 'b')]
+        await dispatcher.flush()
+        assert [f.result() for f in futures] == [True, True]
+        assert sorted(c for _, c in sender.sent) == ['a', 'b']
+        assert dispatcher.stats['rate_limited'] == 2
+        assert dispatcher.stats['retried'] == 2
+    asyncio.run(run())
+
+
+def test_undeliverable_messages_are_dropped():
+    async def run():
+        sender = RecordingSender({'a': [SendFailed('403 Missing Access')], 'b': [RateLimited(0.0)] * 3})
+        dispatcher = OutboundDispatcher(sender, max_attempts=2)
+        failed = dispatcher.send(channel(1), 'a')
+        gave_up = dispatcher.send(channel(2), 'b')
+        after = dispatcher.send(channel(1), 'c')
+        await dispatcher.flush()
+        assert not failed.result()
+        assert not gave_up.result()
+        assert after.result()
+        assert sender.sent == [(1, 'c')]
+        assert dispatcher.stats['failed'] == 2
+    asyncio.run(run())
+
+
+def test_empty_bucket_waits_for_reset():
+    async def run():
+        # Every response says the bucket is used up for the next 50ms
+        sender = RecordingSender(limit=RateLimit('messages', 0, 0.05))
+        dispatcher = OutboundDispatcher(sender)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i in range(3):
+            dispatcher.send(channel(1), str(i))
+        await dispatcher.flush()
+        assert loop.time() - start >= 0.09
+        assert dispatcher.stats['rate_limited'] == 0
+    asyncio.run(run())
+
+
+def test_http_sender_identifies_the_bot():
+    async def run():
+        sender = HttpSender('token')
+        await sender.start()
+        try:
+            assert sender.session.headers['Authorization'] == 'Bot token'
+            assert sender.session.headers['User-Agent'] == USER_AGENT
+            assert USER_AGENT.startswith('DiscordBot (')
+        finally:
+            await sender.close()
+    asyncio.run(run())
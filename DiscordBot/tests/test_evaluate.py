@@ -0,0 +1,60 @@
+import sys
+import json
+import pytest
+
+torch = pytest.importorskip('torch')
+from PIL import Image
+import evaluate
+
+
+def colour_model(images):
+    '''Predicts the brightest channel: red is label 0, green 1 and blue 2.'''
+    return images.mean(dim=(2, 3))
+
+
+@pytest.fixture
+def items(tmp_path):
+    paths = {}
+    for name, colour in (('red', (255, 0, 0)), ('green', (0, 255, 0)), ('blue', (0, 0, 255))):
+        paths[name] = str(tmp_path / f'{name}.png')
+        Image.new('RGB', (300, 260), colour).save(paths[name])
+    for name in ('broken', 'empty'):
+        paths[name] = str(tmp_path / f'{name}.jpg')
+        (tmp_path / f'{name}.jpg').write_bytes(b'not a jpeg' if name == 'broken' else b'')
+    # With batches of 2 the last batch has no decodable image at all
+    return [(paths['red'], 0), (paths['green'], 1), (paths['blue'], 1), (paths['broken'], 2), (paths['empty'], 0)]
+
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_confusion_matrix_and_failures(items, workers):
+    confusion, misclassified, failed, timings = evaluate.evaluate(colour_model, torch.device('cpu'), items,
+                                                                  batch_size=2, workers=workers)
+    assert confusion.tolist() == [[1, 0, 0], [0, 1, 1], [0, 0, 0]]
+    assert misclassified == [(items[2][0], 1, 2)]
+    assert failed == [items[3][0], items[4][0]]
+    assert timings['wall_seconds'] >= timings['forward_seconds'] > 0
+
+
+def test_precision_recall():
+    confusion = torch.tensor([[8, 2, 0], [1, 9, 0], [0, 0, 0]])
+    scores = evaluate.precision_recall(confusion)
+    assert scores[0] == pytest.approx((8 / 9, 8 / 10, 10))
+    assert scores[1] == pytest.approx((9 / 11, 9 / 10, 10))
+    assert scores[2] == (0.0, 0.0, 0) # No images and no predictions
+
+
+def test_main_writes_json(tmp_path, write_weights, monkeypatch, capsys):
+    root = tmp_path / 'heldout'
+    for name in evaluate.CLASS_DIRS:
+        (root / name).mkdir(parents=True)
+    Image.new('RGB', (64, 64), 'orange').save(root / 'kittens' / 'kitten.png')
+    (root / 'Other' / 'broken.jpg').write_bytes(b'not a jpeg')
+    out = tmp_path / 'eval.json'
+    monkeypatch.setattr(sys, 'argv', ['evaluate.py', str(root), '--weights', write_weights(), '--arch', 'mobilenet_v3_small',
+                                      '--workers', '0', '--json', str(out)])
+    evaluate.main()
+    results = json.loads(out.read_text())
+    assert results['images'] == 1
+    assert sum(map(sum, results['confusion'])) == 1
+    assert results['undecodable'] == [str(root / 'Other' / 'broken.jpg')]
+    assert 'Undecodable (1):' in capsys.readouterr().out
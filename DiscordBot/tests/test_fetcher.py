@@ -0,0 +1,89 @@
+import asyncio
+import aiohttp
+import pytest
+from aiohttp import web
+from fakes import FakeAttachment
+from fetcher import ImageFetcher, ImageTooLarge, NotAnImage, fetch_sync
+
+
+async def serve():
+    '''A local CDN: small and large images, a streamed image with no Content-Length, an HTML page and a 404.'''
+    async def image(request):
+        return web.Response(body=b'x' * int(request.match_info['size']), content_type='image/png')
+
+    async def streamed(request):
+        response = web.StreamResponse(headers={'Content-Type': 'image/jpeg'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+        for _ in range(64):
+            await response.write(b'x' * 1024)
+        await response.write_eof()
+        return response
+
+    async def page(request):
+        return web.Response(text='<html></html>', content_type='text/html')
+    app = web.Application()
+    app.router.add_get('/image/{size}', image)
+    app.router.add_get('/streamed', streamed)
+    app.router.add_get('/page', page)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+
+def test_downloads_and_size_cap():
+    async def run():
+        runner, base = await serve()
+        fetcher = ImageFetcher(max_bytes=32 * 1024)
+        try:
+            assert await fetcher.fetch(f'{base}/image/100') == b'x' * 100
+            with pytest.raises(ImageTooLarge):
+                await fetcher.fetch(f'{base}/image/{64 * 1024}') # Content-Length says it's too big
+            with pytest.raises(ImageTooLarge):
+                await fetcher.fetch(f'{base}/streamed') # Only found out while reading
+            with pytest.raises(NotAnImage):
+                await fetcher.fetch(f'{base}/page')
+            with pytest.raises(aiohttp.ClientResponseError):
+                await fetcher.fetch(f'{base}/missing')
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+        return fetcher
+    fetcher = asyncio.run(run())
+    assert fetcher.stats == {'fetched': 1, 'rejected': 3, 'failed': 1}
+
+
+def test_attachment_metadata_is_checked_before_downloading():
+    async def run():
+        fetcher = ImageFetcher(max_bytes=1000)
+        # Nothing listens on these URLs; rejected attachments must not be requested
+        with pytest.raises(ImageTooLarge):
+            await fetcher.fetch(FakeAttachment('http://127.0.0.1:9/big.png', size=1001))
+        with pytest.raises(NotAnImage):
+            await fetcher.fetch(FakeAttachment('http://127.0.0.1:9/doc.pdf', content_type='application/pdf'))
+        await fetcher.close()
+        return fetcher
+    assert asyncio.run(run()).stats['rejected'] == 2
+
+
+def test_fixture_directory(tmp_path):
+    (tmp_path / 'small.jpg').write_bytes(b'x' * 10)
+    (tmp_path / 'big.jpg').write_bytes(b'x' * 100)
+
+    async def run():
+        fetcher = ImageFetcher(max_bytes=50, fixture_dir=str(tmp_path))
+        assert await fetcher.fetch(FakeAttachment('https://cdn.example/attachments/1/2/small.jpg')) == b'x' * 10
+        with pytest.raises(ImageTooLarge):
+            await fetcher.fetch('https://cdn.example/big.jpg')
+        with pytest.raises(FileNotFoundError):
+            await fetcher.fetch('https://cdn.example/missing.jpg')
+        return fetcher
+    fetcher = asyncio.run(run())
+    assert fetcher.session is None
+    assert fetcher.stats == {'fetched': 1, 'rejected': 1, 'failed': 1}
+
+    assert fetch_sync('https://cdn.example/small.jpg', fixture_dir=str(tmp_path)) == b'x' * 10
+    with pytest.raises(ImageTooLarge):
+        fetch_sync('https://cdn.example/big.jpg', max_bytes=50, fixture_dir=str(tmp_path))
@@ -0,0 +1,48 @@
+import numpy as np
+from hash_list import HashList, load_hashes
+
+
+def test_match_and_add(tmp_path):
+    path = tmp_path / 'known.txt'
+    path.write_text('# known hashes\n00000000000000ff\n\n0000000000ff0000  # from a report\n')
+    hashes = HashList(str(path))
+    hashes.load()
+    assert len(hashes) == 2
+    assert hashes.match(0xFF) == (0xFF, 0)
+    assert hashes.match(0xFE) == (0xFF, 1)
+    assert hashes.match(0xF0F0F0F0F0F0F0F0) is None
+
+    assert hashes.add(0xABCDEF)
+    assert not hashes.add(0xABCDEF)
+    assert not hashes.add(0xFF)
+    assert hashes.match(0xABCDEF) == (0xABCDEF, 0)
+    assert path.read_text().endswith('0000000000abcdef\n')
+
+    restarted = HashList(str(path))
+    restarted.load()
+    assert len(restarted) == 3
+    assert restarted.match(0xABCDEE) == (0xABCDEF, 1)
+
+
+def test_npy_list_additions_go_to_a_text_file_next_to_it(tmp_path):
+    path = tmp_path / 'known.npy'
+    np.save(path, np.array([0xFF], dtype=np.uint64))
+    assert load_hashes(str(path)).tolist() == [0xFF]
+    hashes = HashList(str(path))
+    hashes.load()
+    assert hashes.add(0x1234)
+    assert load_hashes(str(path)).tolist() == [0xFF]
+    assert (tmp_path / 'known.added.txt').read_text() == '0000000000001234\n'
+
+    restarted = HashList(str(path))
+    restarted.load()
+    assert len(restarted) == 2
+    assert restarted.match(0x1235) == (0x1234, 1)
+    assert not restarted.add(0x1234)
+
+
+def test_missing_file_is_an_empty_list(tmp_path):
+    hashes = HashList(str(tmp_path / 'none.txt'))
+    hashes.load()
+    assert len(hashes) == 0
+    assert hashes.match(0) is None
@@ -0,0 +1,41 @@
+from fakes import FakeGuild, FakeMessage, FakeUser
+from message_cache import MessageCache
+
+
+def test_evicts_the_least_recently_used():
+    cache = MessageCache(max_entries=2)
+    cache.put(1, 10, 20, 30)
+    cache.put(2, 10, 20, 31)
+    assert cache.get(1).author_id == 30 # 1 is now more recent than 2
+    cache.put(3, 10, 20, 32)
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert cache.stats == {'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_putting_again_refreshes_without_evicting():
+    cache = MessageCache(max_entries=2)
+    first = cache.put(1, 10, 20, 30)
+    cache.put(2, 10, 20, 31)
+    assert cache.put(1, 10, 20, 30, phash=0xABC) is first
+    assert first.phash == 0xABC
+    cache.put(1, 10, 20, 30) # No phash keeps the known one
+    assert first.phash == 0xABC
+    cache.put(3, 10, 20, 32)
+    assert list(cache.entries) == [1, 3]
+    assert cache.stats['evictions'] == 1
+
+
+def test_messages_and_phash():
+    cache = MessageCache()
+    user = FakeUser('poster')
+    channel = FakeGuild('CS 152').add_channel('group-25')
+    info = cache.put_message(channel.post('hi', user))
+    assert (info.guild_id, info.channel_id, info.author_id, info.phash) == (channel.guild.id, channel.id, user.id, None)
+    dm = FakeMessage('hi', user, user.dm_channel)
+    assert cache.put_message(dm, phash=7).guild_id is None
+    cache.set_phash(dm.id, 9)
+    assert cache.get(dm.id).phash == 9
+    cache.set_phash(12345, 9) # Not cached: ignored
+    assert cache.get(12345) is None
@@ -0,0 +1,107 @@
+import asyncio
+import aiohttp
+import pytest
+import metrics
+from metrics import Counter, Gauge, Histogram, Registry, StatsCounters
+
+
+def test_text_format():
+    registry = Registry()
+    registry.register(Counter('modbot_messages_total', 'Messages seen', {'kind': 'dm'})).inc(3)
+    registry.register(Counter('modbot_messages_total', 'Messages seen', {'kind': 'group'})).inc()
+    registry.register(Gauge('modbot_queue_depth', fn=lambda: 7))
+    histogram = registry.register(Histogram((1, 10), 'modbot_fetch_ms', 'Fetch time', {'stage': 'fetch'}))
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value)
+    registry.register(StatsCounters('modbot_fetch_total', {'fetched': 2, 'failed': 1}, 'Fetches'))
+    assert registry.render() == '\n'.join([
+        '# HELP modbot_fetch_ms Fetch time',
+        '# TYPE modbot_fetch_ms histogram',
+        'modbot_fetch_ms_bucket{stage="fetch",le="1"} 2', # Buckets are cumulative and include their bound
+        'modbot_fetch_ms_bucket{stage="fetch",le="10"} 3',
+        'modbot_fetch_ms_bucket{stage="fetch",le="+Inf"} 4',
+        'modbot_fetch_ms_sum{stage="fetch"} 56.5',
+        'modbot_fetch_ms_count{stage="fetch"} 4',
+        '# HELP modbot_fetch_total Fetches',
+        '# TYPE modbot_fetch_total counter',
+        'modbot_fetch_total{event="fetched"} 2',
+        'modbot_fetch_total{event="failed"} 1',
+        '# HELP modbot_messages_total Messages seen',
+        '# TYPE modbot_messages_total counter', # Described once for all its label sets
+        'modbot_messages_total{kind="dm"} 3',
+        'modbot_messages_total{kind="group"} 1',
+        '# TYPE modbot_queue_depth gauge',
+        'modbot_queue_depth 7',
+    ]) + '\n'
+
+
+def test_histogram_percentiles():
+    histogram = Histogram((1, 10, 100))
+    assert histogram.snapshot() == {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    for value in [0.5] * 90 + [20] * 9 + [500]:
+        histogram.observe(value)
+    assert histogram.percentile(50) == 1 # The upper bound of the bucket it falls in
+    assert histogram.percentile(95) == 100
+    assert histogram.percentile(100) == 500 # Above the top bucket reports the max
+    assert histogram.mean() == pytest.approx((45 + 180 + 500) / 100)
+    small = Histogram((1, 10, 100))
+    small.observe(3)
+    assert small.percentile(99) == 3 # Capped by the largest value seen
+
+
+def test_registry_reuses_and_replaces_metrics():
+    registry = Registry()
+    first = registry.get_or_create(Counter, 'hits', {'cache': 'verdict'})
+    assert registry.get_or_create(Counter, 'hits', {'cache': 'verdict'}) is first
+    assert registry.get_or_create(Counter, 'hits', {'cache': 'hash'}) is not first
+    stats = {'fetched': 0}
+    registry.register(StatsCounters('fetch', {'fetched': 5}))
+    registry.register(StatsCounters('fetch', stats)) # e.g. a new ImageFetcher after a restart
+    stats['fetched'] += 1
+    first.inc()
+    assert registry.snapshot() == {'hits{cache="verdict"}': 1, 'hits{cache="hash"}': 0, 'fetch': {'fetched': 1}}
+
+
+def test_span_times_a_stage_around_awaits():
+    histogram = metrics.histogram('modbot_stage_ms', stage='test_sleep')
+    in_flight = metrics.gauge('modbot_in_flight', stage='test_sleep')
+    before = histogram.count
+
+    async def run():
+        with metrics.span('test_sleep'):
+            assert in_flight.value == 1
+            await asyncio.sleep(0.01)
+    asyncio.run(run())
+    assert histogram.count == before + 1
+    assert histogram.max >= 10
+    assert in_flight.value == 0
+
+
+def test_serve():
+    registry = Registry()
+    registry.register(Counter('modbot_up')).inc()
+
+    async def run():
+        runner = await metrics.serve(0, registry=registry)
+        port = runner.addresses[0][1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                    return response.content_type, await response.text()
+        finally:
+            await runner.cleanup()
+    assert asyncio.run(run()) == ('text/plain', '# TYPE modbot_up counter\nmodbot_up 1\n')
+
+
+def test_write_snapshots(tmp_path):
+    registry = Registry()
+    registry.register(Gauge('modbot_ready', fn=lambda: 1))
+    path = str(tmp_path / 'metrics.prom')
+
+    async def run():
+        task = asyncio.create_task(metrics.write_snapshots(path, interval=60, registry=registry))
+        await asyncio.sleep(0.01)
+        task.cancel()
+    asyncio.run(run())
+    with open(path) as f:
+        assert f.read() == registry.render()
@@ -0,0 +1,94 @@
+import sqlite3
+import pytest
+from report_store import REMOVED, ReportStore, canonical_link
+
+LINK = 'https://discord.com/channels/1/2/3'
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'reports.db')
+
+
+def open_store(path):
+    store = ReportStore(path, flush_ms=1)
+    store.load()
+    return store
+
+
+def file_case(store, link=LINK, reporter_id=10, reported_user_id=20, automatic=False, child=False, severity=1,
+              filed_at=100.0, phash=None):
+    return store.file(reporter_id, 'reporter', automatic, reported_user_id, 'Jan 01 2026 00:00:00', filed_at, link,
+                      child, None, severity, phash)
+
+
+def test_open_cases_and_strikes_survive_a_restart(path):
+    store = open_store(path)
+    first = file_case(store, phash=2 ** 64 - 1)
+    second = file_case(store, link='https://discord.com/channels/1/2/4')
+    store.add_strike(20, first.number)
+    store.close_case(second.number, REMOVED, reviewer_id=30)
+    store.close()
+
+    store = open_store(path)
+    assert list(store.open) == [first.number]
+    assert store.get(first.number) == first # Including the unsigned 64-bit perceptual hash
+    assert store.get(second.number) is None
+    assert store.has_strike(20)
+    assert not store.has_strike(21)
+    assert file_case(store).number == second.number + 1 # Numbers carry on from the highest filed
+    closed = store.lookup(second.number)
+    assert closed.link == 'https://discord.com/channels/1/2/4'
+    store.close()
+
+
+def test_set_phash_is_persisted(path):
+    store = open_store(path)
+    case = file_case(store)
+    store.set_phash(case.number, 0xDEADBEEF)
+    store.close()
+    store = open_store(path)
+    assert store.get(case.number).phash == 0xDEADBEEF
+    store.close()
+
+
+def test_find_filters_newest_first(path):
+    store = open_store(path)
+    user = file_case(store, reported_user_id=1, filed_at=100.0)
+    auto = file_case(store, reported_user_id=1, automatic=True, child=True, severity=3, filed_at=200.0)
+    other = file_case(store, reported_user_id=2, filed_at=300.0)
+    store.close_case(user.number, REMOVED)
+    numbers = lambda cases: [case.number for case in cases]
+    assert numbers(store.find()) == [other.number, auto.number, user.number]
+    assert numbers(store.find(reported_user_id=1)) == [auto.number, user.number]
+    assert numbers(store.find(status='open')) == [other.number, auto.number]
+    assert numbers(store.find(automatic=True)) == [auto.number]
+    assert numbers(store.find(contains_child=False)) == [other.number, user.number]
+    assert numbers(store.find(min_severity=2)) == [auto.number]
+    assert numbers(store.find(since=150.0, until=300.0)) == [auto.number]
+    assert numbers(store.find(before=other.number, limit=1)) == [auto.number]
+    store.close()
+
+
+def test_links_are_canonical(path):
+    assert canonical_link(' https://ptb.discord.com/channels/1/2/3 ') == LINK
+    assert canonical_link('see <https://canary.discordapp.com/channels/1/2/3>') == LINK
+    assert canonical_link(' not a link ') == 'not a link'
+
+    store = open_store(path)
+    case = file_case(store, link='https://ptb.discord.com/channels/1/2/3')
+    assert case.link == LINK
+    assert [c.number for c in store.find(link='https://canary.discord.com/channels/1/2/3')] == [case.number]
+    store.close()
+
+
+def test_load_normalises_old_links(path):
+    store = open_store(path)
+    case = file_case(store)
+    store.close()
+    with sqlite3.connect(path) as conn:
+        conn.execute('UPDATE cases SET link = ? WHERE number = ?', ('https://ptb.discord.com/channels/1/2/3', case.number))
+    store = open_store(path)
+    assert store.get(case.number).link == LINK
+    assert [c.number for c in store.find(link=LINK)] == [case.number]
+    store.close()
@@ -0,0 +1,71 @@
+from collections import namedtuple
+from review_queue import ReviewScheduler
+
+Case = namedtuple('Case', ['number', 'severity', 'filed_at'])
+
+
+def test_most_severe_then_oldest_first():
+    scheduler = ReviewScheduler()
+    for case in (Case(1, 1, 10.0), Case(2, 3, 30.0), Case(3, 3, 20.0), Case(4, 2, 5.0)):
+        scheduler.enqueue(case)
+    scheduler.enqueue(Case(1, 1, 10.0)) # Already queued
+    assert len(scheduler) == 4
+    assert [scheduler.claim_next('mod', now=100.0) for _ in range(5)] == [3, 2, 4, 1, None]
+
+
+def test_leased_case_cannot_be_claimed_by_someone_else():
+    scheduler = ReviewScheduler(lease_seconds=60)
+    scheduler.enqueue(Case(1, 1, 0.0))
+    assert scheduler.claim(1, 'alice', now=10.0)
+    assert scheduler.claim(1, 'alice', now=20.0) # The holder can reopen it
+    assert not scheduler.claim(1, 'bob', now=30.0)
+    assert scheduler.claim_next('bob', now=30.0) is None
+    scheduler.enqueue(Case(1, 1, 0.0)) # Leased cases aren't queued twice
+    assert len(scheduler) == 0
+
+
+def test_expired_lease_returns_the_case_to_the_queue():
+    scheduler = ReviewScheduler(lease_seconds=60)
+    scheduler.enqueue(Case(1, 1, 0.0))
+    scheduler.enqueue(Case(2, 1, 5.0))
+    before = scheduler.expired.value
+    assert scheduler.claim_next('alice', now=10.0) == 1
+    assert scheduler.renew(1, 'alice', now=50.0) # Now expires at 110
+    assert not scheduler.renew(1, 'bob', now=50.0)
+    assert scheduler.expire(now=100.0) == 0
+    assert scheduler.expire(now=110.0) == 1
+    assert scheduler.expired.value == before + 1
+    assert not scheduler.renew(1, 'alice', now=111.0)
+    assert scheduler.claim_next('bob', now=111.0) == 1 # Back in its original place, ahead of case 2
+
+
+def test_claim_expires_stale_leases():
+    scheduler = ReviewScheduler(lease_seconds=60)
+    scheduler.enqueue(Case(1, 1, 0.0))
+    assert scheduler.claim(1, 'alice', now=0.0)
+    assert scheduler.claim(1, 'bob', now=61.0)
+
+
+def test_release_and_complete():
+    scheduler = ReviewScheduler()
+    scheduler.enqueue(Case(1, 1, 0.0))
+    scheduler.enqueue(Case(2, 1, 1.0))
+    assert scheduler.claim_next('alice', now=10.0) == 1
+    scheduler.release(1, 'bob') # Not bob's lease
+    assert 1 in scheduler.leases
+    scheduler.release(1, 'alice')
+    assert len(scheduler) == 2
+    scheduler.complete(1)
+    assert scheduler.claim_next('alice', now=20.0) == 2
+    scheduler.complete(2)
+    assert scheduler.claim_next('alice', now=30.0) is None
+    assert scheduler.stats()['queued'] == 0
+    assert scheduler.stats()['leased'] == 0
+
+
+def test_stats_expire_leases():
+    scheduler = ReviewScheduler(lease_seconds=0)
+    scheduler.enqueue(Case(1, 1, 0.0))
+    scheduler.claim_next('alice', now=0.0)
+    stats = scheduler.stats()
+    assert (stats['queued'], stats['leased']) == (1, 0)
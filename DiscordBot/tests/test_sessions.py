@@ -0,0 +1,63 @@
+import asyncio
+from collections import namedtuple
+import sessions
+from review_queue import ReviewScheduler
+from sessions import SessionStore, sweep
+
+
+def test_idle_sessions_expire(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(sessions.time, 'monotonic', lambda: now[0])
+    ended = []
+    store = SessionStore('test', ttl=60, on_end=lambda user_id, session: ended.append((user_id, session)))
+    store[1] = 'a'
+    now[0] = 30.0
+    store[2] = 'b'
+    now[0] = 50.0
+    assert store[1] == 'a' # Activity moves 1 behind 2
+    assert store.expire(now=100.0) == 1
+    assert ended == [(2, 'b')]
+    assert 1 in store and 2 not in store
+    assert store.expire(now=110.0) == 1
+    assert store.counts() == {'live': 0, 'expired': 2, 'evicted': 0}
+
+
+def test_least_recently_active_is_evicted():
+    ended = []
+    store = SessionStore('test', max_sessions=2, on_end=lambda user_id, session: ended.append(user_id))
+    store[1], store[2] = 'a', 'b'
+    store[1]
+    store[3] = 'c'
+    assert ended == [2]
+    assert len(store) == 2
+    assert store.pop(1) == 'a'
+    assert store.pop(1, 'gone') == 'gone'
+    assert ended == [2] # Finished flows aren't ended again
+    assert store.stats == {'started': 3, 'finished': 1, 'expired': 0, 'evicted': 1}
+
+
+def test_failing_on_end_does_not_stop_expiry():
+    def on_end(user_id, session):
+        raise RuntimeError('cleanup failed')
+    store = SessionStore('test', ttl=0, on_end=on_end)
+    store[1], store[2] = 'a', 'b'
+    assert store.expire() == 2
+    assert len(store) == 0
+
+
+def test_sweep_expires_sessions_and_review_leases():
+    Case = namedtuple('Case', ['number', 'severity', 'filed_at'])
+
+    async def run():
+        store = SessionStore('test', ttl=0)
+        store[1] = 'a'
+        scheduler = ReviewScheduler(lease_seconds=0)
+        scheduler.enqueue(Case(1, 1, 0.0))
+        scheduler.claim_next('mod', now=0.0)
+        task = asyncio.create_task(sweep([store, scheduler], interval=0.01))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        assert len(store) == 0
+        assert not scheduler.leases
+        assert len(scheduler) == 1
+    asyncio.run(run())
@@ -0,0 +1,80 @@
+import asyncio
+import numpy as np
+from text_filter import HashedLinearModel, TermMatcher, TextFilter, hashed_ngrams, load_terms, normalize, normalize_batch
+
+
+def test_normalize():
+    assert normalize('FR33 N1TRO!!') == 'fre nitro'
+    assert normalize('free   nitrooo') == 'fre nitro'
+    assert normalize('Café') == 'cafe'
+    assert normalize('fr\u200bee') == 'fre'
+    assert normalize_batch(['', 'a', '', 'aa']) == ['', 'a', '', 'a']
+    assert normalize_batch([]) == []
+
+
+def test_terms_match_whole_words_and_phrases():
+    matcher = TermMatcher([('Harassment', 'kys', 1.0), ('Spam', 'free nitro', 1.0), ('Spam', 'nitro', 0.5),
+                           ('Spam', 'nitro giveaway', 1.0)])
+    terms = lambda text: [matcher.terms[t][0] for t in matcher.find(normalize(text))]
+    assert terms('the skys are blue') == []
+    assert terms('just KYS') == ['kys']
+    assert terms('FR33 N1TRO here') == ['free nitro', 'nitro']
+    assert terms('free nitro giveaway') == ['free nitro', 'nitro', 'nitro giveaway']
+
+
+def test_term_weights_add_up_to_a_verdict():
+    text_filter = TextFilter(threshold=0.8)
+    text_filter.set_scorers(TermMatcher([('Spam', 'nitro', 0.5), ('Spam', 'giveaway', 0.5), ('Scam', 'wallet', 0.4)]))
+    spam, weak, clean = text_filter.score_batch(['nitro giveaway', 'nitro wallet', 'hello there'])
+    assert spam.category == 'Spam'
+    assert spam.score == 1.0
+    assert spam.terms == ('nitro', 'giveaway')
+    assert weak is None
+    assert clean is None
+
+
+def test_nothing_is_flagged_until_loaded(tmp_path):
+    text_filter = TextFilter(terms_path=str(tmp_path / 'missing.txt'))
+    assert text_filter.score('kys') is None
+    path = tmp_path / 'terms.txt'
+    path.write_text('# category, term, weight\nHarassment\tkys\n\nSpam\tnitro\t0.5\n', encoding='utf-8')
+    assert load_terms(str(path)) == [('Harassment', 'kys', 1.0), ('Spam', 'nitro', 0.5)]
+    text_filter = TextFilter(terms_path=str(path))
+    text_filter.load()
+    assert text_filter.score('kys').category == 'Harassment'
+
+
+def test_hashed_ngrams_stay_within_each_text():
+    indices, owners = hashed_ngrams(['ab', '', 'abcd'], ngrams=(3,), bits=8)
+    # ' ab ' has 2 trigrams and ' abcd ' has 4; nothing spans the separators
+    assert owners.tolist() == [0, 0, 2, 2, 2, 2]
+    assert indices[0] == indices[2] # ' ab' starts both
+    assert indices.max() < 2 ** 8
+
+
+def test_model_round_trip(tmp_path):
+    texts = normalize_batch(['free nitro click here', 'claim your free nitro', 'see you at lunch', 'nice game last night'])
+    model = HashedLinearModel(['Spam'], bits=12)
+    model.fit(texts, np.array([[1], [1], [0], [0]]), epochs=100)
+    predictions = model.predict(texts)[:, 0]
+    assert (predictions[:2] > 0.5).all() and (predictions[2:] < 0.5).all()
+    path = str(tmp_path / 'model.npz')
+    model.save(path)
+    loaded = HashedLinearModel.load(path)
+    assert loaded.categories == ['Spam']
+    assert np.allclose(loaded.predict(texts), model.predict(texts))
+
+
+def test_submitted_messages_are_scored_in_one_batch():
+    flagged = []
+
+    async def run():
+        text_filter = TextFilter(on_flagged=lambda message, verdict: flagged.append((message, verdict.category)))
+        text_filter.set_scorers(TermMatcher([('Harassment', 'kys', 1.0)]))
+        for i, text in enumerate(['hi', 'kys', 'hello', 'k y s', 'KYS!!']):
+            text_filter.submit(i, text)
+        await asyncio.sleep(0)
+        assert text_filter.stats['batches'] == 1
+        assert text_filter.stats['messages'] == 5
+    asyncio.run(run())
+    assert flagged == [(1, 'Harassment'), (4, 'Harassment')]
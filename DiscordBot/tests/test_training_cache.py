@@ -0,0 +1,72 @@
+import os
+import sys
+import pytest
+
+torch = pytest.importorskip('torch')
+np = pytest.importorskip('numpy')
+from PIL import Image
+
+# training_cache.py sits next to the notebook, one level above the bot
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import training_cache
+
+COLOURS = {'adults': [(200, 0, 0), (0, 200, 0)], 'kittens': [(0, 0, 200), (200, 200, 0)], 'Other': [(0, 200, 200)]}
+
+
+@pytest.fixture
+def root(tmp_path):
+    root = tmp_path / 'data'
+    for name, colours in COLOURS.items():
+        (root / name).mkdir(parents=True)
+        for i, colour in enumerate(colours):
+            Image.new('RGB', (400, 300), colour).save(root / name / f'{i}.png')
+    (root / 'Other' / 'broken.jpg').write_bytes(b'not a jpeg')
+    return str(root)
+
+
+def test_pack_round_trip(root, tmp_path):
+    cache = str(tmp_path / 'cache')
+    index = training_cache.pack(root, cache, workers=1)
+    assert index['labels'] == [0, 0, 1, 1, 2, 2]
+    assert index['paths'][5].endswith('broken.jpg') # Files are listed in sorted order
+    assert index['failed'] == [5]
+    images = np.load(os.path.join(cache, training_cache.IMAGES_FILE))
+    assert images.shape == (6, 256, 256, 3)
+    for row, path in enumerate(index['paths'][:5]):
+        assert np.array_equal(images[row], training_cache.decode(path))
+    assert tuple(images[2, 128, 128]) == (0, 0, 200)
+
+    # A second pack of the same files reuses the cache
+    mtime = os.path.getmtime(os.path.join(cache, training_cache.IMAGES_FILE))
+    assert training_cache.pack(root, cache, workers=1) == index
+    assert os.path.getmtime(os.path.join(cache, training_cache.IMAGES_FILE)) == mtime
+
+    dataset = training_cache.PackedImageDataset(cache, [2, 4], [1, 2], train=False)
+    image, label = dataset[0]
+    assert (image.dtype, image.shape, label) == (torch.uint8, (3, 224, 224), 1)
+    assert image[:, 0, 0].tolist() == [0, 0, 200]
+    image, _ = training_cache.PackedImageDataset(cache, [2], [1], train=True)[0]
+    assert image.shape == (3, 224, 224)
+
+
+def test_split_rows_skips_failed_images():
+    index = {'paths': [str(i) for i in range(10)], 'failed': [3, 7]}
+    train, val = training_cache.split_rows(index, val_fraction=0.25)
+    assert sorted(train + val) == [0, 1, 2, 4, 5, 6, 8, 9]
+    assert len(val) == 2
+    assert training_cache.split_rows(index, val_fraction=0.25) == (train, val)
+
+
+def test_loaders(root, tmp_path):
+    cache = str(tmp_path / 'cache')
+    training_cache.pack(root, cache, workers=1)
+    loaders = training_cache.make_loaders(cache, val_fraction=0.4, batch_size=2, num_workers=0)
+    assert len(loaders['train'].dataset) == 3 and len(loaders['val'].dataset) == 2
+    images, labels = next(iter(loaders['val']))
+    assert images.dtype == torch.uint8 and images.shape == (2, 3, 224, 224)
+    inputs = training_cache.to_input(images, torch.device('cpu'))
+    assert inputs.dtype == torch.float32
+    # Normalised exactly as ToTensor() + Normalize() would
+    expected = (images.float() / 255 - torch.tensor(training_cache.MEAN).view(1, 3, 1, 1)) / torch.tensor(training_cache.STD).view(1, 3, 1, 1)
+    assert torch.allclose(inputs, expected, atol=1e-5)
+    assert training_cache.to_input(inputs, torch.device('cpu')) is inputs
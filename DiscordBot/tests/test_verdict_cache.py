@@ -0,0 +1,79 @@
+import verdict_cache
+from verdict_cache import ENTRY_BYTES, VerdictCache
+
+
+def make_cache(entries=8, version='v1', **kwargs):
+    versions = [version]
+    cache = VerdictCache(lambda: versions[0], max_bytes=entries * ENTRY_BYTES, **kwargs)
+    return cache, versions
+
+
+def test_exact_and_similar_lookups():
+    cache, _ = make_cache()
+    cache.store('a', 0b1011, 1)
+    assert cache.lookup_exact('a') == (0b1011, 1)
+    assert cache.lookup_exact('b') is None
+    assert cache.lookup_similar(0b1010) == 1 # One bit away
+    assert cache.lookup_similar(0xFFFF0000) is None
+
+
+def test_evicts_least_recently_used():
+    cache, _ = make_cache(entries=2)
+    cache.store('a', 1, 0)
+    cache.store('b', 2 ** 20, 0)
+    cache.lookup_exact('a') # a is now more recent than b
+    cache.store('c', 2 ** 40, 0)
+    assert len(cache) == 2
+    assert cache.lookup_exact('b') is None
+    assert cache.lookup_exact('a') is not None
+    assert cache.stats['evictions'] == 1
+
+
+def test_evicting_one_file_keeps_a_shared_phash():
+    cache, _ = make_cache(entries=2)
+    cache.store('a', 0xABC, 1)
+    cache.store('b', 0xABC, 1) # Re-encoded copy with the same perceptual hash
+    cache.store('c', 2 ** 50, 0) # Evicts a
+    assert cache.lookup_exact('a') is None
+    assert cache.lookup_similar(0xABC) == 1
+    assert cache.by_phash[0xABC] == {'b'}
+    cache.lookup_exact('c')
+    cache.store('d', 2 ** 60, 0) # Evicts b, the last file with that hash
+    assert 0xABC not in cache.by_phash
+    assert cache.lookup_similar(0xABC) is None
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(verdict_cache.time, 'time', lambda: now[0])
+    cache, _ = make_cache(ttl=60)
+    cache.store('a', 7, 1)
+    now[0] += 61
+    assert cache.lookup_exact('a') is None
+    assert cache.lookup_similar(7) is None
+    assert len(cache) == 0
+
+
+def test_new_weights_clear_the_cache():
+    cache, versions = make_cache()
+    cache.store('a', 7, 1)
+    versions[0] = 'v2'
+    assert cache.lookup_exact('a') is None
+    assert len(cache) == 0
+    assert cache.stats['invalidations'] == 1
+    versions[0] = None # Weights not loaded yet: nothing is cached or served
+    cache.store('b', 8, 1)
+    assert len(cache) == 0
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'verdicts.json')
+    cache, _ = make_cache(path=path)
+    cache.store('a', 7, 1)
+    cache.save()
+    restored, _ = make_cache(path=path)
+    restored.load()
+    assert restored.lookup_exact('a') == (7, 1)
+    changed, _ = make_cache(path=path, version='v2')
+    changed.load()
+    assert changed.lookup_exact('a') is None
@@ -0,0 +1,466 @@
+'''
+Automatic text filter. Scores every message in the group channel against the
+report reasons users can pick by hand (hate speech, spam, scam, harassment)
+with two parts:
+
+  - A term list matched with one Aho-Corasick automaton whose alphabet is
+    words, so a message is scanned once, a word at a time, however many
+    terms (single words or phrases) are listed. Text is normalised first
+    (Unicode compatibility forms, accents, confusable Cyrillic and Greek
+    letters, leetspeak digits, zero-width characters, punctuation, repeated
+    letters) and the terms are normalised the same way.
+  - A linear model over hashed character n-grams, scored with NumPy for a
+    whole batch of messages at once.
+
+    python text_filter.py bench --terms 20000 --messages 20000
+    python text_filter.py train labelled.jsonl text_model.npz
+
+A training file has one JSON object per line: {"text": "...", "labels": ["Spam"]}.
+'''
+import os
+import asyncio
+import re
+import json
+import time
+import random
+import logging
+import argparse
+import string
+import unicodedata
+from collections import namedtuple, deque
+import numpy as np
+from metrics import Histogram, SIZE_BUCKETS, StatsCounters, gauge, span, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Verdict for a flagged message: the worst category, its score in [0, 1] and the listed terms it contained
+TextVerdict = namedtuple('TextVerdict', ['category', 'score', 'terms'])
+
+# Map from look-alike characters to the letter they imitate. Applied after lower-casing.
+LEETSPEAK = {'0': 'o', '1': 'i', '3': 'e', '4': 'a', '5': 's', '7': 't', '@': 'a', '$': 's'}
+CONFUSABLES = {
+    # Cyrillic
+    'а': 'a', 'в': 'b', 'е': 'e', 'ё': 'e', 'к': 'k', 'м': 'm', 'н': 'h', 'о': 'o', 'р': 'p', 'с': 'c',
+    'т': 't', 'у': 'y', 'х': 'x', 'і': 'i', 'ї': 'i', 'ј': 'j', 'ѕ': 's', 'ԁ': 'd', 'ɡ': 'g', 'ո': 'n',
+    # Greek
+    'α': 'a', 'β': 'b', 'ε': 'e', 'η': 'n', 'ι': 'i', 'κ': 'k', 'ν': 'v', 'ο': 'o', 'ρ': 'p', 'τ': 't',
+    'υ': 'u', 'χ': 'x', 'ω': 'w',
+}
+ZERO_WIDTH = '\u200b\u200c\u200d\u2060\ufeff\u00ad'
+FOLD = str.maketrans({**{ch: ' ' for ch in string.punctuation}, **LEETSPEAK, **CONFUSABLES,
+                      **{ch: None for ch in ZERO_WIDTH}, '\0': ' '})
+COMBINING = re.compile('[\u0300-\u036f]+')
+SEPARATORS = re.compile(r'[\W_]+')
+
+# Character n-gram feature hashing
+NGRAMS = (3, 4)
+HASH_BITS = 18
+PRIME = np.uint64(1000003)
+MIX = np.uint64(0x9E3779B97F4A7C15) # Fibonacci hashing: the top bits of h * MIX are well spread
+
+
+def fold(text):
+    if text.isascii():
+        return text.lower().translate(FOLD) # Punctuation is in the table, so no regex is needed
+    text = COMBINING.sub('', unicodedata.normalize('NFKD', text))
+    return SEPARATORS.sub(' ', text.lower().translate(FOLD))
+
+
+def normalize_batch(texts):
+    '''
+    Folds each text to lower-case words separated by single spaces, with runs
+    of a repeated character squeezed to one, so "FR33 N1TRO!!" and
+    "free   nitrooo" both become "fre nitro". The squeezing is done on one
+    array of code points for the whole batch.
+    '''
+    if not texts:
+        return []
+    codes = np.frombuffer('\0'.join(map(fold, texts)).encode('utf-32-le'), dtype=np.uint32)
+    keep = np.empty(len(codes), dtype=bool)
+    keep[:1] = True
+    np.not_equal(codes[1:], codes[:-1], out=keep[1:])
+    keep |= codes == 0 # Never merge the separators between two empty texts
+    return [text.strip() for text in codes[keep].tobytes().decode('utf-32-le').split('\0')]
+
+
+def normalize(text):
+    return normalize_batch([text])[0]
+
+
+def load_terms(path):
+    '''
+    Reads a term list: one "category<TAB>term[<TAB>weight]" per line, blank
+    lines and # comments ignored. A term is a word or a phrase; weight
+    defaults to 1, which flags a message on its own.
+    '''
+    terms = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].rstrip('\n')
+            if not line.strip():
+                continue
+            fields = line.split('\t')
+            weight = float(fields[2]) if len(fields) > 2 and fields[2].strip() else 1.0
+            terms.append((fields[0].strip(), fields[1].strip(), weight))
+    return terms
+
+
+class TermMatcher:
+    '''
+    Aho-Corasick automaton over the words of the normalised terms. Matching
+    whole words keeps "kys" from firing inside "skys" and costs one dict
+    lookup per word of the message rather than one per character.
+    '''
+    def __init__(self, terms=()):
+        self.goto = [{}] # Map from word to next state, per state
+        self.fail = [0]
+        self.output = [()] # Indexes into self.terms of the terms that end at each state
+        self.terms = [] # (original term, category, weight)
+        for category, original, weight in terms:
+            words = normalize(original).split()
+            if not words:
+                continue
+            state = 0
+            for word in words:
+                nxt = self.goto[state].get(word)
+                if nxt is None:
+                    nxt = self.goto[state][word] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                state = nxt
+            self.output[state] += (len(self.terms),)
+            self.terms.append((original, category, weight))
+        self._link()
+
+    def _link(self):
+        # Breadth first, so every state's fail target is finished before its children need it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and word not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(word, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.output[nxt] += self.output[self.fail[nxt]]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def find(self, text):
+        '''Indexes of the terms found in already normalised text, in order of where they end.'''
+        goto, fail, output = self.goto, self.fail, self.output
+        root = goto[0]
+        found = []
+        state = 0
+        for word in text.split():
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0) if state else root.get(word, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+
+def hashed_ngrams(texts, ngrams=NGRAMS, bits=HASH_BITS):
+    '''
+    Feature indices of every character n-gram of every text, hashed into
+    2**bits buckets, and the index of the text each one came from (in
+    ascending order). All texts are hashed together in a few array operations.
+    '''
+    longest = max(ngrams)
+    joined = '\0'.join(' ' + text + ' ' for text in texts) + '\0' * longest
+    codes = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    count = len(codes) - longest
+    # separators[p] is how many separators come before position p, i.e. which text p is in
+    separators = np.zeros(len(codes) + 1, dtype=np.intp)
+    np.cumsum(codes == 0, out=separators[1:])
+    owner = separators[:count]
+    # One column per n-gram size, so flattening keeps the features of each text together
+    hashes = np.empty((count, len(ngrams)), dtype=np.uint64)
+    valid = np.empty((count, len(ngrams)), dtype=bool)
+    h = codes
+    for n in range(1, longest + 1):
+        if n > 1:
+            h = h[:-1] * PRIME + codes[n - 1:n - 1 + len(h) - 1] # Hash of each n-gram from the (n-1)-gram hash
+        if n in ngrams:
+            j = ngrams.index(n)
+            hashes[:, j] = ((h[:count] ^ np.uint64(n)) * MIX) >> np.uint64(64 - bits) # n mixed in so sizes hash apart
+            np.equal(separators[n:n + count], owner, out=valid[:, j]) # n-grams over a separator are dropped
+    valid = valid.ravel()
+    return hashes.ravel()[valid].astype(np.intp), np.repeat(owner, len(ngrams))[valid]
+
+
+class HashedLinearModel:
+    '''
+    One logistic regression per category over hashed character n-grams. A
+    message's features are its n-gram counts divided by how many it has, so
+    scoring is a gather of weight rows and a per-message sum.
+    '''
+    def __init__(self, categories, weights=None, bias=None, ngrams=NGRAMS, bits=HASH_BITS):
+        self.categories = list(categories)
+        self.ngrams = tuple(ngrams)
+        self.bits = bits
+        self.weights = np.zeros((2**bits, len(self.categories)), dtype=np.float32) if weights is None else weights
+        self.bias = np.zeros(len(self.categories), dtype=np.float32) if bias is None else bias
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls([str(c) for c in data['categories']], data['weights'].astype(np.float32),
+                       data['bias'].astype(np.float32), tuple(int(n) for n in data['ngrams']), int(data['bits']))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(f, categories=np.array(self.categories), weights=self.weights, bias=self.bias,
+                     ngrams=np.array(self.ngrams), bits=np.array(self.bits))
+
+    def _features(self, texts):
+        indices, owners = hashed_ngrams(texts, self.ngrams, self.bits)
+        return indices, owners, np.bincount(owners, minlength=len(texts)).astype(np.float32)
+
+    def logits(self, texts):
+        indices, owners, counts = self._features(texts)
+        if not len(indices):
+            return np.broadcast_to(self.bias, (len(texts), len(self.categories))).copy()
+        # Features arrive grouped by text, so each text's sum is one segment of a reduceat
+        present = counts > 0
+        starts = np.searchsorted(owners, np.flatnonzero(present))
+        sums = np.zeros((len(texts), len(self.categories)), dtype=np.float32)
+        sums[present] = np.add.reduceat(self.weights[indices], starts, axis=0)
+        return sums / np.maximum(counts, 1)[:, None] + self.bias
+
+    def predict(self, texts):
+        '''Probability of each category for each (normalised) text, shape (len(texts), categories).'''
+        if not texts:
+            return np.zeros((0, len(self.categories)), dtype=np.float32)
+        return 1 / (1 + np.exp(-self.logits(texts)))
+
+    def fit(self, texts, labels, epochs=200, lr=20.0, l2=1e-6):
+        '''Full-batch gradient descent on normalised texts and a (len(texts), categories) 0/1 label array.'''
+        indices, owners, counts = self._features(texts)
+        labels = np.asarray(labels, dtype=np.float32)
+        counts = np.maximum(counts, 1)
+        for _ in range(epochs):
+            error = self.predict(texts) - labels
+            scaled = error / counts[:, None] / len(texts)
+            for c in range(len(self.categories)):
+                grad = np.bincount(indices, weights=scaled[owners, c], minlength=2**self.bits)
+                self.weights[:, c] -= (lr * (grad + l2 * self.weights[:, c])).astype(np.float32)
+            self.bias -= lr * error.mean(axis=0) / 10
+
+
+class TextFilter:
+    '''
+    Scores messages with the term list and the n-gram model, whichever is
+    loaded. A category's score is the larger of the model's probability and
+    the summed weights of its matched terms (capped at 1); a message is
+    flagged for its highest scoring category if that reaches threshold.
+
+    Messages given to submit() are scored together with every other message
+    submitted in the same event loop iteration, so a burst of traffic is
+    scored in batches without any handler waiting on it, and
+    on_flagged(message, verdict) is called for each one that is flagged.
+    Until load() is called, or if neither file exists, nothing is flagged.
+    '''
+    def __init__(self, terms_path=None, model_path=None, threshold=0.8, on_flagged=None):
+        self.terms_path = terms_path
+        self.model_path = model_path
+        self.threshold = threshold
+        self.on_flagged = on_flagged
+        self.matcher = TermMatcher()
+        self.model = None
+        self.categories = []
+        self.columns = {} # Map from category to its column in the score array
+        self.pending = [] # (message, text) submitted since the last batch
+        self.stats = {'messages': 0, 'batches': 0, 'term_hits': 0, 'flagged': 0}
+        REGISTRY.register(StatsCounters('modbot_text_filter_total', self.stats, 'Messages scored by the text filter'))
+        gauge('modbot_text_filter_terms', 'Terms on the text filter list', fn=lambda: len(self.matcher))
+        self.batch_size = REGISTRY.register(Histogram(SIZE_BUCKETS, 'modbot_text_batch_size', 'Messages per text filter batch'))
+
+    def load(self):
+        start = time.perf_counter()
+        terms = load_terms(self.terms_path) if self.terms_path and os.path.isfile(self.terms_path) else []
+        model = HashedLinearModel.load(self.model_path) if self.model_path and os.path.isfile(self.model_path) else None
+        self.set_scorers(TermMatcher(terms), model)
+        logger.info('Loaded %d filter terms and %s text model in %.2fs', len(self.matcher),
+                    'a' if model is not None else 'no', time.perf_counter() - start)
+
+    def set_scorers(self, matcher, model=None):
+        categories = list(model.categories) if model is not None else []
+        for _, category, _ in matcher.terms:
+            if category not in categories:
+                categories.append(category)
+        self.matcher, self.model = matcher, model
+        self.categories = categories
+        self.columns = {category: i for i, category in enumerate(categories)}
+
+    def score_batch(self, texts):
+        '''A TextVerdict, or None if nothing reached threshold, for each text.'''
+        self.stats['batches'] += 1
+        self.stats['messages'] += len(texts)
+        if not self.categories:
+            return [None] * len(texts)
+        normalised = normalize_batch(texts)
+        scores = np.zeros((len(texts), len(self.categories)), dtype=np.float32)
+        if self.model is not None:
+            scores[:, :len(self.model.categories)] = self.model.predict(normalised)
+        matched = [()] * len(texts)
+        if len(self.matcher):
+            terms, columns = self.matcher.terms, self.columns
+            for i, text in enumerate(normalised):
+                found = self.matcher.find(text)
+                if not found:
+                    continue
+                matched[i] = found
+                self.stats['term_hits'] += len(found)
+                weights = {}
+                for t in found:
+                    _, category, weight = terms[t]
+                    weights[category] = weights.get(category, 0.0) + weight
+                for category, weight in weights.items():
+                    c = columns[category]
+                    scores[i, c] = max(scores[i, c], min(1.0, weight))
+        worst = scores.argmax(axis=1)
+        verdicts = []
+        for i, c in enumerate(worst):
+            score = float(scores[i, c])
+            if score < self.threshold:
+                verdicts.append(None)
+                continue
+            category = self.categories[c]
+            terms = tuple(dict.fromkeys(self.matcher.terms[t][0] for t in matched[i] if self.matcher.terms[t][1] == category))
+            verdicts.append(TextVerdict(category, score, terms))
+            self.stats['flagged'] += 1
+        return verdicts
+
+    def score(self, text):
+        return self.score_batch([text])[0]
+
+    def submit(self, message, text):
+        self.pending.append((message, text))
+        if len(self.pending) == 1:
+            asyncio.get_running_loop().call_soon(self._flush) # Runs after the other handlers that are ready this iteration
+
+    def _flush(self):
+        batch, self.pending = self.pending, []
+        self.batch_size.observe(len(batch))
+        try:
+            with span('text_filter'):
+                verdicts = self.score_batch([text for _, text in batch])
+        except Exception:
+            logger.exception('Text filter failed for %d messages', len(batch))
+            return
+        for (message, _), verdict in zip(batch, verdicts):
+            if verdict is not None and self.on_flagged is not None:
+                try:
+                    self.on_flagged(message, verdict)
+                except Exception:
+                    logger.exception('Handling a flagged message failed')
+
+
+def read_labelled(path):
+    texts, labels = [], []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                texts.append(row['text'])
+                labels.append(row.get('labels', []))
+    return texts, labels
+
+
+def train(args):
+    texts, labels = read_labelled(args.labelled)
+    categories = args.categories or sorted({label for row in labels for label in row})
+    targets = np.array([[category in row for category in categories] for row in labels], dtype=np.float32)
+    normalised = normalize_batch(texts)
+    model = HashedLinearModel(categories, bits=args.bits)
+    start = time.perf_counter()
+    model.fit(normalised, targets, epochs=args.epochs, lr=args.lr)
+    predictions = model.predict(normalised) >= 0.5
+    print(f'Trained on {len(texts)} messages in {time.perf_counter() - start:.1f}s')
+    for c, category in enumerate(categories):
+        tp = int((predictions[:, c] & (targets[:, c] > 0)).sum())
+        print(f'  {category}: precision {tp / max(1, predictions[:, c].sum()):.2%}, '
+              f'recall {tp / max(1, targets[:, c].sum()):.2%} (training set)')
+    model.save(args.out)
+
+
+def bench(args):
+    # Synthetic term list, model and traffic, with a few listed terms obfuscated into some messages
+    rng = random.Random(152)
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    def word():
+        return ''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+    categories = ['Hate Speech', 'Spam', 'Scam or Fraud', 'Bullying or Harassment']
+    terms = [(rng.choice(categories), ' '.join(word() for _ in range(rng.randint(1, 3))), 1.0) for _ in range(args.terms)]
+    model = HashedLinearModel(categories)
+    model.weights = np.random.default_rng(152).normal(0, 1, model.weights.shape).astype(np.float32)
+    model.bias[:] = -6
+    leet = {'a': '4', 'e': '3', 'o': '0', 's': '$', 'i': '1'}
+    messages = []
+    for _ in range(args.messages):
+        words = [word() for _ in range(rng.randint(3, 25))]
+        if rng.random() < 0.05:
+            term = rng.choice(terms)[1]
+            words.insert(rng.randrange(len(words) + 1), ''.join(leet.get(ch, ch) for ch in term).upper())
+        messages.append(' '.join(words))
+
+    text_filter = TextFilter(threshold=args.threshold)
+    start = time.perf_counter()
+    text_filter.set_scorers(TermMatcher(terms), model)
+    print(f'Built automaton for {len(terms)} terms ({len(text_filter.matcher.goto)} states) in {time.perf_counter() - start:.2f}s')
+    print(f'{len(messages)} messages, mean {sum(map(len, messages)) / len(messages):.0f} characters')
+
+    start = time.perf_counter()
+    for message in messages:
+        text_filter.score(message)
+    single = time.perf_counter() - start
+    print(f'One at a time:   {single / len(messages) * 1e6:.1f}us per message')
+
+    start = time.perf_counter()
+    flagged = 0
+    for i in range(0, len(messages), args.batch):
+        flagged += sum(v is not None for v in text_filter.score_batch(messages[i:i + args.batch]))
+    batched = time.perf_counter() - start
+    print(f'Batches of {args.batch}: {batched / len(messages) * 1e6:.1f}us per message, {flagged} flagged')
+
+    normalised = normalize_batch(messages)
+    start = time.perf_counter()
+    for text in normalised:
+        text_filter.matcher.find(text)
+    print(f'  of which term matching {(time.perf_counter() - start) / len(messages) * 1e6:.1f}us per message')
+    start = time.perf_counter()
+    for i in range(0, len(normalised), args.batch):
+        model.predict(normalised[i:i + args.batch])
+    print(f'  and the n-gram model {(time.perf_counter() - start) / len(messages) * 1e6:.1f}us per message')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train or benchmark the automatic text filter.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parser_bench = commands.add_parser('bench', help='time scoring on a synthetic term list and traffic')
+    parser_bench.add_argument('--terms', type=int, default=20000)
+    parser_bench.add_argument('--messages', type=int, default=20000)
+    parser_bench.add_argument('--batch', type=int, default=256)
+    parser_bench.add_argument('--threshold', type=float, default=0.8)
+    parser_train = commands.add_parser('train', help='fit the n-gram model on labelled messages')
+    parser_train.add_argument('labelled', help='JSONL file of {"text": ..., "labels": [...]}')
+    parser_train.add_argument('out', help='where to write the model (.npz)')
+    parser_train.add_argument('--categories', nargs='+', help='defaults to every label in the file')
+    parser_train.add_argument('--bits', type=int, default=HASH_BITS)
+    parser_train.add_argument('--epochs', type=int, default=200)
+    parser_train.add_argument('--lr', type=float, default=20.0)
+    args = parser.parse_args()
+    if args.command == 'bench':
+        bench(args)
+    else:
+        train(args)
+
+
+if __name__ == '__main__':
+    main()
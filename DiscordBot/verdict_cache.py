@@ -0,0 +1,151 @@
+import json
+import os
+import time
+import logging
+from collections import OrderedDict
+from image_hash import HammingIndex
+from metrics import StatsCounters, gauge, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of one entry: OrderedDict slot, 64-char digest, tuple, and the perceptual index sets
+ENTRY_BYTES = 480
+
+
+class VerdictCache:
+    '''
+    Remembers the classifier's label for images it has already seen, keyed by
+    the SHA-256 of the file and by its perceptual hash, so a repost (or a
+    lightly re-encoded copy) is labelled without another forward pass.
+
+    Entries expire after ttl seconds and the least recently used ones are
+    evicted to stay within max_bytes. Every entry belongs to one set of model
+    weights; when version_fn reports different weights the cache is emptied.
+    '''
+    def __init__(self, version_fn, max_bytes=32 * 2**20, ttl=7 * 24 * 3600, max_distance=4, path=None):
+        self.version_fn = version_fn # Returns an id for the current weights, or None if none are loaded yet
+        self.max_entries = max(1, max_bytes // ENTRY_BYTES)
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.path = path
+        self.version = None
+        self.entries = OrderedDict() # sha256 -> (phash, label, expires)
+        self.by_phash = {} # phash -> set of sha256 of the cached entries with that hash
+        self.index = HammingIndex(max_distance)
+        self.stats = {'exact_hits': 0, 'near_hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        REGISTRY.register(StatsCounters('modbot_verdict_cache_total', self.stats, 'Verdict cache lookups and evictions'))
+        gauge('modbot_verdict_cache_entries', 'Images in the verdict cache', fn=self.__len__)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _check_version(self):
+        '''Returns False if the current weights are unknown; clears the cache if they changed.'''
+        current = self.version_fn()
+        if current is None:
+            return False
+        if current != self.version:
+            if self.entries:
+                logger.info('Model weights changed, dropping %d cached verdicts', len(self.entries))
+                self.stats['invalidations'] += 1
+            self.clear()
+            self.version = current
+        return True
+
+    def clear(self):
+        self.entries.clear()
+        self.by_phash.clear()
+        self.index = HammingIndex(self.max_distance)
+
+    def _add(self, sha, entry):
+        self.entries[sha] = entry
+        shas = self.by_phash.get(entry[0])
+        if shas is None:
+            shas = self.by_phash[entry[0]] = set()
+            self.index.add(entry[0])
+        shas.add(sha)
+
+    def _remove(self, sha):
+        phash, _, _ = self.entries.pop(sha)
+        shas = self.by_phash[phash]
+        shas.discard(sha)
+        # Other files with the same perceptual hash keep it in the index
+        if not shas:
+            del self.by_phash[phash]
+            self.index.remove(phash)
+
+    def _live(self, sha, now):
+        entry = self.entries.get(sha)
+        if entry is None:
+            return None
+        if entry[2] < now:
+            self._remove(sha)
+            return None
+        self.entries.move_to_end(sha)
+        return entry
+
+    def lookup_exact(self, sha):
+        '''(perceptual hash, label) for an identical file, or None.'''
+        if not self._check_version():
+            return None
+        entry = self._live(sha, time.time())
+        if entry is None:
+            return None
+        self.stats['exact_hits'] += 1
+        return entry[0], entry[1]
+
+    def lookup_similar(self, phash):
+        '''Label for the closest cached image within max_distance bits, or None.'''
+        if not self._check_version():
+            return None
+        now = time.time()
+        for candidate, _ in self.index.search(phash):
+            for sha in list(self.by_phash.get(candidate, ())): # _live may drop expired entries from the set
+                entry = self._live(sha, now)
+                if entry is not None:
+                    self.stats['near_hits'] += 1
+                    return entry[1]
+        self.stats['misses'] += 1
+        return None
+
+    def store(self, sha, phash, label):
+        if not self._check_version():
+            return
+        if sha in self.entries:
+            self._remove(sha)
+        self._add(sha, (phash, label, time.time() + self.ttl))
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.stats['evictions'] += 1
+
+    def save(self):
+        if self.path is None or self.version is None:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.version,
+                       'entries': [[sha, phash, label, expires] for sha, (phash, label, expires) in self.entries.items()]}, f)
+        os.replace(tmp, self.path)
+
+    def load(self):
+        '''Restores entries saved by save(); they are dropped on first use if the weights have changed since.'''
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('Ignoring unreadable verdict cache %s', self.path, exc_info=True)
+            return
+        self.clear()
+        self.version = saved['version']
+        now = time.time()
+        for sha, phash, label, expires in saved['entries']:
+            if expires < now:
+                continue
+            self._add(sha, (phash, label, expires))
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def snapshot(self):
+        return dict(self.stats, entries=len(self.entries), max_entries=self.max_entries)
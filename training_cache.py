@@ -0,0 +1,297 @@
+'''
+Training data cache for the notebook. pack() decodes the adults/, kittens/ and
+Other/ directories once, resizes every image to 256x256 (shorter side to 256,
+then the centre square, as the validation transform already does) and stores
+them in one memory-mapped uint8 array with a JSON index of paths and labels.
+PackedImageDataset reads zero-copy slices of that array and does the random
+crops and flips on uint8 tensors, and make_loaders() feeds it through
+multi-worker, pinned-memory DataLoaders; to_input() normalises each batch on
+the training device.
+
+    python training_cache.py pack . train_cache
+    python training_cache.py bench . train_cache --epochs 2
+
+bench times epochs of the notebook's current pipeline (PIL decode of every
+JPEG, default workers, validation batch size 1) and of the cached one on the
+same train/validation split.
+
+The cache takes 192 KiB per image (about 2 GB for 10,000 images).
+RandomResizedCrop picks its crop from the 256x256 square rather than the full
+original image, which trims the longer side slightly more than before.
+'''
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.utils.data import Dataset, DataLoader
+from torchvision import models, transforms
+from torchvision.transforms import functional
+from PIL import Image
+from tqdm import tqdm
+
+CLASS_DIRS = {'adults': 0, 'kittens': 1, 'Other': 2} # Training directory for each label, as in the notebook
+PACK_SIZE = 256
+CROP_SIZE = 224
+IMAGES_FILE = 'images.npy'
+INDEX_FILE = 'index.json'
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Augmentations on uint8 CxHxW tensors; normalisation is left to to_input()
+train_transform = transforms.Compose([
+    transforms.RandomResizedCrop(CROP_SIZE, antialias=True),
+    transforms.RandomHorizontalFlip(),
+])
+val_transform = transforms.CenterCrop(CROP_SIZE)
+
+
+def list_images(root):
+    '''(path, label) for every file in root's class directories, in a fixed order.'''
+    images = []
+    for name, label in CLASS_DIRS.items():
+        directory = os.path.join(root, name)
+        for filename in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+            images.append((os.path.join(directory, filename), label))
+    return images
+
+
+def decode(path, size=PACK_SIZE):
+    """image file -> size x size x 3 uint8 array"""
+    with Image.open(path) as image:
+        image = functional.resize(image.convert('RGB'), size)
+        return np.asarray(functional.center_crop(image, size))
+
+
+# Each pack worker opens the output array once and writes its rows straight into it
+_pack_images = None
+
+def _open_pack(path):
+    global _pack_images
+    _pack_images = np.load(path, mmap_mode='r+')
+
+def _pack_one(task):
+    row, path = task
+    try:
+        _pack_images[row] = decode(path, _pack_images.shape[1])
+        return row, True
+    except Exception:
+        return row, False
+
+
+def load_index(cache_dir):
+    with open(os.path.join(cache_dir, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def pack(root, cache_dir, size=PACK_SIZE, workers=None):
+    '''
+    Decodes every image under root's class directories into cache_dir and
+    returns the index. Does nothing if the cache already holds exactly these
+    files at this size. Images that can't be decoded are listed in the
+    index's "failed" rows and left out of the datasets.
+    '''
+    images = list_images(root)
+    paths = [path for path, _ in images]
+    index_path = os.path.join(cache_dir, INDEX_FILE)
+    if os.path.isfile(index_path):
+        index = load_index(cache_dir)
+        if index['paths'] == paths and index['size'] == size:
+            return index
+    os.makedirs(cache_dir, exist_ok=True)
+    images_path = os.path.join(cache_dir, IMAGES_FILE)
+    array = np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(len(images), size, size, 3))
+    del array # Header written; the workers fill in the rows
+
+    start = time.perf_counter()
+    failed = []
+    with multiprocessing.Pool(workers or os.cpu_count(), initializer=_open_pack, initargs=(images_path,)) as pool:
+        for row, ok in tqdm(pool.imap_unordered(_pack_one, enumerate(paths), chunksize=16), total=len(paths)):
+            if not ok:
+                failed.append(row)
+    index = {'size': size, 'classes': CLASS_DIRS, 'paths': paths, 'labels': [label for _, label in images],
+             'failed': sorted(failed)}
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f'Packed {len(paths) - len(failed)} images ({len(failed)} unreadable) in {time.perf_counter() - start:.1f}s')
+    return index
+
+
+class PackedImageDataset(Dataset):
+    '''
+    Images from a pack() cache, as (uint8 3x224x224 tensor, label). Training
+    items are randomly resized, cropped and flipped; validation items are the
+    centre crop, which matches Resize(256) + CenterCrop(224).
+    '''
+    def __init__(self, cache_dir, rows, labels, train):
+        self.path = os.path.join(cache_dir, IMAGES_FILE)
+        self.rows = rows
+        self.labels = labels
+        self.transform = train_transform if train else val_transform
+        self.images = None # Opened on first use in each worker, since pickling a memmap copies it
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.load(self.path, mmap_mode='c') # Copy-on-write, so torch can wrap it without copying
+        image = torch.from_numpy(self.images[self.rows[idx]]).permute(2, 0, 1)
+        return self.transform(image), self.labels[idx]
+
+
+def split_rows(index, val_fraction=0.2, seed=152):
+    '''Shuffled (train rows, validation rows) of the images that decoded.'''
+    failed = set(index['failed'])
+    rows = [row for row in range(len(index['paths'])) if row not in failed]
+    order = torch.randperm(len(rows), generator=torch.Generator().manual_seed(seed)).tolist()
+    rows = [rows[i] for i in order]
+    n_val = int(len(rows) * val_fraction)
+    return rows[n_val:], rows[:n_val]
+
+
+def make_loaders(cache_dir, val_fraction=0.2, batch_size=64, val_batch_size=256, num_workers=None, seed=152):
+    '''{'train': DataLoader, 'val': DataLoader} over a pack() cache, for the notebook's training loop.'''
+    index = load_index(cache_dir)
+    train_rows, val_rows = split_rows(index, val_fraction, seed)
+    labels = index['labels']
+    num_workers = os.cpu_count() if num_workers is None else num_workers
+    options = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+    if num_workers:
+        options.update(persistent_workers=True, prefetch_factor=4)
+    return {
+        'train': DataLoader(PackedImageDataset(cache_dir, train_rows, [labels[r] for r in train_rows], True),
+                            batch_size=batch_size, shuffle=True, **options),
+        'val': DataLoader(PackedImageDataset(cache_dir, val_rows, [labels[r] for r in val_rows], False),
+                          batch_size=val_batch_size, shuffle=False, **options),
+    }
+
+
+def to_input(images, device):
+    '''
+    Loader batch -> model input on device. uint8 batches from make_loaders()
+    are normalised there; float batches (the PIL pipeline) are only moved.
+    '''
+    images = images.to(device, non_blocking=True)
+    if images.dtype != torch.uint8:
+        return images
+    mean = torch.tensor(MEAN, device=device).view(1, 3, 1, 1) * 255
+    std = torch.tensor(STD, device=device).view(1, 3, 1, 1) * 255
+    return (images.float() - mean) / std
+
+
+class NotebookDataset(Dataset):
+    '''CustomImageDataset from the notebook: opens and decodes the JPEG on every access.'''
+    transforms = {
+        'train': transforms.Compose([
+            transforms.RandomResizedCrop(CROP_SIZE),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            transforms.Normalize(MEAN, STD),
+        ]),
+        'val': transforms.Compose([
+            transforms.Resize(PACK_SIZE),
+            transforms.CenterCrop(CROP_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize(MEAN, STD),
+        ]),
+    }
+
+    def __init__(self, paths, labels, split):
+        self.paths = paths
+        self.labels = labels
+        self.split = split
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        image = Image.open(self.paths[idx]).convert('RGB')
+        return self.transforms[self.split](image), self.labels[idx]
+
+
+def run_epoch(loader, device, model=None, criterion=None, optimizer=None, train=False):
+    '''Seconds to go through the loader once, with a training or evaluation step per batch if model is given.'''
+    start = time.perf_counter()
+    if model is not None:
+        model.train(train)
+    for inputs, labels in loader:
+        inputs = to_input(inputs, device)
+        labels = labels.to(device, non_blocking=True)
+        if model is None:
+            continue
+        with torch.set_grad_enabled(train):
+            loss = criterion(model(inputs), labels)
+            if train:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def bench(args):
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    index = pack(args.root, args.cache, workers=args.workers)
+    train_rows, val_rows = split_rows(index)
+    paths, labels = index['paths'], index['labels']
+    pipelines = {
+        'current': {
+            'train': DataLoader(NotebookDataset([paths[r] for r in train_rows], [labels[r] for r in train_rows], 'train'),
+                                batch_size=64, shuffle=True),
+            'val': DataLoader(NotebookDataset([paths[r] for r in val_rows], [labels[r] for r in val_rows], 'val'),
+                              batch_size=1, shuffle=True),
+        },
+        'cached': make_loaders(args.cache, num_workers=args.workers),
+    }
+    model = criterion = optimizer = None
+    if args.model != 'none':
+        model = getattr(models, args.model)(weights=None)
+        model.fc = nn.Linear(model.fc.in_features, len(CLASS_DIRS))
+        model = model.to(device)
+        criterion = nn.CrossEntropyLoss()
+        optimizer = optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
+
+    print(f'{len(train_rows)} training and {len(val_rows)} validation images on {device}, model: {args.model}')
+    print(f"{'pipeline':<10}{'epoch':>6}{'train s':>10}{'val s':>10}{'images/s':>10}")
+    results = {}
+    for name, loaders in pipelines.items():
+        for epoch in range(args.epochs):
+            train_seconds = run_epoch(loaders['train'], device, model, criterion, optimizer, train=True)
+            val_seconds = run_epoch(loaders['val'], device, model, criterion)
+            rate = (len(train_rows) + len(val_rows)) / (train_seconds + val_seconds)
+            print(f'{name:<10}{epoch:>6}{train_seconds:>10.2f}{val_seconds:>10.2f}{rate:>10.1f}')
+            results.setdefault(name, []).append(train_seconds + val_seconds)
+    # The first cached epoch includes starting the workers; later ones are the steady state
+    current, cached = min(results['current']), min(results['cached'])
+    print(f'Best epoch: current {current:.2f}s, cached {cached:.2f}s ({current / cached:.1f}x)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the training images into a memory-mapped cache, or time it against the current loaders.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for command, help in (('pack', 'decode the class directories into the cache'),
+                          ('bench', 'time training epochs with the current and cached pipelines')):
+        sub = commands.add_parser(command, help=help)
+        sub.add_argument('root', help='directory containing adults/, kittens/ and Other/')
+        sub.add_argument('cache', help='cache directory to write or read')
+        sub.add_argument('--workers', type=int, default=None, help='decoding and loader processes (default: one per core)')
+        if command == 'pack':
+            sub.add_argument('--size', type=int, default=PACK_SIZE)
+        else:
+            sub.add_argument('--epochs', type=int, default=2)
+            sub.add_argument('--model', default='resnet50', help="torchvision model to train, or 'none' to time loading only")
+    args = parser.parse_args()
+    if args.command == 'pack':
+        pack(args.root, args.cache, size=args.size, workers=args.workers)
+    else:
+        bench(args)
+
+
+if __name__ == '__main__':
+    main()